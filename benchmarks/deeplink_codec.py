@@ -0,0 +1,58 @@
+"""
+Compare the length and the speed of the binary deep link codec with the itsdangerous one it replaced.
+
+Run from the root of the repository with::
+
+    python -m benchmarks.deeplink_codec
+"""
+
+import timeit
+
+import itsdangerous
+
+from thorunimore.deeplinking import DeepLinking
+
+ROUNDS = 20_000
+"""How many times each payload should be encoded and decoded."""
+
+PREFIXES = ["123456", "mario.rossi", "maria_grazia.dellavalle-bianchi"]
+"""Email prefixes of increasing length to encode."""
+
+
+class LegacyDeepLinking:
+    """The codec used before the binary layout was introduced."""
+
+    def __init__(self, secret_key: str, namespace: str = "t"):
+        self.serializer = itsdangerous.URLSafeSerializer(secret_key=secret_key, salt=namespace)
+
+    def encode(self, value):
+        signed = self.serializer.dumps(value)
+        signed = signed.replace("_", "_u").replace(".", "_d")
+        return signed
+
+    def decode(self, signed: str):
+        signed = signed.replace("_d", ".").replace("_u", "_")
+        value = self.serializer.loads(signed)
+        return value
+
+
+def main():
+    legacy = LegacyDeepLinking("benchmark")
+    binary = DeepLinking("benchmark")
+
+    for prefix in PREFIXES:
+        value = ("R", prefix)
+        for name, codec in (("legacy", legacy), ("binary", binary)):
+            payload = codec.encode(value)
+            encode = timeit.timeit(lambda: codec.encode(value), number=ROUNDS) / ROUNDS
+            decode = timeit.timeit(lambda: codec.decode(payload), number=ROUNDS) / ROUNDS
+            fits = "fits" if len(payload) <= DeepLinking.MAX_LENGTH else "TOO LONG"
+            print(f"{name} | {prefix:32} | {len(payload):3} chars {fits:8} | "
+                  f"encode {encode * 1e6:6.2f} µs | decode {decode * 1e6:6.2f} µs")
+
+    # Links issued by the legacy codec keep working
+    assert binary.decode(legacy.encode(("R", "mario.rossi"))) == ("R", "mario.rossi")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Measure how long rendering the whois announcements of a join storm takes, with and without the render memo.
+
+Every join is rendered from freshly loaded rows, as the repository does, while the same few hundred students join
+many groups at once.
+
+Run from the root of the repository with::
+
+    python -m benchmarks.join_rendering
+"""
+
+import random
+import time
+
+from thorunimore.database import Student, Telegram
+from thorunimore.database.rendering import rendered
+
+STUDENTS = 500
+"""How many different students join."""
+
+JOINS = 20_000
+"""How many joins should be announced."""
+
+
+def load(number: int) -> Telegram:
+    """Build the rows of a student as they would be loaded from the database, with new instances every time."""
+    st = Student(email_prefix=f"{200000 + number}", domain="studenti.unimore.it", first_name="Mario",
+                 last_name=f"Rossi Ò'{number}", privacy=False, version=1)
+    for account in range(1 + number % 3):
+        Telegram(id=number * 10 + account, first_name="Mario", last_name=f"<{number}>",
+                 username=f"mario{number}_{account}", version=1, st=st)
+    return st.tg[0]
+
+
+def storm(seed: int) -> float:
+    rng = random.Random(seed)
+    joins = [load(rng.randrange(STUDENTS)) for _ in range(JOINS)]
+    start = time.perf_counter()
+    for tg in joins:
+        tg.whois()
+    return time.perf_counter() - start
+
+
+def main():
+    rendered.max_size = 0
+    without = storm(seed=1)
+
+    rendered.max_size = 10000
+    rendered.clear()
+    memoized = storm(seed=1)
+
+    print(f"without memo | {JOINS} joins | {without * 1000:8.2f} ms | {without / JOINS * 1e6:6.2f} µs per join")
+    print(f"with memo    | {JOINS} joins | {memoized * 1000:8.2f} ms | {memoized / JOINS * 1e6:6.2f} µs per join")
+    print(f"{rendered!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Measure how responsive the bot's event loop stays while the database is slow.
+
+A burst of join events is handled while a probe coroutine keeps measuring how late the event loop wakes it up, once
+with the database queries run directly on the loop, and once through the :class:`Repository`.
+
+Run from the root of the repository with::
+
+    python -m benchmarks.loop_latency
+"""
+
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from thorunimore.database import Student, Telegram
+from thorunimore.database.base import Base
+from thorunimore.telegram.repository import Repository
+
+DB_DELAY = 0.050
+"""How long each query should take, in seconds."""
+
+JOINS = 20
+"""How many join events are handled at the same time."""
+
+PROBE_INTERVAL = 0.005
+"""How often the probe should try to wake up, in seconds."""
+
+
+def create_sessionmaker(path: str) -> sqlalchemy.orm.sessionmaker:
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def slow_down(*_, **__):
+        time.sleep(DB_DELAY)
+
+    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+    session = Session()
+    st = Student(email_prefix="123456", first_name="STEFANO", last_name="PIGOZZI", privacy=False)
+    session.add(Telegram(id=1, first_name="Steffo", st=st))
+    session.commit()
+    session.close()
+    return Session
+
+
+async def probe(lags: list, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        before = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - before - PROBE_INTERVAL)
+
+
+async def blocking_join(Session: sqlalchemy.orm.sessionmaker, tg_id: int) -> None:
+    session = Session()
+    tg = session.query(Telegram).filter_by(id=tg_id).one_or_none()
+    if tg is not None:
+        tg.st.whois()
+    session.close()
+
+
+async def repository_join(repository: Repository, tg_id: int) -> None:
+    await repository.whois_tg_id(tg_id)
+
+
+async def measure(name: str, handler) -> None:
+    lags = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    await asyncio.sleep(PROBE_INTERVAL * 2)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[handler(tg_id % 2) for tg_id in range(JOINS)])
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await probe_task
+    print(f"{name:<12} | "
+          f"{JOINS} joins in {elapsed * 1000:8.1f} ms | "
+          f"loop lag mean {statistics.mean(lags) * 1000:7.1f} ms, max {max(lags) * 1000:7.1f} ms")
+
+
+async def run():
+    with tempfile.TemporaryDirectory() as directory:
+        Session = create_sessionmaker(os.path.join(directory, "bench.sqlite"))
+        repository = Repository(sessionmaker=Session, max_workers=4)
+
+        await measure("blocking", lambda tg_id: blocking_join(Session, tg_id))
+        await measure("repository", lambda tg_id: repository_join(repository, tg_id))
+
+        repository.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
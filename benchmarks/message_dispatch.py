@@ -0,0 +1,69 @@
+"""
+Measure how much handling an ordinary group message costs, before and after routing.
+
+Before routing, every message created a Dialog and advanced it once; now the router drops messages which aren't
+commands before any Dialog is created.
+
+Run from the root of the repository with::
+
+    python -m benchmarks.message_dispatch
+"""
+
+import asyncio
+import os
+import time
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+from thorunimore.telegram.dialog import Dialog
+from thorunimore.telegram.router import Route, route
+
+MESSAGES = 100_000
+"""How many messages should be handled."""
+
+
+class FakeMessage:
+    def __init__(self, message: str, is_private: bool):
+        self.message = message
+        self.is_private = is_private
+        self.chat_id = -1001234567890
+
+
+CHATTER = [
+    FakeMessage("ciao a tutti!", is_private=False),
+    FakeMessage("qualcuno ha gli appunti di analisi?", is_private=False),
+    FakeMessage("", is_private=False),
+    FakeMessage("https://example.org/", is_private=False),
+]
+
+
+async def before(msg: FakeMessage) -> None:
+    menu = await Dialog.create(sender=None, entity=None, repository=None, policies=None, username="thorunimorebot")
+    try:
+        await menu.next(msg)
+    except StopAsyncIteration:
+        pass
+
+
+async def after(msg: FakeMessage) -> None:
+    if route(msg, has_dialog=False) is Route.IGNORE:
+        return
+    await before(msg)
+
+
+async def measure(name: str, handler) -> None:
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        await handler(CHATTER[i % len(CHATTER)])
+    elapsed = time.perf_counter() - start
+    print(f"{name:<8} | {MESSAGES} messages in {elapsed * 1000:8.1f} ms | "
+          f"{elapsed / MESSAGES * 1_000_000:7.2f} µs per message")
+
+
+async def run():
+    await measure("before", before)
+    await measure("after", after)
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
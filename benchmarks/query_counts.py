@@ -0,0 +1,110 @@
+"""
+Count the SQL statements issued by each whois command and by the whois API, and fail if any of them issues more than
+its budget.
+
+Run from the root of the repository with::
+
+    python -m benchmarks.query_counts
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+directory = tempfile.mkdtemp()
+with open(os.path.join(directory, "oidc.json"), "w") as fixture:
+    json.dump({"metadata": {"jwks_uri": "https://example.org/jwks"}, "jwks": {"keys": []}}, fixture)
+os.environ.update({
+    "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(directory, 'counts.sqlite')}",
+    "DATABASE_AUTO_MIGRATE": "true",
+    "SECRET_KEY": "benchmark",
+    "GOOGLE_CLIENT_ID": "benchmark",
+    "GOOGLE_CLIENT_SECRET": "benchmark",
+    "TELEGRAM_BOT_USERNAME": "thorunimorebot",
+    "API_RATE_BACKEND": "memory",
+    "OIDC_FIXTURE": os.path.join(directory, "oidc.json"),
+})
+
+import sqlalchemy.orm
+
+from thorunimore.database import Student, Telegram, Token
+from thorunimore.database.engine import StatementCounter
+from thorunimore.telegram.repository import Repository
+from thorunimore.web.__main__ import api_tokens, app, db
+
+BUDGETS = {
+    "whois_tg_id": 1,
+    "whois_username": 1,
+    "whois_email": 1,
+    "whois_real_name": 1,
+    "whois_tg_ids": 1,
+    "whois_tg_ids_indexed": 0,
+    "api_whois": 1,
+}
+"""The maximum number of statements each operation may issue."""
+
+
+def seed(Session: sqlalchemy.orm.sessionmaker) -> None:
+    session = Session()
+    for number in range(3):
+        st = Student(email_prefix=f"10000{number}", first_name="MARIO", last_name="ROSSI", privacy=False)
+        session.add(Telegram(id=number * 2, first_name="Mario", username=f"mario{number}", st=st))
+        session.add(Telegram(id=number * 2 + 1, first_name="Mario", username=f"mario{number}bis", st=st))
+    session.add(Token(token="benchmark", owner_id=0))
+    session.commit()
+    session.close()
+
+
+async def count_repository(engine: sqlalchemy.engine.Engine, repository: Repository) -> dict:
+    operations = {
+        "whois_tg_id": lambda: repository.whois_tg_id(0, full=True),
+        "whois_username": lambda: repository.whois_username("mario0", full=True),
+        "whois_email": lambda: repository.whois_email("100000", full=True),
+        "whois_real_name": lambda: repository.whois_real_name("Mario Rossi", full=True),
+        "whois_tg_ids": lambda: repository.whois_tg_ids([0, 2, 4, 999]),
+    }
+    counts = {}
+    for name, operation in operations.items():
+        with StatementCounter(engine) as counter:
+            await operation()
+        counts[name] = counter.count
+
+    # Once the verified index is loaded, joins of unregistered accounts are decided without any query
+    await repository.load_verified()
+    with StatementCounter(engine) as counter:
+        await repository.whois_tg_ids([997, 998, 999])
+    counts["whois_tg_ids_indexed"] = counter.count
+    return counts
+
+
+def count_api(client) -> dict:
+    with StatementCounter(db.engine) as counter:
+        response = client.get("/api/benchmark/whois/0")
+        assert response.status_code == 200, response.status_code
+    return {"api_whois": counter.count}
+
+
+def main() -> int:
+    Session = sqlalchemy.orm.sessionmaker(bind=db.engine)
+    seed(Session)
+    with app.app_context():
+        api_tokens.refresh()
+
+    repository = Repository(sessionmaker=Session, max_workers=1)
+    counts = asyncio.run(count_repository(db.engine, repository))
+    repository.shutdown()
+    counts.update(count_api(app.test_client()))
+
+    regressed = False
+    for name, budget in BUDGETS.items():
+        count = counts[name]
+        status = "ok" if count <= budget else "REGRESSED"
+        regressed = regressed or count > budget
+        print(f"{name:<20} | {count:3} statements | budget {budget:3} | {status}")
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
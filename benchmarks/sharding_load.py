@@ -0,0 +1,243 @@
+"""
+Load test the sharded mode with a fake TelegramClient, comparing how many messages per second are handled by a single
+process and by a receiver with worker processes.
+
+Most messages are ordinary chatter in the monitored groups, which the bot should drop as cheaply as possible; the
+others are /whois commands of registered accounts in private chats, which query the database and render a reply.
+The replies of each chat are also checked to arrive in the same order as the commands, while fetching the chat and the
+sender of some messages takes a random time, like it does when they aren't cached.
+
+The CPU time spent by the process receiving the messages is reported too, as with enough cores it is what limits the
+throughput of the sharded mode.
+
+Run from the root of the repository with::
+
+    python -m benchmarks.sharding_load [WORKERS...]
+"""
+
+import asyncio
+import collections
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("BASE_URL", "https://example.org/")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import telethon.client.buttons
+import telethon.tl.types
+import telethon.utils
+
+from thorunimore.database import Student, Telegram
+from thorunimore.database.base import Base
+from thorunimore.telegram.components import *
+from thorunimore.telegram.handler import MessageHandler
+from thorunimore.telegram.sender import Sender
+from thorunimore.telegram.sharding import ShardPool
+
+ACCOUNTS = 1_000
+"""How many registered accounts the database should contain."""
+
+CHATS = 200
+"""How many private chats should send commands at the same time."""
+
+MESSAGES = 4_000
+"""How many commands should be sent in total."""
+
+GROUPS = 20
+"""How many groups should be chatting at the same time."""
+
+CHATTER = 4
+"""How many ordinary group messages should be sent for every command."""
+
+WORKERS = [1, 2, 4]
+"""How many worker processes should be tried, if not specified on the command line."""
+
+UNLIMITED = 1_000_000_000
+"""A rate limit high enough to never be hit."""
+
+SLOW_FETCHES = 0.1
+"""The fraction of the messages whose chat and sender take a while to be fetched."""
+
+
+class FakeMessage:
+    """
+    Stands in for a message received by the TelegramClient, whose chat and sender may take a while to be fetched.
+    """
+
+    def __init__(self, chat, user: telethon.tl.types.User, message: str, delay: float):
+        self.chat_id = telethon.utils.get_peer_id(chat)
+        self.chat = chat
+        self.sender = user
+        self.message = message
+        self.is_private = chat is user
+        self.delay = delay
+
+    async def get_chat(self):
+        await asyncio.sleep(self.delay)
+        return self.chat
+
+    async def get_sender(self):
+        return self.sender
+
+
+class FakeClient:
+    """
+    Stands in for the TelegramClient of the bot: it produces the received messages, and records the sent ones instead
+    of sending them.
+    """
+
+    build_reply_markup = staticmethod(telethon.client.buttons.ButtonMethods.build_reply_markup)
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.commands = collections.defaultdict(list)
+        self.replies = collections.defaultdict(list)
+        self.count = 0
+        self.done = asyncio.Event()
+
+    def updates(self):
+        users = [
+            telethon.tl.types.User(id=10_000 + number, access_hash=number, first_name="Mario", username=f"user{number}")
+            for number in range(CHATS)
+        ]
+        groups = [
+            telethon.tl.types.Chat(id=1_000 + number, title=f"Group {number}", photo=telethon.tl.types.ChatPhotoEmpty(),
+                                   participants_count=CHATS, date=None, version=1)
+            for number in range(GROUPS)
+        ]
+        delays = random.Random(0)
+        for number in range(MESSAGES):
+            for chatter in range(CHATTER):
+                yield FakeMessage(
+                    chat=groups[(number * CHATTER + chatter) % GROUPS],
+                    user=users[(number + chatter) % CHATS],
+                    message="Qualcuno ha gli appunti di ieri?",
+                    delay=delays.uniform(0, 0.01) if delays.random() < SLOW_FETCHES else 0,
+                )
+            user = users[number % CHATS]
+            email = f"{number % ACCOUNTS}@studenti.unimore.it"
+            self.commands[user.id].append(email)
+            yield FakeMessage(
+                chat=user,
+                user=user,
+                message=f"/whois {email}",
+                delay=delays.uniform(0, 0.01) if delays.random() < SLOW_FETCHES else 0,
+            )
+
+    async def send_message(self, entity, message, **kwargs):
+        self.replies[telethon.utils.get_peer_id(entity)].append(message)
+        self.count += 1
+        if self.count == self.expected:
+            self.done.set()
+
+
+def seed(alchemist) -> None:
+    Base.metadata.create_all(bind=alchemist.engine)
+    with alchemist.engine.begin() as connection:
+        connection.execute(Student.__table__.insert(), [
+            {"email_prefix": str(number), "first_name": "MARIO", "last_name": f"ROSSI{number}",
+             "search_name": f"mario rossi{number}", "privacy": False}
+            for number in range(ACCOUNTS)
+        ])
+        connection.execute(Telegram.__table__.insert(), [
+            {"id": 10_000 + number, "first_name": "Mario", "username": f"user{number}", "st_email_prefix": str(number)}
+            for number in range(ACCOUNTS)
+        ])
+
+
+def disordered(client: FakeClient) -> int:
+    # The number of chats whose replies arrived in a different order than their commands
+    return sum(
+        1 for chat_id, commands in client.commands.items()
+        if [re.search(r"\d+@studenti\.unimore\.it", reply).group(0) for reply in client.replies[chat_id]] != commands
+    )
+
+
+def report(name: str, elapsed: float, cpu: float, client: FakeClient) -> None:
+    total = MESSAGES * (CHATTER + 1)
+    print(f"{name:<12} | {total} messages in {elapsed * 1000:9.1f} ms | {total / elapsed:8.1f} messages/s | "
+          f"receiver CPU {cpu / total * 1_000_000:6.1f} µs/message | {disordered(client)} chats out of order")
+
+
+async def single(alchemist) -> None:
+    client = FakeClient(expected=MESSAGES)
+    sender = Sender(bot=client, rate=UNLIMITED, burst=UNLIMITED, chat_rate=UNLIMITED, chat_burst=UNLIMITED)
+    sender_task = asyncio.create_task(sender.run())
+    repository = create_repository(alchemist)
+    policies = create_policies()
+    await repository.run(policies.refresh)
+    handler = MessageHandler(
+        sender=sender,
+        repository=repository,
+        policies=policies,
+        menus=create_menus(),
+        checkpoints=create_checkpoints(),
+        username="thorunimorebot",
+    )
+    # Like the Supervisor, handle every message in its own task, a limited number at a time
+    semaphore = asyncio.Semaphore(int(os.environ.get("HANDLER_CONCURRENCY", "16")))
+
+    async def handle(msg):
+        async with semaphore:
+            await handler.handle(msg)
+
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    tasks = [asyncio.create_task(handle(msg)) for msg in client.updates()]
+    await client.done.wait()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+    await asyncio.gather(*tasks)
+    sender_task.cancel()
+    repository.shutdown()
+    report("in-process", elapsed, cpu, client)
+
+
+async def sharded(alchemist, workers: int) -> None:
+    client = FakeClient(expected=MESSAGES)
+    sender = Sender(bot=client, rate=UNLIMITED, burst=UNLIMITED, chat_rate=UNLIMITED, chat_burst=UNLIMITED)
+    sender_task = asyncio.create_task(sender.run())
+    repository = create_repository(alchemist)
+    pool = ShardPool(sender=sender, repository=repository, workers=workers, username="thorunimorebot")
+    pool_task = asyncio.create_task(pool.run())
+    # Starting the workers takes a while, and isn't part of handling the messages
+    while not pool.ready:
+        await asyncio.sleep(0.1)
+
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    for msg in client.updates():
+        if pool.wants(msg):
+            pool.submit(msg)
+    await client.done.wait()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+
+    pool_task.cancel()
+    for shard in pool.shards:
+        shard.process.terminate()
+        shard.process.join()
+    sender_task.cancel()
+    repository.shutdown()
+    report(f"{workers} workers", elapsed, cpu, client)
+
+
+async def run(workers):
+    # The workers are configured by the environment they inherit, so this has to happen before they are started
+    directory = tempfile.mkdtemp()
+    os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(directory, 'load.sqlite')}"
+    os.environ["DIALOG_CHECKPOINTS"] = os.path.join(directory, "checkpoints.sqlite")
+    alchemist, _ = create_alchemist()
+    seed(alchemist)
+    await single(alchemist)
+    for count in workers:
+        await sharded(alchemist, count)
+
+
+if __name__ == "__main__":
+    asyncio.run(run([int(arg) for arg in sys.argv[1:]] or WORKERS))
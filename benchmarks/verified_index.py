@@ -0,0 +1,90 @@
+"""
+Measure how long loading the verified index takes, how much memory it uses, and how fast it answers compared to
+querying the database for every join.
+
+Run from the root of the repository with::
+
+    python -m benchmarks.verified_index [ACCOUNTS]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from thorunimore.database import Student, Telegram
+from thorunimore.database.base import Base
+from thorunimore.telegram.verified import VerifiedIndex
+
+ACCOUNTS = 100_000
+"""How many registered accounts the database should contain, if not specified on the command line."""
+
+LOOKUPS = 10_000
+"""How many joins should be decided."""
+
+
+def seed(engine: sqlalchemy.engine.Engine, accounts: int, rng: random.Random) -> list:
+    tg_ids = rng.sample(range(10_000_000, 6_000_000_000), accounts)
+    with engine.begin() as connection:
+        connection.execute(Student.__table__.insert(), [
+            {"email_prefix": str(number), "first_name": "MARIO", "last_name": "ROSSI", "search_name": "mario rossi"}
+            for number in range(accounts)
+        ])
+        connection.execute(Telegram.__table__.insert(), [
+            {"id": tg_id, "first_name": "Mario", "st_email_prefix": str(number)}
+            for number, tg_id in enumerate(tg_ids)
+        ])
+    return tg_ids
+
+
+def main() -> None:
+    accounts = int(sys.argv[1]) if len(sys.argv) > 1 else ACCOUNTS
+    rng = random.Random(1)
+    engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'verified.sqlite')}")
+    Base.metadata.create_all(bind=engine)
+    tg_ids = seed(engine, accounts, rng)
+    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+
+    index = VerifiedIndex()
+    tracemalloc.start()
+    start = time.perf_counter()
+    session = Session()
+    index.finish_load(VerifiedIndex.load(session))
+    session.close()
+    load = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(index) == accounts
+
+    tracemalloc.start()
+    as_set = set(tg_ids)
+    set_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Half of the joins are from registered accounts, half from unknown ones
+    joins = [rng.choice(tg_ids) if number % 2 else rng.randrange(1, 10_000_000) for number in range(LOOKUPS)]
+
+    start = time.perf_counter()
+    decided = [tg_id in index for tg_id in joins]
+    indexed = time.perf_counter() - start
+
+    session = Session()
+    start = time.perf_counter()
+    queried = [session.query(Telegram.id).filter_by(id=tg_id).one_or_none() is not None for tg_id in joins]
+    database = time.perf_counter() - start
+    session.close()
+    assert decided == queried
+
+    print(f"load         | {accounts} ids | {load * 1000:8.2f} ms | peak {peak / 2 ** 20:6.2f} MiB")
+    print(f"memory       | index {index.nbytes / 2 ** 20:6.2f} MiB | set of ints {set_size / 2 ** 20:6.2f} MiB")
+    print(f"index lookup | {LOOKUPS} joins | {indexed * 1000:8.2f} ms | {indexed / LOOKUPS * 1e6:8.2f} µs per join")
+    print(f"db query     | {LOOKUPS} joins | {database * 1000:8.2f} ms | {database / LOOKUPS * 1e6:8.2f} µs per join")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
+from .nonces import UsedNonce
+from .policies import GroupPolicy
 from .students import Student
 from .telegram import Telegram
 from .tokens import Token
 
 __all__ = (
+    "GroupPolicy",
     "Student",
     "Telegram",
     "Token",
+    "UsedNonce",
 )
@@ -0,0 +1,30 @@
+import logging
+import os
+
+import coloredlogs
+import sqlalchemy
+
+from .engine import engine_options
+from .migrations import migrate
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    logging.root.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+    stream_handler = logging.StreamHandler()
+    stream_handler.formatter = coloredlogs.ColoredFormatter(
+        "{asctime:>19} | {name:<24} | {levelname:>7} | {message}",
+        style="{",
+    )
+    logging.root.addHandler(stream_handler)
+
+    log.info("Migrating the database...")
+    engine = sqlalchemy.create_engine(os.environ["SQLALCHEMY_DATABASE_URI"], **engine_options())
+    migrate(engine)
+    engine.dispose()
+    log.info("The database is up to date!")
+
+
+if __name__ == "__main__":
+    main()
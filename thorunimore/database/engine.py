@@ -0,0 +1,144 @@
+import contextlib
+import logging
+import os
+import threading
+
+import sqlalchemy
+import sqlalchemy.engine
+import sqlalchemy.orm
+from royalnet.typing import *
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "engine_options",
+    "PoolStats",
+    "StatementCounter",
+    "session_scope",
+)
+
+
+def engine_options(environ: Mapping[str, str] = os.environ) -> Dict[str, Any]:
+    """
+    Build the keyword arguments to pass to :func:`sqlalchemy.create_engine` from the environment.
+
+    Options whose environment variable isn't set are left to the SQLAlchemy defaults, so that pool-less dialects such
+    as SQLite keep working.
+
+    :param environ: The mapping to read the settings from.
+    :return: The keyword arguments.
+    """
+    options: Dict[str, Any] = {}
+    if "DATABASE_POOL_SIZE" in environ:
+        options["pool_size"] = int(environ["DATABASE_POOL_SIZE"])
+    if "DATABASE_MAX_OVERFLOW" in environ:
+        options["max_overflow"] = int(environ["DATABASE_MAX_OVERFLOW"])
+    if "DATABASE_POOL_TIMEOUT" in environ:
+        options["pool_timeout"] = float(environ["DATABASE_POOL_TIMEOUT"])
+    if "DATABASE_POOL_RECYCLE" in environ:
+        options["pool_recycle"] = int(environ["DATABASE_POOL_RECYCLE"])
+    if "DATABASE_POOL_PRE_PING" in environ:
+        options["pool_pre_ping"] = environ["DATABASE_POOL_PRE_PING"].lower() in ("1", "true", "yes")
+    return options
+
+
+class PoolStats:
+    """
+    Counters about the connections of a SQLAlchemy connection pool, kept up to date through pool events.
+    """
+
+    def __init__(self):
+        self.checked_out: int = 0
+        "The number of connections currently checked out of the pool."
+
+        self.peak_checked_out: int = 0
+        "The highest number of connections that were checked out at the same time."
+
+        self.checkouts: int = 0
+        "The total number of times a connection was checked out of the pool."
+
+        self.connections: int = 0
+        "The total number of DBAPI connections the pool has opened."
+
+        self._lock: threading.Lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}({self.checked_out=}, {self.peak_checked_out=}, {self.checkouts=}, " \
+               f"{self.connections=})"
+
+    def attach(self, engine: sqlalchemy.engine.Engine) -> None:
+        """
+        Start counting the connections of the pool of the given engine.
+
+        :param engine: The engine to listen to.
+        """
+        sqlalchemy.event.listen(engine, "connect", self._on_connect)
+        sqlalchemy.event.listen(engine, "checkout", self._on_checkout)
+        sqlalchemy.event.listen(engine, "checkin", self._on_checkin)
+
+    def _on_connect(self, *_) -> None:
+        with self._lock:
+            self.connections += 1
+
+    def _on_checkout(self, *_) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            if self.checked_out > self.peak_checked_out:
+                self.peak_checked_out = self.checked_out
+
+    def _on_checkin(self, *_) -> None:
+        with self._lock:
+            self.checked_out -= 1
+
+
+class StatementCounter:
+    """
+    A context manager counting the SQL statements an engine executes while it is active.
+
+    .. code-block:: python
+
+        with StatementCounter(engine) as counter:
+            ...
+        print(counter.count)
+    """
+
+    def __init__(self, engine: sqlalchemy.engine.Engine):
+        self.engine: sqlalchemy.engine.Engine = engine
+        self.count: int = 0
+        "The number of statements executed so far."
+
+        self.statements: List[str] = []
+        "The statements executed so far."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}({self.count=})"
+
+    def _on_execute(self, _conn, _cursor, statement: str, *_) -> None:
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self) -> "StatementCounter":
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *_) -> None:
+        sqlalchemy.event.remove(self.engine, "before_cursor_execute", self._on_execute)
+
+
+@contextlib.contextmanager
+def session_scope(sessionmaker: Callable[[], sqlalchemy.orm.Session]) -> Iterator[sqlalchemy.orm.Session]:
+    """
+    Create a Session for a single operation, rolling it back if the operation fails and always closing it, so that
+    its connection is returned to the pool as soon as possible.
+
+    :param sessionmaker: The factory to create the Session with.
+    """
+    session = sessionmaker()
+    try:
+        yield session
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
@@ -0,0 +1,31 @@
+import sqlalchemy.orm as o
+
+from .students import Student
+from .telegram import Telegram
+
+__all__ = (
+    "student_whois",
+    "telegram_student",
+    "telegram_whois",
+)
+
+
+def student_whois() -> o.Load:
+    """
+    :return: The loader option fetching everything :meth:`Student.whois` needs in the same query as the Student.
+    """
+    return o.joinedload(Student.tg)
+
+
+def telegram_whois() -> o.Load:
+    """
+    :return: The loader option fetching everything :meth:`Telegram.whois` needs in the same query as the Telegram.
+    """
+    return o.joinedload(Telegram.st).joinedload(Student.tg)
+
+
+def telegram_student() -> o.Load:
+    """
+    :return: The loader option fetching the Student of a Telegram in the same query as the Telegram.
+    """
+    return o.joinedload(Telegram.st)
@@ -0,0 +1,208 @@
+import logging
+
+import sqlalchemy as s
+import sqlalchemy.engine
+import sqlalchemy.exc
+from royalnet.typing import *
+
+from .nonces import UsedNonce
+from .policies import GroupPolicy
+from .students import Student, normalize_name
+from .telegram import Telegram
+from .tokens import Token
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "MIGRATIONS",
+    "SchemaOutdatedError",
+    "migrate",
+    "check",
+    "prepare",
+)
+
+
+class SchemaOutdatedError(Exception):
+    """The database schema is older than the one the code expects, and the database needs to be migrated."""
+
+
+Migration = Callable[[sqlalchemy.engine.Connection], None]
+
+LOCK_ID = 0x74686F72
+"""The id of the PostgreSQL advisory lock preventing multiple processes from migrating at the same time."""
+
+_metadata = s.MetaData()
+
+schema_version = s.Table(
+    "schema_version", _metadata,
+    s.Column("version", s.Integer, primary_key=True),
+    s.Column("description", s.String, nullable=False),
+    s.Column("applied_at", s.DateTime, nullable=False, server_default=s.func.now()),
+)
+"""The table keeping track of which migrations have been applied to the database."""
+
+
+def _initial_schema(conn: sqlalchemy.engine.Connection) -> None:
+    # The schema as it was before migrations were introduced, which databases created back then already have
+    metadata = s.MetaData()
+    s.Table(
+        "students", metadata,
+        s.Column("email_prefix", s.String, nullable=False, primary_key=True),
+        s.Column("first_name", s.String, nullable=False),
+        s.Column("last_name", s.String, nullable=False),
+        s.Column("privacy", s.Boolean, nullable=False, server_default="TRUE"),
+    )
+    s.Table(
+        "telegram", metadata,
+        s.Column("id", s.BigInteger, primary_key=True),
+        s.Column("first_name", s.String, nullable=False),
+        s.Column("last_name", s.String),
+        s.Column("username", s.String),
+        s.Column("st_email_prefix", s.String, s.ForeignKey("students.email_prefix"), nullable=False),
+        s.Column("is_admin", s.Boolean, nullable=False, server_default="FALSE"),
+    )
+    s.Table(
+        "tokens", metadata,
+        s.Column("id", s.Integer, nullable=False, primary_key=True),
+        s.Column("token", s.String, nullable=False),
+        s.Column("owner_id", s.BigInteger, s.ForeignKey("telegram.id"), nullable=False),
+    )
+    metadata.create_all(bind=conn, checkfirst=True)
+
+
+def _create_index(conn: sqlalchemy.engine.Connection, table: s.Table, name: str) -> None:
+    index = next(index for index in table.indexes if index.name == name)
+    index.create(bind=conn)
+
+
+def _student_search_name(conn: sqlalchemy.engine.Connection) -> None:
+    postgresql = conn.dialect.name == "postgresql"
+    if postgresql:
+        conn.execute(s.text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+    conn.execute(s.text("ALTER TABLE students ADD COLUMN search_name VARCHAR"))
+
+    students = s.table("students", s.column("email_prefix"), s.column("first_name"), s.column("last_name"),
+                       s.column("search_name"))
+    rows = conn.execute(s.select(students.c.email_prefix, students.c.first_name, students.c.last_name)).fetchall()
+    if rows:
+        conn.execute(
+            students.update().where(students.c.email_prefix == s.bindparam("prefix")),
+            [{"prefix": row.email_prefix, "search_name": normalize_name(row.first_name, row.last_name)}
+             for row in rows]
+        )
+
+    if postgresql:
+        conn.execute(s.text("ALTER TABLE students ALTER COLUMN search_name SET NOT NULL"))
+    _create_index(conn, Student.__table__, "ix_students_search_name")
+    if postgresql:
+        _create_index(conn, Student.__table__, "ix_students_search_name_trgm")
+
+
+def _lookup_indexes(conn: sqlalchemy.engine.Connection) -> None:
+    _create_index(conn, Telegram.__table__, "ix_telegram_username")
+    _create_index(conn, Telegram.__table__, "ix_telegram_st_email_prefix")
+    _create_index(conn, Token.__table__, "ix_tokens_token")
+
+
+def _token_revocation(conn: sqlalchemy.engine.Connection) -> None:
+    conn.execute(s.text("ALTER TABLE tokens ADD COLUMN revoked BOOLEAN NOT NULL DEFAULT FALSE"))
+
+
+def _token_rate_limit(conn: sqlalchemy.engine.Connection) -> None:
+    conn.execute(s.text("ALTER TABLE tokens ADD COLUMN rate_limit INTEGER"))
+
+
+def _row_versions(conn: sqlalchemy.engine.Connection) -> None:
+    conn.execute(s.text("ALTER TABLE students ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+    conn.execute(s.text("ALTER TABLE telegram ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+
+def _used_nonces(conn: sqlalchemy.engine.Connection) -> None:
+    UsedNonce.__table__.create(bind=conn)
+
+
+def _group_policies(conn: sqlalchemy.engine.Connection) -> None:
+    conn.execute(s.text("ALTER TABLE students ADD COLUMN domain VARCHAR NOT NULL DEFAULT 'studenti.unimore.it'"))
+    GroupPolicy.__table__.create(bind=conn)
+
+
+MIGRATIONS: List[Tuple[int, str, Migration]] = [
+    (1, "Create the initial schema", _initial_schema),
+    (2, "Add a normalized and indexed search name to students", _student_search_name),
+    (3, "Index the columns used for lookups, and make tokens unique", _lookup_indexes),
+    (4, "Allow tokens to be revoked", _token_revocation),
+    (5, "Give each token its own rate limit", _token_rate_limit),
+    (6, "Keep track of the version of students and Telegram accounts", _row_versions),
+    (7, "Remember which deep links have already been used", _used_nonces),
+    (8, "Store the email domain of students, and the moderation policy of each group", _group_policies),
+]
+"""The migrations of the database schema, in the order they should be applied."""
+
+
+def current_version(conn: sqlalchemy.engine.Connection) -> int:
+    """
+    :return: The version of the most recent migration applied to the database, or 0 if none were.
+    """
+    if not s.inspect(conn).has_table(schema_version.name):
+        return 0
+    return conn.execute(s.select(s.func.max(schema_version.c.version))).scalar() or 0
+
+
+def migrate(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Apply to the database all the migrations which haven't been applied yet, each in its own transaction.
+
+    :param engine: The engine connected to the database to migrate.
+    """
+    with engine.connect() as conn:
+        postgresql = conn.dialect.name == "postgresql"
+        if postgresql:
+            conn.execute(s.text("SELECT pg_advisory_lock(:id)"), {"id": LOCK_ID})
+        try:
+            with conn.begin():
+                schema_version.create(bind=conn, checkfirst=True)
+                version = current_version(conn)
+
+            for number, description, migration in MIGRATIONS:
+                if number <= version:
+                    continue
+                log.info(f"Applying migration {number}: {description}")
+                with conn.begin():
+                    migration(conn)
+                    conn.execute(schema_version.insert().values(version=number, description=description))
+        finally:
+            if postgresql:
+                conn.execute(s.text("SELECT pg_advisory_unlock(:id)"), {"id": LOCK_ID})
+
+
+def check(engine: sqlalchemy.engine.Engine) -> None:
+    """
+    Check with a single query that all the migrations have been applied to the database, without changing it.
+
+    :param engine: The engine connected to the database to check.
+    :raises SchemaOutdatedError: If some migrations haven't been applied yet.
+    """
+    with engine.connect() as conn:
+        try:
+            version = conn.execute(s.select(s.func.max(schema_version.c.version))).scalar() or 0
+        except sqlalchemy.exc.DBAPIError:
+            version = 0
+
+    latest, _, _ = MIGRATIONS[-1]
+    if version < latest:
+        raise SchemaOutdatedError(f"The database is at version {version}, but version {latest} is required: "
+                                  f"run thorunimore-migrate to update it.")
+
+
+def prepare(engine: sqlalchemy.engine.Engine, auto_migrate: bool = False) -> None:
+    """
+    Make sure the database is ready to be used, either migrating it or only checking it.
+
+    :param engine: The engine connected to the database.
+    :param auto_migrate: Whether the pending migrations should be applied instead of only being checked for.
+    """
+    if auto_migrate:
+        migrate(engine)
+    else:
+        check(engine)
@@ -0,0 +1,19 @@
+import sqlalchemy as s
+
+from .base import Base
+
+
+class UsedNonce(Base):
+    """
+    A table that contains the nonces of the deep links which have already been used, so that they can't be used again.
+    """
+    __tablename__ = "used_nonces"
+
+    nonce = s.Column(s.String, nullable=False, primary_key=True)
+    """The hexadecimal nonce of the deep link."""
+
+    expires_at = s.Column(s.DateTime, index=True)
+    """When the deep link expires, after which the row isn't needed anymore, or None if the link never expires."""
+
+    def __repr__(self):
+        return f"{self.__qualname__}({self.nonce=}, {self.expires_at=})"
@@ -0,0 +1,33 @@
+import sqlalchemy as s
+
+from .base import Base
+
+
+class GroupPolicy(Base):
+    """
+    A table that contains how the bot should moderate each of the Telegram groups it is an admin of.
+
+    Groups without a row are moderated with the default policy, configured through environment variables.
+    """
+    __tablename__ = "group_policies"
+
+    chat_id = s.Column(s.BigInteger, primary_key=True)
+    """The id of the group, as returned by :func:`telethon.utils.get_peer_id` (starting with -100 for supergroups)."""
+
+    title = s.Column(s.String)
+    """The name of the group, shown next to its invite link."""
+
+    allowed_domains = s.Column(s.String, nullable=False)
+    """The comma-separated email domains of the students allowed in the group."""
+
+    action = s.Column(s.String, nullable=False, default="kick", server_default="kick")
+    """What should be done with the members who aren't allowed: either ``kick`` or ``restrict`` (mute)."""
+
+    announce = s.Column(s.Boolean, nullable=False, default=True, server_default="TRUE")
+    """Whether the bot should send messages to the group about its members."""
+
+    invite_link = s.Column(s.String)
+    """The link to join the group, given to the allowed students after they register, or None to not give it."""
+
+    def __repr__(self):
+        return f"{self.__qualname__}({self.chat_id=}, {self.allowed_domains=}, {self.action=}, {self.announce=})"
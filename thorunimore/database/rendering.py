@@ -0,0 +1,76 @@
+import collections
+import threading
+
+from royalnet.typing import *
+
+__all__ = (
+    "RenderCache",
+    "rendered",
+)
+
+
+class RenderCache:
+    """
+    A size-bounded memo of the messages rendered from database rows, keyed by the identity and the version of the
+    rows they were rendered from, so that a message is rendered again only after one of its rows has changed.
+
+    When full, the least recently used message is evicted to make room for the new one.
+    It is thread-safe, as rows are rendered in the worker threads of the repository.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        """
+        Initialize a RenderCache object.
+
+        :param max_size: The maximum number of messages to keep; 0 disables memoization.
+        """
+        self.max_size: int = max_size
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        "The rendered messages, from the least to the most recently used."
+
+        self.hits: int = 0
+        "The number of messages which didn't need to be rendered."
+
+        self.misses: int = 0
+        "The number of messages which had to be rendered."
+
+        self._lock: threading.Lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(size={len(self.entries)}, {self.hits=}, {self.misses=})"
+
+    def get(self, key: Optional[Hashable], render: Callable[[], str]) -> str:
+        """
+        Get the memoized message with the given key, rendering and memoizing it if needed.
+
+        :param key: The identities and versions of the rows the message is rendered from, or None if any of the rows
+                    has no version yet, in which case the message is always rendered.
+        :param render: The function rendering the message.
+        :return: The message.
+        """
+        if key is None or self.max_size <= 0:
+            return render()
+        with self._lock:
+            message = self.entries.get(key)
+            if message is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return message
+        message = render()
+        with self._lock:
+            self.misses += 1
+            self.entries[key] = message
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return message
+
+    def clear(self) -> None:
+        """
+        Remove all the memoized messages.
+        """
+        with self._lock:
+            self.entries.clear()
+
+
+rendered = RenderCache()
+"""The memo of the messages rendered from Students and Telegram accounts."""
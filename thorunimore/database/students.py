@@ -1,7 +1,24 @@
+import re
+import unicodedata
+
 import sqlalchemy as s
 import sqlalchemy.orm as o
 
 from .base import Base
+from .rendering import rendered
+from .versioning import bump_version
+
+
+def normalize_name(*parts: str) -> str:
+    """
+    Normalize a full name for searching, so that it can be compared ignoring case, accents and the order of the names.
+
+    :param parts: The parts of the name, such as the first name and the last name.
+    :return: The words of the name, lowercase, without accents and sorted, separated by single spaces.
+    """
+    text = unicodedata.normalize("NFKD", " ".join(part for part in parts if part))
+    text = "".join(char for char in text if not unicodedata.combining(char)).casefold()
+    return " ".join(sorted(re.findall(r"\w+", text)))
 
 
 class Student(Base):
@@ -17,6 +34,21 @@ class Student(Base):
     privacy = s.Column(s.Boolean, nullable=False, default=True, server_default="TRUE")
     """Whether or not the student has requested to keep his data hidden from all users."""
 
+    domain = s.Column(s.String, nullable=False, server_default="studenti.unimore.it")
+    """The domain of the email of the student; it defaults to the only one allowed before domains were stored."""
+
+    search_name = s.Column(s.String, nullable=False)
+    """The full name of the student, normalized with :func:`normalize_name`; it is kept up to date automatically."""
+
+    version = s.Column(s.Integer, nullable=False, default=1, server_default="1")
+    """A counter incremented every time the row changes; it is kept up to date automatically."""
+
+    __table_args__ = (
+        s.Index("ix_students_search_name", search_name, postgresql_ops={"search_name": "text_pattern_ops"}),
+        s.Index("ix_students_search_name_trgm", search_name,
+                postgresql_using="gin", postgresql_ops={"search_name": "gin_trgm_ops"}),
+    )
+
     tg = o.relationship("Telegram", back_populates="st")
 
     def email(self):
@@ -25,7 +57,7 @@ class Student(Base):
 
         :return: The email in form of a str.
         """
-        return f"{self.email_prefix}@studenti.unimore.it"
+        return f"{self.email_prefix}@{self.domain}"
 
     def __str__(self) -> str:
         """
@@ -50,9 +82,18 @@ class Student(Base):
         """
         Compose the whois message for this student, ignoring privacy settings.
 
+        The message is memoized until the student or any of their Telegram accounts changes.
+
         :return: The composed message.
         """
-
+        tgs = [(tg.id, tg.version) for tg in self.tg]
+        if self.version is None or any(version is None for _, version in tgs):
+            key = None
+        else:
+            key = ("whois_message", self.email_prefix, self.version, tuple(tgs))
+        return rendered.get(key, self._render_whois_message)
+
+    def _render_whois_message(self) -> str:
         emoji = "👤" if self.privacy else "🎓"
 
         rows = [
@@ -67,3 +108,12 @@ class Student(Base):
             rows.append("")
 
         return "\n".join(rows)
+
+
+@s.event.listens_for(Student, "before_insert")
+@s.event.listens_for(Student, "before_update")
+def _update_search_name(_mapper, _connection, target: Student) -> None:
+    target.search_name = normalize_name(target.first_name, target.last_name)
+
+
+s.event.listen(Student, "before_update", bump_version)
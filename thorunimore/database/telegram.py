@@ -4,6 +4,8 @@ import sqlalchemy.orm as o
 import html
 
 from .base import Base
+from .rendering import rendered
+from .versioning import bump_version
 
 
 class Telegram(Base):
@@ -15,13 +17,16 @@ class Telegram(Base):
     id = s.Column(s.BigInteger, primary_key=True)
     first_name = s.Column(s.String, nullable=False)
     last_name = s.Column(s.String)
-    username = s.Column(s.String)
+    username = s.Column(s.String, index=True)
 
-    st_email_prefix = s.Column(s.String, s.ForeignKey("students.email_prefix"), nullable=False)
+    st_email_prefix = s.Column(s.String, s.ForeignKey("students.email_prefix"), nullable=False, index=True)
     st = o.relationship("Student", back_populates="tg", uselist=False)
 
     is_admin = s.Column(s.Boolean, nullable=False, default=False, server_default="FALSE")
 
+    version = s.Column(s.Integer, nullable=False, default=1, server_default="1")
+    """A counter incremented every time the row changes; it is kept up to date automatically."""
+
     def __repr__(self):
         return f"{self.__qualname__}({self.id=}, {self.first_name=}, {self.last_name=}, {self.username=}, " \
                f"{self.st_email_prefix=})"
@@ -35,13 +40,25 @@ class Telegram(Base):
         else:
             return self.first_name
 
+    def _rendering_key(self, message: str) -> Optional[Hashable]:
+        """
+        :param message: The name of the rendered message.
+        :return: The key of the message in the render memo, or None if the row has no version yet.
+        """
+        if self.version is None:
+            return None
+        return message, self.id, self.version
+
     def name_mention(self) -> str:
         """
         Create a Telegram name mention.
 
         :return: The mention.
         """
-        return f'<a href="tg://user?id={self.id}">{html.escape(str(self))}</a>'
+        return rendered.get(
+            self._rendering_key("name_mention"),
+            lambda: f'<a href="tg://user?id={self.id}">{html.escape(str(self))}</a>',
+        )
 
     def at_mention(self) -> Optional[str]:
         """
@@ -64,5 +81,11 @@ class Telegram(Base):
 
     def minimessage(self) -> str:
         """Compose the whois message subsection for this Telegram account."""
-        return f"📱 {self.name_mention()}\n" \
-               f"{self.at_mention() or ''}\n"
+        return rendered.get(
+            self._rendering_key("minimessage"),
+            lambda: f"📱 {self.name_mention()}\n"
+                    f"{self.at_mention() or ''}\n",
+        )
+
+
+s.event.listen(Telegram, "before_update", bump_version)
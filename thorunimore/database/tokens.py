@@ -11,10 +11,16 @@ class Token(Base):
     __tablename__ = "tokens"
 
     id = s.Column(s.Integer, nullable=False, primary_key=True)
-    token = s.Column(s.String, nullable=False)
+    token = s.Column(s.String, nullable=False, index=True, unique=True)
+
+    revoked = s.Column(s.Boolean, nullable=False, default=False, server_default="FALSE")
+    """Whether the token has been revoked, and should not be accepted anymore."""
+
+    rate_limit = s.Column(s.Integer)
+    """How many API requests the token may make every rate limit window, or None to use the default quota."""
 
     owner_id = s.Column(s.BigInteger, s.ForeignKey("telegram.id"), nullable=False)
     owner = o.relationship("Telegram", backref="tokens")
 
     def __repr__(self):
-        return f"{self.__qualname__}({self.id=}, {self.token=}, {self.owner_id=})"
+        return f"{self.__qualname__}({self.id=}, {self.token=}, {self.owner_id=}, {self.revoked=}, {self.rate_limit=})"
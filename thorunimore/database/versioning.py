@@ -0,0 +1,17 @@
+import sqlalchemy.orm as o
+
+__all__ = (
+    "bump_version",
+)
+
+
+def bump_version(_mapper, _connection, target) -> None:
+    """
+    A ``before_update`` listener incrementing the ``version`` column of a row whenever any of its other columns is
+    changed, so that anything derived from the row, such as the ETags of the API, can tell it is outdated.
+
+    The increment is done by the database, so that concurrent updates can't get the same version.
+    """
+    session = o.object_session(target)
+    if session is not None and session.is_modified(target, include_collections=False):
+        target.version = type(target).version + 1
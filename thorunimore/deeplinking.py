@@ -1,19 +1,153 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import struct
+import time
+
 import itsdangerous
 from royalnet.typing import *
 
 
+class DeepLink(NamedTuple):
+    """A decoded deep link payload."""
+
+    opcode: str
+    """The opcode, telling what the link is for."""
+
+    data: str
+    """The data of the link."""
+
+    nonce: bytes
+    """An identifier of the link, which is the same for all the payloads encoding the same link."""
+
+    expires: Optional[int]
+    """The UNIX time the link expires at, or None if it never does."""
+
+
 class DeepLinking:
-    """A helper class to pass secure information between Telegram and Flask via Telegram Deep Linking."""
+    """
+    A helper class to pass secure information between Telegram and Flask via Telegram Deep Linking.
+
+    Values are pairs of a single-character opcode and a string, packed in a compact binary layout which fits the 64
+    characters Telegram allows in a ``start`` parameter:
+
+    ======= ============================================================
+    Bytes   Content
+    ======= ============================================================
+    1       The version of the layout, :attr:`VERSION`.
+    1       The opcode, as an ASCII character.
+    4       The UNIX time the link expires at, as a big-endian integer.
+    ...     The data, encoded in UTF-8.
+    8       The first bytes of the HMAC-SHA256 of everything above.
+    ======= ============================================================
+
+    The result is encoded in unpadded URL-safe base64.
+
+    Links issued before this layout was introduced are JSON lists signed by itsdangerous, which never expire; they are
+    still accepted.
+    """
+
+    VERSION = 1
+    """The version of the binary layout."""
+
+    TAG_SIZE = 8
+    """The number of bytes of the HMAC kept in the payload."""
 
-    def __init__(self, secret_key: str, namespace: str = "t"):
+    MAX_LENGTH = 64
+    """The maximum length of a Telegram ``start`` parameter."""
+
+    _header = struct.Struct(">BcI")
+
+    def __init__(self, secret_key: str, namespace: str = "t", max_age: int = 3600,
+                 clock: Callable[[], float] = time.time):
+        """
+        Initialize a DeepLinking object.
+
+        :param secret_key: The key used to sign the payloads; it must be the same for the encoder and the decoder.
+        :param namespace: A string which makes the payloads signed for a purpose invalid for the others.
+        :param max_age: For how many seconds the payloads created by :meth:`encode` are valid.
+        :param clock: The function used to get the current time.
+        """
         self.serializer = itsdangerous.URLSafeSerializer(secret_key=secret_key, salt=namespace)
+        self.key: bytes = hmac.new(secret_key.encode("utf8"), f"deeplinking:{namespace}".encode("utf8"),
+                                   hashlib.sha256).digest()
+        self.max_age: int = max_age
+        self.clock: Callable[[], float] = clock
+
+    def _tag(self, message: bytes) -> bytes:
+        return hmac.new(self.key, message, hashlib.sha256).digest()[:self.TAG_SIZE]
+
+    def encode(self, value: Tuple[str, str]) -> str:
+        """
+        Sign a value and encode it as a deep link payload.
+
+        :param value: The opcode and the data to encode.
+        :return: The payload, which should be at most :attr:`MAX_LENGTH` characters long.
+        :raises ValueError: If the opcode isn't a single ASCII character.
+        """
+        opcode, data = value
+        if len(opcode) != 1:
+            raise ValueError("The opcode should be a single character")
+        message = self._header.pack(self.VERSION, opcode.encode("ascii"), int(self.clock()) + self.max_age) \
+            + data.encode("utf8")
+        return base64.urlsafe_b64encode(message + self._tag(message)).rstrip(b"=").decode("ascii")
+
+    def decode(self, signed: str) -> Tuple[str, str]:
+        """
+        Verify a deep link payload and decode the value it contains.
+
+        :param signed: The payload.
+        :return: The opcode and the data.
+        :raises itsdangerous.exc.SignatureExpired: If the payload has expired.
+        :raises itsdangerous.exc.BadData: If the payload is invalid, or its signature doesn't match.
+        """
+        link = self.decode_link(signed)
+        return link.opcode, link.data
+
+    def decode_link(self, signed: str) -> DeepLink:
+        """
+        Verify a deep link payload and decode it, including the nonce identifying it.
+
+        The nonce of a binary payload is its tag, which differs for every link issued at a different second; legacy
+        payloads are identical for the same value, so their nonce is derived from the value itself.
+
+        :param signed: The payload.
+        :return: The decoded link.
+        :raises itsdangerous.exc.SignatureExpired: If the payload has expired.
+        :raises itsdangerous.exc.BadData: If the payload is invalid, or its signature doesn't match.
+        """
+        # The version byte makes binary payloads start with A, while legacy ones start with the base64 of ["
+        if not signed.startswith("A"):
+            return self._decode_legacy(signed)
+
+        try:
+            raw = base64.b64decode(signed + "=" * (-len(signed) % 4), altchars=b"-_", validate=True)
+        except (binascii.Error, ValueError):
+            raise itsdangerous.exc.BadPayload("Deep link payload is not valid base64")
+        if len(raw) < self._header.size + self.TAG_SIZE:
+            raise itsdangerous.exc.BadPayload("Deep link payload is too short")
+
+        message, tag = raw[:-self.TAG_SIZE], raw[-self.TAG_SIZE:]
+        if not hmac.compare_digest(tag, self._tag(message)):
+            raise itsdangerous.exc.BadSignature("Deep link signature does not match")
 
-    def encode(self, value: Any) -> str:
-        signed = self.serializer.dumps(value)
-        signed = signed.replace("_", "_u").replace(".", "_d")
-        return signed
+        version, opcode, expires = self._header.unpack_from(message)
+        if version != self.VERSION:
+            raise itsdangerous.exc.BadPayload(f"Unknown deep link payload version: {version}")
+        if expires < self.clock():
+            raise itsdangerous.exc.SignatureExpired("Deep link has expired")
+        try:
+            return DeepLink(opcode.decode("ascii"), message[self._header.size:].decode("utf8"), tag, expires)
+        except UnicodeDecodeError:
+            raise itsdangerous.exc.BadPayload("Deep link payload is not valid text")
 
-    def decode(self, signed: str) -> Any:
+    def _decode_legacy(self, signed: str) -> DeepLink:
         signed = signed.replace("_d", ".").replace("_u", "_")
         value = self.serializer.loads(signed)
-        return value
+        try:
+            opcode, data = value
+        except (TypeError, ValueError):
+            raise itsdangerous.exc.BadPayload("Legacy deep link payload is not a pair")
+        nonce = hashlib.sha256(f"{opcode}:{data}".encode("utf8")).digest()[:self.TAG_SIZE]
+        return DeepLink(opcode, data, nonce, None)
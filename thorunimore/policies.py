@@ -0,0 +1,151 @@
+import logging
+import os
+import time
+
+import sqlalchemy.orm
+from royalnet.typing import *
+
+from .database import GroupPolicy
+from .registry import PeriodicRegistry
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "KICK",
+    "RESTRICT",
+    "Policy",
+    "PolicyRegistry",
+    "default_policy",
+)
+
+KICK = "kick"
+"""The action removing the members who aren't allowed from the group."""
+
+RESTRICT = "restrict"
+"""The action preventing the members who aren't allowed from sending messages to the group."""
+
+
+class Policy(NamedTuple):
+    """How a group should be moderated, as known by a :class:`PolicyRegistry`."""
+
+    chat_id: Optional[int]
+    """The id of the group, or None for the default policy."""
+
+    title: Optional[str]
+    """The name of the group."""
+
+    allowed_domains: FrozenSet[str]
+    """The email domains of the students allowed in the group."""
+
+    action: str
+    """What should be done with the members who aren't allowed, either :data:`KICK` or :data:`RESTRICT`."""
+
+    announce: bool
+    """Whether the bot should send messages to the group about its members."""
+
+    invite_link: Optional[str]
+    """The link to join the group, or None if it shouldn't be given."""
+
+    @staticmethod
+    def parse_domains(domains: str) -> FrozenSet[str]:
+        """
+        Parse a comma-separated list of email domains.
+
+        :param domains: The list of domains.
+        :return: The set of the domains, lowercase and without whitespace.
+        """
+        return frozenset(domain.strip().lower() for domain in domains.split(",") if domain.strip())
+
+    @classmethod
+    def from_row(cls, row: GroupPolicy) -> "Policy":
+        """
+        Create a Policy from a row of the ``group_policies`` table.
+
+        :param row: The row.
+        :return: The created Policy.
+        """
+        if row.action not in (KICK, RESTRICT):
+            log.warning(f"Unknown action {row.action!r} for {row.chat_id}, kicking instead")
+        return cls(
+            chat_id=row.chat_id,
+            title=row.title,
+            allowed_domains=cls.parse_domains(row.allowed_domains),
+            action=RESTRICT if row.action == RESTRICT else KICK,
+            announce=row.announce,
+            invite_link=row.invite_link,
+        )
+
+
+def default_policy(environ: Mapping[str, str] = os.environ) -> Policy:
+    """
+    Build the policy of the groups without a row in the ``group_policies`` table from the environment.
+
+    :param environ: The mapping to read the settings from.
+    :return: The default policy.
+    """
+    return Policy(
+        chat_id=None,
+        title=None,
+        allowed_domains=Policy.parse_domains(environ.get("ALLOWED_DOMAINS", "studenti.unimore.it")),
+        action=KICK,
+        announce=True,
+        invite_link=environ.get("GROUP_URL"),
+    )
+
+
+class PolicyRegistry(PeriodicRegistry):
+    """
+    An in-memory registry of the moderation policies of the groups, so that handling a join never requires a database
+    query.
+
+    The registry has to be reloaded periodically, so that policies can be added and changed without restarting the
+    process; groups without a policy use the default one.
+    """
+
+    def __init__(self, default: Policy, refresh_interval: float = 60, clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize a PolicyRegistry object; only the default policy will be known until it is refreshed for the first
+        time.
+
+        :param default: The policy of the groups without a row in the ``group_policies`` table.
+        :param refresh_interval: The number of seconds after which the registry should be reloaded.
+        :param clock: The function used to get the current time.
+        """
+        super().__init__(refresh_interval=refresh_interval, clock=clock)
+        self.default: Policy = default
+
+        self.policies: Dict[int, Policy] = {}
+        "The policies of the groups, as a mapping of their chat id to their policy."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(size={len(self.policies)}, {self.refreshed=}, {self.failures=})"
+
+    def _reload(self, session: sqlalchemy.orm.Session) -> None:
+        self.policies = {row.chat_id: Policy.from_row(row) for row in session.query(GroupPolicy).all()}
+
+    def get(self, chat_id: int) -> Policy:
+        """
+        Get the policy of a group.
+
+        :param chat_id: The id of the group, as returned by :func:`telethon.utils.get_peer_id`.
+        :return: The policy of the group, or the default one if it has none.
+        """
+        return self.policies.get(chat_id, self.default)
+
+    def domains(self) -> FrozenSet[str]:
+        """
+        :return: The email domains allowed in at least one group.
+        """
+        return self.default.allowed_domains.union(*(policy.allowed_domains for policy in self.policies.values()))
+
+    def invites(self, domain: str) -> List[Policy]:
+        """
+        Find the groups a student may join.
+
+        :param domain: The email domain of the student.
+        :return: The policies of the groups with an invite link allowing the domain, the default one included.
+        """
+        return [
+            policy for policy in (self.default, *self.policies.values())
+            if policy.invite_link and domain in policy.allowed_domains
+        ]
@@ -0,0 +1,119 @@
+import contextlib
+import logging
+import threading
+import time
+
+from royalnet.typing import *
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "PeriodicRegistry",
+)
+
+
+class PeriodicRegistry:
+    """
+    The base of the in-memory registries which are reloaded from the database periodically, so that changes are picked
+    up without restarting the process.
+
+    Subclasses implement :meth:`_reload`, which must replace their whole contents at once: replacing an attribute is
+    atomic, so lookups running meanwhile see either the old or the new contents, and never have to wait for a reload.
+    A reload which fails keeps the current contents until the next one, so that an outage of the database doesn't
+    turn every lookup into a failing query.
+    """
+
+    def __init__(self, refresh_interval: float = 60, clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize a PeriodicRegistry object.
+
+        :param refresh_interval: The number of seconds after which the registry should be reloaded.
+        :param clock: The function used to get the current time.
+        """
+        self.refresh_interval: float = refresh_interval
+        self.clock: Callable[[], float] = clock
+
+        self.refreshed: Optional[float] = None
+        "The time the registry was last reloaded, or tried to be, or None if it never was."
+
+        self.failures: int = 0
+        "The number of reloads which failed."
+
+        self._lock: threading.Lock = threading.Lock()
+        self._stopped: threading.Event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _reload(self, *args) -> None:
+        raise NotImplementedError()
+
+    def refresh(self, *args) -> None:
+        """
+        Reload the registry.
+
+        :param args: The arguments the subclass needs to query the database with.
+        """
+        self._reload(*args)
+        self.refreshed = self.clock()
+        log.debug(f"Refreshed {self}")
+
+    def refresh_if_stale(self, *args) -> None:
+        """
+        Reload the registry if it hasn't been reloaded for :attr:`refresh_interval` seconds; if the reload fails, the
+        error is logged, and the current contents are kept until the next attempt.
+
+        :param args: The arguments the subclass needs to query the database with.
+        """
+        if self.refreshed is not None and self.clock() - self.refreshed < self.refresh_interval:
+            return
+        # Only one thread reloads, the others keep using the current contents
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self.refresh(*args)
+        except Exception:
+            self.failures += 1
+            self.refreshed = self.clock()
+            log.error(f"Could not refresh {self}, keeping the current contents", exc_info=True)
+        finally:
+            self._lock.release()
+
+    def start(self, *args, context: Callable[[], ContextManager] = contextlib.nullcontext) -> None:
+        """
+        Start reloading the registry in a background thread, whenever it becomes stale.
+
+        The thread doesn't survive a fork, so processes forked after starting it have to start it again.
+
+        :param args: The arguments the subclass needs to query the database with.
+        :param context: A function returning the context every reload should happen in, such as the application
+                        context of Flask.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(args, context),
+            name=f"{self.__class__.__name__}-refresh",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background thread started by :meth:`start`.
+        """
+        self._stopped.set()
+
+    def _run(self, args: tuple, context: Callable[[], ContextManager]) -> None:
+        while True:
+            delay = self.refresh_interval
+            if self.refreshed is not None:
+                delay = self.refreshed + self.refresh_interval - self.clock()
+            if self._stopped.wait(max(1.0, delay)):
+                return
+            # noinspection PyBroadException
+            try:
+                with context():
+                    self.refresh_if_stale(*args)
+            except Exception:
+                log.error(f"Unexpected error while refreshing {self}", exc_info=True)
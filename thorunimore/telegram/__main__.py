@@ -2,40 +2,58 @@ import asyncio
 import logging
 import os
 
-import coloredlogs
-import royalnet.alchemist
-import royalnet.campaigns
 import telethon
-import telethon.tl.custom
-import sys
-import traceback
+import telethon.utils
 from royalnet.typing import *
 
-from .dialog import Dialog
-from ..database import Telegram
-from ..database.base import Base
-
-log = logging.getLogger(__name__)
-
-log.info("Creating Alchemist...")
-alchemist: royalnet.alchemist.Alchemist = royalnet.alchemist.Alchemist(
-    engine_args=[os.environ["SQLALCHEMY_DATABASE_URI"]],
-    engine_kwargs={}
+from .audit import AuditProgress, MembershipAudit
+from .components import (
+    create_alchemist,
+    create_checkpoints,
+    create_menus,
+    create_policies,
+    create_repository,
+    run_policy_reloader,
+    setup_logging,
 )
-log.debug("Mapping database tables...")
-alchemist.add_metadata(Base.metadata)
+from .handler import MessageHandler
+from .joins import JoinPipeline
+from .sender import Priority, Sender
+from .sharding import ShardPool
+from .supervisor import Supervisor
+from ..database.migrations import prepare
+from ..ttlcache import TTLCache
 
-log.debug("Creating telethon TelegramClient...")
-client = telethon.client.TelegramClient("bot", int(os.environ["TELEGRAM_API_ID"]), os.environ["TELEGRAM_API_HASH"])
+log = logging.getLogger(__name__)
 
 
 async def run():
-    logging.root.setLevel(os.environ["LOG_LEVEL"])
-    stream_handler = logging.StreamHandler()
-    stream_handler.formatter = coloredlogs.ColoredFormatter("{asctime:>19} | {name:<24} | {levelname:>7} | {message}", style="{")
-    logging.root.addHandler(stream_handler)
+    setup_logging()
     log.debug("Logging setup successfully!")
 
+    log.info("Creating Alchemist...")
+    alchemist, pool_stats = create_alchemist()
+    log.debug("Checking the database schema...")
+    prepare(
+        alchemist.engine,
+        auto_migrate=os.environ.get("DATABASE_AUTO_MIGRATE", "false").lower() in ("1", "true", "yes"),
+    )
+
+    log.debug("Creating Repository...")
+    repository = create_repository(alchemist)
+
+    log.debug("Creating PolicyRegistry...")
+    policies = create_policies()
+
+    # The loops which must run as long as the bot does; if any of them stops, the bot stops too
+    tasks: List[asyncio.Task] = []
+
+    def start(coro: Awaitable[NoReturn], name: str) -> None:
+        tasks.append(asyncio.create_task(coro, name=name))
+
+    log.debug("Creating telethon TelegramClient...")
+    client = telethon.client.TelegramClient("bot", int(os.environ["TELEGRAM_API_ID"]), os.environ["TELEGRAM_API_HASH"])
+
     log.debug("Starting telethon TelegramClient...")
     # noinspection PyProtectedMember
     bot = await client._start(
@@ -51,9 +69,97 @@ async def run():
     me = await bot.get_me()
     log.debug(f"Logged in as: {me.first_name} <{me.id}>")
 
-    menus: Dict[int, Dialog] = {}
-
-    @bot.on(telethon.events.ChatAction())
+    log.debug("Loading verified ids...")
+    try:
+        await repository.load_verified()
+    except Exception:
+        log.error("Could not load the verified ids, querying the database until they are", exc_info=True)
+    start(repository.run_verified_loader(), "verified-loader")
+
+    log.debug("Loading group policies...")
+    await repository.run(policies.refresh)
+    start(run_policy_reloader(repository, policies), "policy-reloader")
+
+    sender = Sender(
+        bot=bot,
+        rate=float(os.environ.get("SEND_RATE", "30")),
+        burst=float(os.environ.get("SEND_BURST", "30")),
+        chat_rate=float(os.environ.get("SEND_CHAT_RATE", "1")),
+        chat_burst=float(os.environ.get("SEND_CHAT_BURST", "3")),
+    )
+    start(sender.run(), "sender")
+
+    if workers := int(os.environ.get("WORKER_PROCESSES", "0")):
+        # The Dialogs run in the worker processes, this one only receives and sends
+        pool = ShardPool(
+            sender=sender,
+            repository=repository,
+            workers=workers,
+            username=me.username,
+        )
+        start(pool.run(), "shard-pool")
+        menus = None
+        checkpoints = None
+        handler = None
+    else:
+        pool = None
+        menus = create_menus()
+        start(menus.run_sweeper(), "dialog-sweeper")
+        checkpoints = create_checkpoints()
+        handler = MessageHandler(
+            sender=sender,
+            repository=repository,
+            policies=policies,
+            menus=menus,
+            checkpoints=checkpoints,
+            username=me.username,
+        )
+
+    joins = JoinPipeline(
+        sender=sender,
+        repository=repository,
+        policies=policies,
+        kick_interval=float(os.environ.get("KICK_INTERVAL", "0.5")),
+        burst_window=float(os.environ.get("KICK_BURST_WINDOW", "3")),
+    )
+    start(joins.run_worker(), "join-worker")
+    repository.on_register = joins.enqueue_lift
+
+    if audit_chats := [chat.strip() for chat in os.environ.get("AUDIT_CHATS", "").split(",") if chat.strip()]:
+        audit = MembershipAudit(
+            bot=bot,
+            repository=repository,
+            joins=joins,
+            progress=AuditProgress(path=os.environ.get("AUDIT_PROGRESS", "audit.sqlite")),
+            chats=[int(chat) if chat.lstrip("-").isdigit() else chat for chat in audit_chats],
+            interval=float(os.environ.get("AUDIT_INTERVAL", "86400")),
+            dry_run=os.environ.get("AUDIT_DRY_RUN", "false").lower() in ("1", "true", "yes"),
+        )
+        start(audit.run(), "membership-audit")
+    else:
+        audit = None
+
+    supervisor = Supervisor(
+        bot=bot,
+        min_delay=float(os.environ.get("RECONNECT_MIN_DELAY", "1")),
+        max_delay=float(os.environ.get("RECONNECT_MAX_DELAY", "300")),
+        catch_up_timeout=float(os.environ.get("CATCH_UP_TIMEOUT", "120")),
+        concurrency=int(os.environ.get("HANDLER_CONCURRENCY", "16")),
+        seen=TTLCache(
+            max_size=int(os.environ.get("SEEN_UPDATES_SIZE", "10000")),
+            ttl=float(os.environ.get("SEEN_UPDATES_TTL", "3600")),
+        ),
+    )
+
+    async def report_stats():
+        while True:
+            await asyncio.sleep(60)
+            log.debug(f"Statistics: {menus}, {checkpoints}, {pool}, {joins}, {audit}, {sender}, {supervisor}, "
+                      f"{pool_stats}, {repository.whois_cache}, {repository.verified}, {policies}")
+
+    start(report_stats(), "stats-reporter")
+
+    @supervisor.on(telethon.events.ChatAction())
     async def on_chat_action(event: telethon.events.ChatAction.Event):
         if event.user_joined:
             users = await event.get_users()
@@ -61,74 +167,40 @@ async def run():
 
             if len(users) == 0:
                 log.warning(f"Telegram sent join information improperly! {chat=}, {users=}")
-                await bot.send_message(
-                    entity=chat,
-                    parse_mode="HTML",
-                    message="❓ Un nuovo account si è unito alla chat, ma Telegram inaspettatamente non ha fornito "
-                            "alcuna informazione su di esso, e pertanto non è stato possibile verificarlo."
-                )
+                if policies.get(telethon.utils.get_peer_id(chat)).announce:
+                    await sender.send_message(
+                        entity=chat,
+                        priority=Priority.NOTICE,
+                        parse_mode="HTML",
+                        message="❓ Un nuovo account si è unito alla chat, ma Telegram inaspettatamente non ha "
+                                "fornito alcuna informazione su di esso, e pertanto non è stato possibile verificarlo."
+                    )
                 return
 
-            user = users[0]
-            session = alchemist.Session()
-            tg = session.query(Telegram).filter_by(id=user.id).one_or_none()
-            if tg is None:
-                await bot.kick_participant(entity=chat, user=user)
-                await bot.send_message(
-                    entity=chat,
-                    parse_mode="HTML",
-                    message="🚫 L'account è stato rimosso dal gruppo perchè non autenticato."
-                )
-            else:
-                await bot.send_message(
-                    entity=chat,
-                    parse_mode="HTML",
-                    message=tg.st.whois()
-                )
-
-    @bot.on(telethon.events.NewMessage())
-    async def on_message(event: telethon.events.NewMessage.Event):
-        msg: telethon.tl.custom.Message = event.message
-        log.debug(f"Received message: {msg}")
-
-        # Restart dialog
-        if msg.chat_id in menus and msg.message.startswith("/start"):
-            log.debug(f"Stopping existing Dialog for {msg.chat_id}")
-            await menus[msg.chat_id].stop()
-            del menus[msg.chat_id]
-
-        # Create new dialog
-        if msg.chat_id not in menus:
-            log.debug(f"Creating new Dialog for {msg.chat_id}")
-            menus[msg.chat_id] = await Dialog.create(bot=bot, entity=msg.chat, session=alchemist.Session())
-
-        # Shortcut for the dialog
-        menu = menus[msg.chat_id]
-
-        log.debug(f"Advancing Dialog for {msg.chat_id}")
-        # noinspection PyBroadException
-        try:
-            await menu.next(msg)
-        except StopAsyncIteration:
-            del menus[msg.chat_id]
-        except Exception:
-            log.error("".join(traceback.format_exception(*sys.exc_info())))
-            await bot.send_message(
-                entity=msg.chat,
-                message="☢️ Si è verificato un errore critico e la conversazione è stata annullata.\n"
-                        "\n"
-                        "L'errore è stato salvato nei log del server.")
-
-    while True:
-        # log.info(f"Catching up...")
-        # await bot.catch_up()
-
-        log.info(f"Running!")
-        # noinspection PyProtectedMember
-        await bot._run_until_disconnected()
-
-        log.error("Disconnected... Retrying in a minute.")
-        await asyncio.sleep(60)
+            await joins.handle(chat, users)
+
+    if pool is not None:
+        # Submitting has to happen before anything is awaited, so that the messages of a chat keep their order
+        @supervisor.on(telethon.events.NewMessage(), limited=False)
+        async def on_message(event: telethon.events.NewMessage.Event):
+            if pool.wants(event.message):
+                pool.submit(event.message)
+    else:
+        @supervisor.on(telethon.events.NewMessage())
+        async def on_message(event: telethon.events.NewMessage.Event):
+            await handler.handle(event.message)
+
+    start(supervisor.run(), "supervisor")
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        error = None if task.cancelled() else task.exception()
+        log.critical(f"The {task.get_name()} task stopped unexpectedly, stopping the bot", exc_info=error)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    await bot.disconnect()
+    # Exit with an error, so that the service manager restarts the bot
+    raise SystemExit(1)
 
 
 def main():
@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import sqlite3
+import time
+
+import telethon
+import telethon.tl.types
+import telethon.utils
+from royalnet.typing import *
+from telethon.hints import *
+
+from .joins import JoinPipeline
+from .repository import Repository
+from ..policies import RESTRICT
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "AuditProgress",
+    "MembershipAudit",
+)
+
+
+class AuditProgress:
+    """
+    The progress of the membership audits, kept in a local SQLite file so that an interrupted audit resumes where it
+    stopped instead of starting over.
+
+    The progress is the set of members already checked rather than a position in the list of members, as the list
+    shifts whenever someone joins, leaves or is kicked.
+    """
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.time):
+        """
+        Initialize an AuditProgress object, creating the file if it doesn't exist.
+
+        :param path: The path of the SQLite file.
+        :param clock: The function used to get the current time; it must keep counting across restarts.
+        """
+        self.path: str = path
+        self.clock: Callable[[], float] = clock
+
+        self.connection: sqlite3.Connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS audits ("
+                                "chat_id INTEGER PRIMARY KEY, audited INTEGER NOT NULL, completed_at REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS audited_members ("
+                                "chat_id INTEGER NOT NULL, tg_id INTEGER NOT NULL, PRIMARY KEY (chat_id, tg_id)) "
+                                "WITHOUT ROWID")
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}({self.path=})"
+
+    def get(self, chat_id: int) -> Tuple[int, Optional[float]]:
+        """
+        Get the progress of the audit of a chat.
+
+        :param chat_id: The id of the chat.
+        :return: The number of members audited by the audit in progress, and the UNIX time the last audit was
+                 completed at, or None if no audit was ever completed.
+        """
+        row = self.connection.execute("SELECT audited, completed_at FROM audits WHERE chat_id = ?",
+                                      (chat_id,)).fetchone()
+        if row is None:
+            return 0, None
+        return row
+
+    def checked(self, chat_id: int) -> Set[int]:
+        """
+        Get the members of a chat already checked by the audit in progress.
+
+        :param chat_id: The id of the chat.
+        :return: The Telegram ids of the checked members.
+        """
+        return {tg_id for tg_id, in self.connection.execute("SELECT tg_id FROM audited_members WHERE chat_id = ?",
+                                                            (chat_id,))}
+
+    def advance(self, chat_id: int, tg_ids: Collection[int]) -> None:
+        """
+        Record that some members of a chat have been checked by the audit in progress.
+
+        :param chat_id: The id of the chat.
+        :param tg_ids: The Telegram ids of the checked members.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.executemany("INSERT OR IGNORE INTO audited_members (chat_id, tg_id) VALUES (?, ?)",
+                                        [(chat_id, tg_id) for tg_id in tg_ids])
+            self.connection.execute("INSERT INTO audits (chat_id, audited) "
+                                    "VALUES (?, (SELECT COUNT(*) FROM audited_members WHERE chat_id = ?)) "
+                                    "ON CONFLICT (chat_id) DO UPDATE SET audited = excluded.audited",
+                                    (chat_id, chat_id))
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def complete(self, chat_id: int) -> None:
+        """
+        Record that the audit of a chat has been completed now.
+
+        :param chat_id: The id of the chat.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute("DELETE FROM audited_members WHERE chat_id = ?", (chat_id,))
+            self.connection.execute("INSERT OR REPLACE INTO audits (chat_id, audited, completed_at) VALUES (?, 0, ?)",
+                                    (chat_id, self.clock()))
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+
+class MembershipAudit:
+    """
+    Periodically check all the members of the monitored groups, removing the ones which aren't verified.
+
+    This catches the accounts which joined before the bot was an admin of a group, or while it couldn't see the
+    joins. All the members are listed before anyone is kicked, as kicking shifts the pages still to be listed; they are
+    then checked a page at a time with a single query per page, and unverified members are kicked through the
+    :class:`JoinPipeline`, with the audit waiting for the kicks of a page before moving on to the next one.
+    """
+
+    def __init__(self,
+                 bot: telethon.TelegramClient,
+                 repository: Repository,
+                 joins: JoinPipeline,
+                 progress: AuditProgress,
+                 chats: List[EntityLike],
+                 interval: float = 86400,
+                 page_size: int = 200,
+                 dry_run: bool = False):
+        """
+        Initialize a MembershipAudit object.
+
+        :param bot: The client of the bot, which must be an admin of the chats.
+        :param repository: The Repository to look up the members in.
+        :param joins: The JoinPipeline performing the kicks.
+        :param progress: The store of the progress of the audits.
+        :param chats: The chats to audit.
+        :param interval: The number of seconds between two audits of the same chat.
+        :param page_size: The number of members to check with a single query, and to record as checked at once.
+        :param dry_run: Whether unverified members should only be logged instead of being kicked.
+        """
+        self.bot: telethon.TelegramClient = bot
+        self.repository: Repository = repository
+        self.joins: JoinPipeline = joins
+        self.progress: AuditProgress = progress
+        self.chats: List[EntityLike] = chats
+        self.interval: float = interval
+        self.page_size: int = page_size
+        self.dry_run: bool = dry_run
+
+        self.audited: int = 0
+        "The number of members audited."
+
+        self.unverified: int = 0
+        "The number of unverified members found."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}({self.audited=}, {self.unverified=}, {self.dry_run=})"
+
+    @staticmethod
+    def _is_exempt(user: telethon.tl.types.User) -> bool:
+        # Admins can't be kicked, and the bot must not kick itself
+        return user.is_self or isinstance(getattr(user, "participant", None), (
+            telethon.tl.types.ChannelParticipantAdmin,
+            telethon.tl.types.ChannelParticipantCreator,
+            telethon.tl.types.ChatParticipantAdmin,
+            telethon.tl.types.ChatParticipantCreator,
+        ))
+
+    @staticmethod
+    def _is_muted(user: telethon.tl.types.User) -> bool:
+        # Members restricted by the bot, or by an admin, in a way that already prevents them from sending messages
+        participant = getattr(user, "participant", None)
+        return (isinstance(participant, telethon.tl.types.ChannelParticipantBanned)
+                and not participant.left and participant.banned_rights.send_messages)
+
+    async def audit(self, chat: Entity) -> None:
+        """
+        Audit all the members of a chat, resuming the interrupted audit of the chat if there is one.
+
+        :param chat: The chat to audit.
+        """
+        chat_id = telethon.utils.get_peer_id(chat)
+        checked = self.progress.checked(chat_id)
+        if checked:
+            log.info(f"Resuming audit of {chat_id} after {len(checked)} members")
+        else:
+            log.info(f"Starting audit of {chat_id}")
+
+        # Telegram lists at most 10000 members, bigger groups have to be listed with searches
+        total = (await self.bot.get_participants(chat, limit=0)).total
+        aggressive = total > 10000
+
+        # Searches return the same member more than once, and in no stable order
+        members: Dict[int, telethon.tl.types.User] = {}
+        async for user in self.bot.iter_participants(chat, aggressive=aggressive):
+            if user.id not in checked and not self._is_exempt(user):
+                members[user.id] = user
+        log.debug(f"Listed {len(members)} members of {chat_id} to audit")
+
+        users = list(members.values())
+        for start in range(0, len(users), self.page_size):
+            page = users[start:start + self.page_size]
+            await self._check(chat, chat_id, page)
+            self.progress.advance(chat_id, [user.id for user in page])
+
+        self.progress.complete(chat_id)
+        log.info(f"Completed audit of {chat_id}: {len(checked) + len(users)} members checked")
+
+    async def _check(self, chat: Entity, chat_id: int, users: List[telethon.tl.types.User]) -> None:
+        policy = self.joins.policies.get(chat_id)
+        registered = await self.repository.registered_tg_ids(
+            [user.id for user in users],
+            domains=policy.allowed_domains,
+        )
+        self.audited += len(users)
+        for user in users:
+            if user.id in registered:
+                continue
+            if policy.action == RESTRICT and self._is_muted(user):
+                # Restricting them again would only announce them again
+                continue
+            self.unverified += 1
+            if self.dry_run:
+                log.info(f"Audit found unverified member of {chat_id}: "
+                         f"{user.id} ({telethon.utils.get_display_name(user)})")
+            else:
+                self.joins.enqueue_kick(chat, user)
+
+        # Wait for the kicks, so that the progress recorded afterwards never skips unkicked members
+        while self.joins.pending.get(chat_id):
+            await asyncio.sleep(self.joins.kick_interval)
+
+    async def run(self) -> NoReturn:
+        """
+        Audit the chats forever, whenever their last audit is older than :attr:`interval`, or was interrupted.
+        """
+        while True:
+            for chat_like in self.chats:
+                # noinspection PyBroadException
+                try:
+                    chat = await self.bot.get_entity(chat_like)
+                    audited, completed_at = self.progress.get(telethon.utils.get_peer_id(chat))
+                    if audited or completed_at is None or completed_at + self.interval <= self.progress.clock():
+                        await self.audit(chat)
+                except Exception:
+                    log.error(f"Unexpected error while auditing {chat_like}", exc_info=True)
+            await asyncio.sleep(60)
@@ -8,6 +8,8 @@ import telethon.tl.custom as tc
 from royalnet.typing import *
 from telethon.hints import *
 
+from .sender import Sender
+
 __all__ = (
     "Question",
     "Keyboard",
@@ -16,12 +18,12 @@ __all__ = (
 
 class ThorChallenge(rc.AsyncChallenge, metaclass=abc.ABCMeta):
     """
-    Like a Royalnet challenge, but also define an action to be taken by the TelegramClient if this becomes the new
-    challenge.
+    Like a Royalnet challenge, but also define an action to be taken by the Sender of the TelegramClient if this becomes
+    the new challenge.
     """
 
     @abc.abstractmethod
-    async def send(self, bot: telethon.TelegramClient, entity: Entity) -> ThorChallenge:
+    async def send(self, sender: Sender, entity: Entity) -> ThorChallenge:
         raise NotImplementedError()
 
 
@@ -34,8 +36,8 @@ class Question(ThorChallenge):
         self.message_args = message_args
         self.message_kwargs = message_kwargs
 
-    async def send(self, bot: telethon.TelegramClient, entity: Entity) -> Question:
-        await bot.send_message(
+    async def send(self, sender: Sender, entity: Entity) -> Question:
+        await sender.send_message(
             entity=entity,
             message=self.message,
             parse_mode="HTML",
@@ -76,9 +78,9 @@ class UnrestrictedKeyboard(Question):
             new_rows.append(new_row)
         return new_rows
 
-    async def send(self, bot: telethon.TelegramClient, entity: Entity) -> UnrestrictedKeyboard:
-        markup = bot.build_reply_markup(self.buttons())
-        await bot.send_message(
+    async def send(self, sender: Sender, entity: Entity) -> UnrestrictedKeyboard:
+        markup = sender.bot.build_reply_markup(self.buttons())
+        await sender.send_message(
             entity=entity,
             message=self.message,
             buttons=markup,
@@ -0,0 +1,114 @@
+import json
+import logging
+import sqlite3
+import time
+
+from royalnet.typing import *
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "Checkpoint",
+    "CheckpointStore",
+)
+
+
+class Checkpoint(NamedTuple):
+    """The saved state of a Dialog waiting for an answer."""
+
+    step: str
+    """The name of the step the Dialog should resume from."""
+
+    data: Dict[str, JSON]
+    """The arguments of the step."""
+
+    saved_at: float
+    """The UNIX time the checkpoint was saved at."""
+
+
+class CheckpointStore:
+    """
+    A store of the checkpoints of the open Dialogs, kept in a local SQLite file so that they survive restarts.
+
+    Checkpoints are only read when a message arrives for a chat without an open Dialog, so nothing has to be loaded
+    when the bot starts.
+    """
+
+    def __init__(self, path: str, ttl: float = 900, clock: Callable[[], float] = time.time):
+        """
+        Initialize a CheckpointStore object, creating the file if it doesn't exist and deleting the expired checkpoints.
+
+        :param path: The path of the SQLite file.
+        :param ttl: The number of seconds after which a checkpoint is not resumed anymore.
+        :param clock: The function used to get the current time; it must keep counting across restarts.
+        """
+        self.path: str = path
+        self.ttl: float = ttl
+        self.clock: Callable[[], float] = clock
+
+        self.connection: sqlite3.Connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checkpoints ("
+                                "chat_id INTEGER PRIMARY KEY, step TEXT NOT NULL, data TEXT NOT NULL, "
+                                "saved_at REAL NOT NULL)")
+        self.purge()
+
+        self.saved: int = 0
+        "The number of checkpoints saved."
+
+        self.resumed: int = 0
+        "The number of checkpoints loaded to resume a Dialog."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}({self.path=}, {self.saved=}, {self.resumed=})"
+
+    def save(self, chat_id: int, step: str, data: Dict[str, JSON]) -> None:
+        """
+        Save the checkpoint of a chat, replacing the previous one.
+
+        :param chat_id: The id of the chat.
+        :param step: The name of the step the Dialog should resume from.
+        :param data: The arguments of the step; they must be serializable to JSON.
+        """
+        self.connection.execute("INSERT OR REPLACE INTO checkpoints (chat_id, step, data, saved_at) "
+                                "VALUES (?, ?, ?, ?)",
+                                (chat_id, step, json.dumps(data, separators=(",", ":")), self.clock()))
+        self.saved += 1
+
+    def load(self, chat_id: int) -> Optional[Checkpoint]:
+        """
+        Load the checkpoint of a chat, if it has one which hasn't expired.
+
+        :param chat_id: The id of the chat.
+        :return: The checkpoint, or None.
+        """
+        row = self.connection.execute("SELECT step, data, saved_at FROM checkpoints WHERE chat_id = ?",
+                                      (chat_id,)).fetchone()
+        if row is None:
+            return None
+        step, data, saved_at = row
+        if saved_at + self.ttl <= self.clock():
+            self.discard(chat_id)
+            return None
+        self.resumed += 1
+        return Checkpoint(step=step, data=json.loads(data), saved_at=saved_at)
+
+    def discard(self, chat_id: int) -> None:
+        """
+        Delete the checkpoint of a chat, if it has one.
+
+        :param chat_id: The id of the chat.
+        """
+        self.connection.execute("DELETE FROM checkpoints WHERE chat_id = ?", (chat_id,))
+
+    def purge(self) -> int:
+        """
+        Delete all the expired checkpoints.
+
+        :return: The number of deleted checkpoints.
+        """
+        cursor = self.connection.execute("DELETE FROM checkpoints WHERE saved_at + ? <= ?", (self.ttl, self.clock()))
+        if cursor.rowcount:
+            log.debug(f"Purged {cursor.rowcount} expired checkpoints")
+        return cursor.rowcount
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+
+import coloredlogs
+import royalnet.alchemist
+from royalnet.typing import *
+
+from .checkpoints import CheckpointStore
+from .repository import Repository
+from .store import DialogStore
+from .verified import VerifiedIndex
+from ..database.engine import engine_options, PoolStats
+from ..policies import PolicyRegistry, default_policy
+from ..ttlcache import TTLCache
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "setup_logging",
+    "create_alchemist",
+    "create_repository",
+    "create_policies",
+    "run_policy_reloader",
+    "create_menus",
+    "create_checkpoints",
+)
+
+
+def setup_logging(environ: Mapping[str, str] = os.environ) -> None:
+    """
+    Make the root logger print colored messages to the standard error, at the level given by the environment.
+
+    :param environ: The mapping to read the settings from.
+    """
+    logging.root.setLevel(environ["LOG_LEVEL"])
+    stream_handler = logging.StreamHandler()
+    stream_handler.formatter = coloredlogs.ColoredFormatter(
+        "{asctime:>19} | {processName:<12} | {name:<24} | {levelname:>7} | {message}",
+        style="{",
+    )
+    logging.root.addHandler(stream_handler)
+
+
+def create_alchemist(environ: Mapping[str, str] = os.environ) -> Tuple[royalnet.alchemist.Alchemist, PoolStats]:
+    """
+    Connect to the database given by the environment.
+
+    :param environ: The mapping to read the settings from.
+    :return: The Alchemist, and the statistics of its connection pool.
+    """
+    alchemist = royalnet.alchemist.Alchemist(
+        engine_args=[environ["SQLALCHEMY_DATABASE_URI"]],
+        engine_kwargs=engine_options(environ),
+    )
+    pool_stats = PoolStats()
+    pool_stats.attach(alchemist.engine)
+    return alchemist, pool_stats
+
+
+def create_repository(alchemist: royalnet.alchemist.Alchemist,
+                      environ: Mapping[str, str] = os.environ) -> Repository:
+    """
+    Create the Repository of the bot, with the caches and the index configured by the environment.
+
+    :param alchemist: The Alchemist of the database.
+    :param environ: The mapping to read the settings from.
+    :return: The created Repository.
+    """
+    return Repository(
+        sessionmaker=alchemist.Session,
+        max_workers=int(environ.get("DATABASE_THREADS", "4")),
+        whois_cache=TTLCache(
+            max_size=int(environ.get("WHOIS_CACHE_SIZE", "10000")),
+            ttl=float(environ.get("WHOIS_CACHE_TTL", "300")),
+        ),
+        nonce_cache=TTLCache(
+            max_size=int(environ.get("NONCE_CACHE_SIZE", "10000")),
+            ttl=float(environ.get("NONCE_CACHE_TTL", "3600")),
+        ),
+        verified=VerifiedIndex(
+            max_age=float(environ.get("VERIFIED_INDEX_MAX_AGE", "900")),
+        ),
+    )
+
+
+def create_policies(environ: Mapping[str, str] = os.environ) -> PolicyRegistry:
+    """
+    Create the registry of the policies of the groups, with the default policy given by the environment.
+
+    :param environ: The mapping to read the settings from.
+    :return: The created PolicyRegistry, which still has to be refreshed.
+    """
+    return PolicyRegistry(
+        default=default_policy(environ),
+        refresh_interval=float(environ.get("POLICY_REFRESH", "60")),
+    )
+
+
+async def run_policy_reloader(repository: Repository, policies: PolicyRegistry) -> NoReturn:
+    """
+    Reload the policies of the groups forever, every :attr:`PolicyRegistry.refresh_interval` seconds.
+
+    :param repository: The Repository to query with.
+    :param policies: The registry to reload.
+    """
+    while True:
+        await asyncio.sleep(policies.refresh_interval)
+        await repository.run(policies.refresh_if_stale)
+
+
+def create_menus(environ: Mapping[str, str] = os.environ) -> DialogStore:
+    """
+    Create the store of the open Dialogs, with the limits given by the environment.
+
+    :param environ: The mapping to read the settings from.
+    :return: The created DialogStore, whose sweeper still has to be started.
+    """
+    return DialogStore(
+        max_size=int(environ.get("DIALOG_MAX", "1000")),
+        ttl=float(environ.get("DIALOG_TIMEOUT", "900")),
+    )
+
+
+def create_checkpoints(environ: Mapping[str, str] = os.environ) -> CheckpointStore:
+    """
+    Open the store of the checkpoints of the Dialogs given by the environment.
+
+    :param environ: The mapping to read the settings from.
+    :return: The opened CheckpointStore.
+    """
+    return CheckpointStore(
+        path=environ.get("DIALOG_CHECKPOINTS", "checkpoints.sqlite"),
+        ttl=float(environ.get("DIALOG_TIMEOUT", "900")),
+    )
@@ -1,44 +1,76 @@
 from __future__ import annotations
 
+import html
 import logging
 import os
 import re
+import time
 
 import itsdangerous
 import royalnet.campaigns
 import royalnet.campaigns.exc
-import sqlalchemy.orm
 import telethon
 import telethon.tl.custom
 from royalnet.typing import *
 from telethon.hints import *
 
 from .challenges import *
+from .checkpoints import Checkpoint, CheckpointStore
+from .repository import Repository
+from .sender import Priority, Sender
 from ..database import Student, Telegram
-from ..deeplinking import DeepLinking
+from ..deeplinking import DeepLink, DeepLinking
+from ..policies import PolicyRegistry
 
 log = logging.getLogger(__name__)
 dl = DeepLinking(os.environ["SECRET_KEY"])
 
 
-email_regex = re.compile(r"^([0-9]+)(?:@studenti\.unimore\.it)?$")
+email_regex = re.compile(r"^([0-9]+|[^\s@:]+(?=@))(?:@[\w.-]+)?$")
+
+CONFIRM_CHOICES = [["❌ No.", "✅ Sì!"]]
+"""The answers to the question asking a student to confirm their identity."""
+
+PRIVACY_QUESTION = (
+    "📝 Vuoi permettere agli altri studenti verificati di associare il tuo <b>vero nome</b> e la tua "
+    "<b>email istituzionale</b> al tuo <b>account Telegram</b>?"
+    "\n\n"
+    "(Gli amministratori del gruppo vi avranno comunque accesso, e potrai cambiare idea in qualsiasi "
+    "momento con il comando /settings.)"
+)
+"""The question asking a student which privacy mode they want."""
+
+PRIVACY_CHOICES = [["👤 Nascondi.", "📱 Mostra!"]]
+"""The answers to :data:`PRIVACY_QUESTION`."""
 
 
 class Dialog:
-    def __init__(self, bot: telethon.TelegramClient, entity: Entity, session: sqlalchemy.orm.Session):
+    def __init__(self,
+                 sender: Sender,
+                 entity: Entity,
+                 repository: Repository,
+                 policies: PolicyRegistry,
+                 username: str,
+                 checkpoints: Optional[CheckpointStore] = None):
         """
         Initialize an Dialog object.
 
         .. warning:: Do not use this, use the Dialog.create() method instead!
         """
-        self.bot: telethon.TelegramClient = bot
-        "The bot at one side of the Dialog."
+        self.sender: Sender = sender
+        "The Sender of the bot at one side of the Dialog."
 
         self.entity: Entity = entity
         "The entity (user, group) at the other side of the Dialog."
 
-        self.session: sqlalchemy.orm.Session = session
-        "The SQLAlchemy Session to be used exclusively for this dialog."
+        self.repository: Repository = repository
+        "The Repository to be used to access the database."
+
+        self.policies: PolicyRegistry = policies
+        "The registry of the policies of the groups, used to find the groups a student may join."
+
+        self.username: str = username
+        "The username of the bot."
 
         self.campaign: royalnet.campaigns.AsyncCampaign = ...
         """
@@ -47,29 +79,104 @@ class Dialog:
         May be an instance of Ellipsis if the Dialog is not initialized.
         """
 
+        self.last_activity: float = time.monotonic()
+        "The time.monotonic() value of the last time the Dialog was created or advanced."
+
+        self.checkpoints: Optional[CheckpointStore] = checkpoints
+        "The store to save the state of the Dialog to while it waits for an answer, or None if it shouldn't be saved."
+
+        self.checkpointed: bool = False
+        "Whether a checkpoint of the Dialog has been saved, and has to be deleted when the Dialog is closed."
+
     @classmethod
     async def create(cls,
-                     bot: telethon.TelegramClient,
+                     sender: Sender,
                      entity: Entity,
-                     session: sqlalchemy.orm.Session) -> Dialog:
+                     repository: Repository,
+                     policies: PolicyRegistry,
+                     username: str,
+                     checkpoints: Optional[CheckpointStore] = None) -> Dialog:
         """
         Create a new Dialog object.
 
-        :param bot: The bot at one side of the Dialog.
+        :param sender: The Sender of the bot at one side of the Dialog.
         :param entity: The entity (user, group) at the other side of the Dialog.
-        :param session: The SQLAlchemy Session to be used exclusively for this dialog.
+        :param repository: The Repository to be used to access the database.
+        :param policies: The registry of the policies of the groups.
+        :param username: The username of the bot.
+        :param checkpoints: The store to save the state of the Dialog to while it waits for an answer.
         :return: The created dialog.
         """
-        menu = cls(bot=bot, entity=entity, session=session)
+        menu = cls(sender=sender, entity=entity, repository=repository, policies=policies, username=username,
+                   checkpoints=checkpoints)
         menu.campaign = await royalnet.campaigns.AsyncCampaign.create(start=menu.__first())
         return menu
 
+    @classmethod
+    async def resume(cls,
+                     sender: Sender,
+                     entity: Entity,
+                     repository: Repository,
+                     policies: PolicyRegistry,
+                     username: str,
+                     checkpoints: CheckpointStore,
+                     checkpoint: Checkpoint) -> Optional[Dialog]:
+        """
+        Recreate a Dialog from a checkpoint, waiting for the same answer the saved one was waiting for.
+
+        :param sender: The Sender of the bot at one side of the Dialog.
+        :param entity: The entity (user, group) at the other side of the Dialog.
+        :param repository: The Repository to be used to access the database.
+        :param policies: The registry of the policies of the groups.
+        :param username: The username of the bot.
+        :param checkpoints: The store the checkpoint was loaded from.
+        :param checkpoint: The checkpoint to resume from.
+        :return: The resumed dialog, or None if the checkpoint refers to an unknown step.
+        """
+        menu = cls(sender=sender, entity=entity, repository=repository, policies=policies, username=username,
+                   checkpoints=checkpoints)
+        steps = {
+            "register.confirm": (menu.__register_confirm, CONFIRM_CHOICES),
+            "register.privacy": (menu.__register_privacy, PRIVACY_CHOICES),
+            "settings.privacy": (menu.__settings_privacy, PRIVACY_CHOICES),
+        }
+        try:
+            step, choices = steps[checkpoint.step]
+            start = step(**checkpoint.data)
+        except (KeyError, TypeError):
+            log.warning(f"Discarding invalid checkpoint: {checkpoint}")
+            checkpoints.discard(menu._chat_id())
+            return None
+        # The keyboard was already sent before the checkpoint was saved, so it is only needed to check the answer
+        menu.campaign = await royalnet.campaigns.AsyncCampaign.create(
+            start=start,
+            challenge=Keyboard(message="", choices=choices),
+        )
+        menu.checkpointed = True
+        return menu
+
+    def _chat_id(self) -> int:
+        return telethon.utils.get_peer_id(self.entity)
+
+    def _checkpoint(self, step: str, **data: JSON) -> None:
+        """
+        Save the state of the Dialog, so that it can be resumed from the given step if the bot restarts.
+
+        :param step: The name of the step, which will receive the next message.
+        :param data: The arguments of the step.
+        """
+        if self.checkpoints is None:
+            return
+        self.checkpoints.save(self._chat_id(), step, data)
+        self.checkpointed = True
+
     async def next(self, msg: telethon.tl.custom.Message) -> None:
         """
         Advance to the next message of the Dialog.
 
         :param msg: The message to pass to the AsyncAdventure.
         """
+        self.last_activity = time.monotonic()
         try:
             log.debug(f"Advancing: {self}")
             await self.campaign.next(msg)
@@ -81,14 +188,19 @@ class Dialog:
             raise
         else:
             log.debug(f"Sending: {self.campaign.challenge}")
-            await self.campaign.challenge.send(bot=self.bot, entity=self.entity)
+            await self.campaign.challenge.send(sender=self.sender, entity=self.entity)
 
-    async def stop(self) -> None:
+    async def stop(self, keep_checkpoint: bool = False) -> None:
         """
         Suddenly stop a dialog, and cleanup.
+
+        :param keep_checkpoint: Whether the checkpoint of the Dialog should be kept, so that it can be resumed by the
+                                next message of its chat.
         """
         log.debug(f"Stopping: {self}")
         await self.campaign.adventure.aclose()
+        if keep_checkpoint:
+            self.checkpointed = False
         await self._close()
 
     async def _close(self) -> None:
@@ -96,23 +208,62 @@ class Dialog:
         Close and cleanup a dialog.
         """
         log.debug(f"Closing: {self}")
-        self.session.close()
+        if self.checkpointed:
+            self.checkpoints.discard(self._chat_id())
+            self.checkpointed = False
+
+    @staticmethod
+    async def warn_private_only(sender: Sender, entity: Entity, username: str) -> None:
+        """
+        Warn the chat that the command it sent only works in private chats.
+
+        It can be used without creating a Dialog.
+
+        :param sender: The Sender of the bot sending the warning.
+        :param entity: The entity (group) the command was sent in.
+        :param username: The username of the bot.
+        """
+        await sender.send_message(
+            entity=entity,
+            parse_mode="HTML",
+            message=f"⚠️ Questo comando funziona solo in chat privata (@{username}).",
+            buttons=sender.bot.build_reply_markup(telethon.tl.custom.Button.clear()),
+            link_preview=False,
+        )
+
+    def _invites(self, domain: str) -> str:
+        """
+        Compose the links to the groups a student may join, to be appended to a message.
+
+        :param domain: The email domain of the student.
+        :return: The links, preceded by a blank line, or an empty string if there are none.
+        """
+        policies = self.policies.invites(domain)
+        if not policies:
+            return ""
+        if len(policies) == 1:
+            return f'\n\n<a href="{html.escape(policies[0].invite_link)}">Entra nel gruppo cliccando qui!</a>'
+        links = [
+            f'- <a href="{html.escape(policy.invite_link)}">{html.escape(policy.title or policy.invite_link)}</a>'
+            for policy in policies
+        ]
+        return "\n\nEntra nei gruppi cliccando qui:\n" + "\n".join(links)
 
     async def __message(self, msg, **kwargs) -> telethon.types.Message:
         """
         Send a Telegram message to the user at the other side of the dialog.
 
-        It's a shortcut to self.bot.send_message.
+        It's a shortcut to self.sender.send_message.
 
         :param msg: The contents of the message.
         :param kwargs: Keyword arguments to pass to send_message.
         :return: The Message returned by send_message.
         """
-        return await self.bot.send_message(
+        return await self.sender.send_message(
             entity=self.entity,
             parse_mode="HTML",
             message=msg,
-            buttons=self.bot.build_reply_markup(telethon.tl.custom.Button.clear()),
+            buttons=self.sender.bot.build_reply_markup(telethon.tl.custom.Button.clear()),
             link_preview=False,
             **kwargs
         )
@@ -133,24 +284,20 @@ class Dialog:
                 if msg.is_private:
                     yield self.__start()
                 else:
-                    await self.__message(
-                        f"⚠️ Questo comando funziona solo in chat privata (@{os.environ['TELEGRAM_BOT_USERNAME']})."
-                    )
+                    await self.warn_private_only(sender=self.sender, entity=self.entity, username=self.username)
 
             elif text.startswith("/settings"):
                 if msg.is_private:
                     yield self.__settings()
                 else:
-                    await self.__message(
-                        f"⚠️ Questo comando funziona solo in chat privata (@{os.environ['TELEGRAM_BOT_USERNAME']})."
-                    )
+                    await self.warn_private_only(sender=self.sender, entity=self.entity, username=self.username)
 
     async def __help(self) -> AsyncAdventure:
         """The /help command."""
         msg: telethon.tl.custom.Message = yield
 
         lines = [
-            f"ℹ️ @{os.environ['TELEGRAM_BOT_USERNAME']} è il bot-moderatore del gruppo studentesco Unimore "
+            f"ℹ️ @{self.username} è il bot-moderatore del gruppo studentesco Unimore "
             f"Informatica.",
             "",
             'Controlla che gli account che si uniscono al gruppo siano effettivamente studenti verificandone '
@@ -177,7 +324,8 @@ class Dialog:
             ]
 
         await self.__message(
-            "\n".join(lines)
+            "\n".join(lines),
+            priority=Priority.HELP,
         )
 
     async def __start(self) -> AsyncAdventure:
@@ -186,23 +334,36 @@ class Dialog:
 
         text: str = msg.message
 
+        # Check whether this is a normal start or a deep-linked one, rejecting invalid links before any query
+        split = text.split(" ", 1)
+        link: Optional[DeepLink] = None
+        if len(split) > 1:
+            try:
+                link = dl.decode_link(split[1])
+            except itsdangerous.exc.SignatureExpired:
+                await self.__message("⌛️ Il link è scaduto: rifai il login per riceverne uno nuovo.")
+                return
+            except itsdangerous.exc.BadData:
+                await self.__message("⚠️ I dati ricevuti non sono validi.")
+                return
+            if self.repository.is_nonce_used(link.nonce):
+                await self.__message("⚠️ Questo link è già stato usato: rifai il login per riceverne uno nuovo.")
+                return
+
         # Check if the user is already registered
         from_user = await msg.get_sender()
-        tg: Telegram = self.session.query(Telegram).filter_by(id=from_user.id).one_or_none()
+        tg: Optional[Telegram] = await self.repository.find_telegram(from_user.id)
         if tg is not None:
             await self.__message(
-                f'⭐️ Hai già effettuato la verifica dell\'identità.\n\n'
-                f'<a href="{os.environ["GROUP_URL"]}">Entra nel gruppo cliccando '
-                f'qui!</a>'
+                "⭐️ Hai già effettuato la verifica dell'identità."
+                + self._invites(tg.st.domain)
             )
             return
 
-        # Check whether this is a normal start or a deep-linked one
-        split = text.split(" ", 1)
-        if len(split) == 1:
+        if link is None:
             yield self.__normal_start()
         else:
-            yield self.__deeplink_start(payload=split[1])
+            yield self.__deeplink_start(link=link)
 
     async def __normal_start(self) -> AsyncAdventure:
         """The /start command, called without arguments."""
@@ -217,19 +378,16 @@ class Dialog:
             f'tornato su Telegram premi il tasto <i>AVVIA</i> in basso per ricevere il link! 😊'
         )
 
-    async def __deeplink_start(self, payload: str) -> AsyncAdventure:
+    async def __deeplink_start(self, link: DeepLink) -> AsyncAdventure:
         """The /start command, called with deep-linked arguments."""
         _: telethon.tl.custom.Message = yield
 
-        try:
-            opcode, data = dl.decode(payload)
-        except itsdangerous.exc.BadData:
-            await self.__message("⚠️ I dati ricevuti non sono validi.")
-            return
-
         # R: Register new account
-        if opcode == "R":
-            yield self.__register(email_prefix=data)
+        if link.opcode == "R":
+            if not await self.repository.consume_nonce(link.nonce, link.expires):
+                await self.__message("⚠️ Questo link è già stato usato: rifai il login per riceverne uno nuovo.")
+                return
+            yield self.__register(email_prefix=link.data)
         else:
             await self.__message("⚠️ Ricevuto un opcode sconosciuto.")
 
@@ -239,53 +397,63 @@ class Dialog:
 
         Links a Telegram account to a real student.
 
-        :param email_prefix: The prefix before @studenti.unimore.it
+        :param email_prefix: The part of the email of the student before the @.
         """
         msg: telethon.tl.custom.Message = yield
 
-        from_user = await msg.get_sender()
-
-        st: Student = self.session.query(Student).filter_by(email_prefix=email_prefix).one()
+        st: Student = await self.repository.get_student(email_prefix)
 
-        # Ask for confirmation
-        choice = yield Keyboard(
+        # Ask for confirmation, passing the answer on to the next step
+        self._checkpoint("register.confirm", email_prefix=email_prefix)
+        yield Keyboard(
             message=f'❔ Tu sei {st.first_name} {st.last_name} <{st.email()}>, giusto?',
-            choices=[["❌ No.", "✅ Sì!"]]
+            choices=CONFIRM_CHOICES,
         )
+        yield self.__register_confirm(email_prefix=email_prefix)
+
+    async def __register_confirm(self, email_prefix: str) -> AsyncAdventure:
+        """
+        The answer to the confirmation asked by :meth:`__register`.
+
+        :param email_prefix: The part of the email of the student before the @.
+        """
+        choice: telethon.tl.custom.Message = yield
+
         if choice.message == "❌ No.":
             await self.__message(
                 "↩️ Effettua il logout da tutti gli account Google sul tuo browser, poi ri-invia il comando /start!"
             )
             return
 
-        # Ask for privacy mode
-        choice = yield Keyboard(
-            message="📝 Vuoi permettere agli altri studenti verificati di associare il tuo <b>vero nome</b> e la tua "
-                    "<b>email istituzionale</b> al tuo <b>account Telegram</b>?"
-                    "\n\n"
-                    "(Gli amministratori del gruppo vi avranno comunque accesso, e potrai cambiare idea in qualsiasi "
-                    "momento con il comando /settings.)",
-            choices=[["👤 Nascondi.", "📱 Mostra!"]],
-        )
-        st.privacy = choice.message == "👤 Nascondi."
+        # Ask for privacy mode, passing the answer on to the next step
+        self._checkpoint("register.privacy", email_prefix=email_prefix)
+        yield Keyboard(message=PRIVACY_QUESTION, choices=PRIVACY_CHOICES)
+        yield self.__register_privacy(email_prefix=email_prefix)
+
+    async def __register_privacy(self, email_prefix: str) -> AsyncAdventure:
+        """
+        The answer to the privacy mode asked by :meth:`__register_confirm`.
+
+        :param email_prefix: The part of the email of the student before the @.
+        """
+        choice: telethon.tl.custom.Message = yield
+
+        from_user = await choice.get_sender()
 
         # Create the SQL record
-        tg = Telegram(
-            id=from_user.id,
+        domain = await self.repository.register(
+            email_prefix=email_prefix,
+            tg_id=from_user.id,
             first_name=from_user.first_name,
             last_name=from_user.last_name,
             username=from_user.username,
-            st=st,
+            privacy=choice.message == "👤 Nascondi.",
         )
 
-        # Commit the SQLAlchemy session
-        self.session.add(tg)
-        self.session.commit()
-
-        # Send the link to the group
+        # Send the links to the groups
         await self.__message(
-            f'✨ Hai completato la verifica dell\'identità.\n\n'
-            f'<a href="{os.environ["GROUP_URL"]}">Entra nel gruppo cliccando qui!</a>'
+            "✨ Hai completato la verifica dell'identità."
+            + self._invites(domain)
         )
         return
 
@@ -295,7 +463,7 @@ class Dialog:
 
         from_user = await msg.get_sender()
 
-        tg: Telegram = self.session.query(Telegram).filter_by(id=from_user.id).one_or_none()
+        tg: Optional[Telegram] = await self.repository.find_telegram(from_user.id)
         if tg is None:
             await self.__message(
                 "⚠️ Non hai ancora effettuato la verifica dell'account!\n"
@@ -304,19 +472,19 @@ class Dialog:
             )
             return
 
-        # Ask for privacy mode
-        choice = yield Keyboard(
-            message="📝 Vuoi permettere agli altri studenti verificati di associare il tuo <b>vero nome</b> e la tua "
-                    "<b>email istituzionale</b> al tuo <b>account Telegram</b>?"
-                    "\n\n"
-                    "(Gli amministratori del gruppo vi avranno comunque accesso, e potrai cambiare idea in qualsiasi "
-                    "momento con il comando /settings.)",
-            choices=[["👤 Nascondi.", "📱 Mostra!"]],
-        )
-        tg.st.privacy = choice.message == "👤 Nascondi."
-        self.session.commit()
+        # Ask for privacy mode, passing the answer on to the next step
+        self._checkpoint("settings.privacy")
+        yield Keyboard(message=PRIVACY_QUESTION, choices=PRIVACY_CHOICES)
+        yield self.__settings_privacy()
+
+    async def __settings_privacy(self) -> AsyncAdventure:
+        """The answer to the privacy mode asked by :meth:`__settings`."""
+        choice: telethon.tl.custom.Message = yield
+
+        from_user = await choice.get_sender()
+        privacy = await self.repository.set_privacy(tg_id=from_user.id, privacy=choice.message == "👤 Nascondi.")
 
-        if tg.st.privacy:
+        if privacy:
             await self.__message("👤 I tuoi dati ora sono nascosti.")
         else:
             await self.__message("📱 I tuoi dati ora sono visibili attraverso il comando /whois!")
@@ -329,7 +497,7 @@ class Dialog:
         args = " ".join(args)
 
         from_user = await msg.get_sender()
-        from_tg: Telegram = self.session.query(Telegram).filter_by(id=from_user.id).one_or_none()
+        from_tg: Optional[Telegram] = await self.repository.find_telegram(from_user.id)
         if from_tg is None:
             await self.__message("⚠️ Non sei registrato a Thor, pertanto non puoi visualizzare i dati di nessun "
                                  "utente.")
@@ -374,70 +542,44 @@ class Dialog:
         """The /whois command, called with an email."""
         msg: telethon.tl.custom.Message = yield
 
-        st: Optional[Student] = self.session.query(Student).filter_by(email_prefix=email_prefix).one_or_none()
-        if st is None:
+        whois: Optional[str] = await self.repository.whois_email(email_prefix, full=admin and msg.is_private)
+        if whois is None:
             await self.__message("⚠️ Nessuno studente trovato.")
             return
 
-        if admin and msg.is_private:
-            await self.__message(st.whois_message())
-        else:
-            await self.__message(st.whois())
+        await self.__message(whois)
 
     async def __whois_real_name(self, name: str, admin: bool) -> AsyncAdventure:
         """The /whois command, called with a first name and a last name."""
         msg: telethon.tl.custom.Message = yield
 
-        students = (
-            self.session
-            .query(Student)
-            .filter(
-                sqlalchemy.or_(
-                    sqlalchemy.func.concat(Student.first_name, " ", Student.last_name) == name.upper(),
-                    sqlalchemy.func.concat(Student.last_name, " ", Student.first_name) == name.upper(),
-                )
-            )
-            .all()
-        )
+        # There might be more than a student with the same name!
+        response: List[str] = await self.repository.whois_real_name(name, full=admin and msg.is_private)
 
-        if len(students) == 0:
+        if len(response) == 0:
             await self.__message("⚠️ Nessuno studente trovato.")
             return
 
-        # There might be more than a student with the same name!
-        response: List[str] = []
-        for student in students:
-            if admin and msg.is_private:
-                response.append(student.whois_message())
-            else:
-                response.append(student.whois())
-
         await self.__message("\n\n".join(response))
 
     async def __whois_username(self, username: str, admin: bool) -> AsyncAdventure:
         """The /whois command, called with a Telegram username."""
         msg: telethon.tl.custom.Message = yield
 
-        tg: Optional[Telegram] = self.session.query(Telegram).filter_by(username=username).one_or_none()
-        if tg is None:
+        whois: Optional[str] = await self.repository.whois_username(username, full=admin and msg.is_private)
+        if whois is None:
             await self.__message("⚠️ Nessuno studente trovato.")
             return
 
-        if admin and msg.is_private:
-            await self.__message(tg.st.whois_message())
-        else:
-            await self.__message(tg.st.whois())
+        await self.__message(whois)
 
     async def __whois_tg_id(self, tg_id: int, admin: bool) -> AsyncAdventure:
         """The /whois command, called with a Telegram id."""
         msg: telethon.tl.custom.Message = yield
 
-        tg: Optional[Telegram] = self.session.query(Telegram).get(tg_id)
-        if tg is None:
+        whois: Optional[str] = await self.repository.whois_tg_id(tg_id, full=admin and msg.is_private)
+        if whois is None:
             await self.__message("⚠️ Nessuno studente trovato.")
             return
 
-        if admin and msg.is_private:
-            await self.__message(tg.st.whois_message())
-        else:
-            await self.__message(tg.st.whois())
+        await self.__message(whois)
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import logging
+import sys
+import traceback
+
+import telethon.tl.custom
+from royalnet.typing import *
+
+from .checkpoints import CheckpointStore
+from .dialog import Dialog
+from .repository import Repository
+from .router import Route, route
+from .sender import Sender
+from .store import DialogStore
+from ..policies import PolicyRegistry
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "MessageHandler",
+)
+
+
+class MessageHandler:
+    """
+    Pass the messages received by the bot to the Dialogs of their chats, creating and resuming Dialogs as needed.
+    """
+
+    def __init__(self,
+                 sender: Sender,
+                 repository: Repository,
+                 policies: PolicyRegistry,
+                 menus: DialogStore,
+                 checkpoints: CheckpointStore,
+                 username: str):
+        """
+        Initialize a MessageHandler object.
+
+        :param sender: The Sender of the bot, used by the Dialogs.
+        :param repository: The Repository used by the Dialogs.
+        :param policies: The registry of the policies of the groups.
+        :param menus: The store of the open Dialogs.
+        :param checkpoints: The store of the checkpoints of the Dialogs waiting for an answer.
+        :param username: The username of the bot.
+        """
+        self.sender: Sender = sender
+        self.repository: Repository = repository
+        self.policies: PolicyRegistry = policies
+        self.menus: DialogStore = menus
+        self.checkpoints: CheckpointStore = checkpoints
+        self.username: str = username
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}({self.username=})"
+
+    async def handle(self, msg: telethon.tl.custom.Message) -> None:
+        """
+        Handle a received message.
+
+        :param msg: The received message.
+        """
+        menu: Optional[Dialog] = self.menus.get(msg.chat_id)
+
+        # Resume the Dialog interrupted by a restart, if this may be the answer it was waiting for
+        if menu is None and msg.is_private and msg.message and not msg.message.startswith("/"):
+            if (checkpoint := self.checkpoints.load(msg.chat_id)) is not None:
+                log.debug(f"Resuming Dialog for {msg.chat_id} from {checkpoint}")
+                menu = await Dialog.resume(
+                    sender=self.sender,
+                    entity=msg.chat,
+                    repository=self.repository,
+                    policies=self.policies,
+                    username=self.username,
+                    checkpoints=self.checkpoints,
+                    checkpoint=checkpoint,
+                )
+                if menu is not None:
+                    await self.menus.put(msg.chat_id, menu)
+
+        # Drop the messages not meant for the bot before doing any work on them
+        destination = route(msg, has_dialog=menu is not None)
+        if destination is Route.IGNORE:
+            return
+
+        log.debug(f"Received message: {msg}")
+
+        if destination is Route.PRIVATE_ONLY:
+            await Dialog.warn_private_only(sender=self.sender, entity=msg.chat, username=self.username)
+            return
+
+        # Restart dialog
+        if menu is not None and msg.message.startswith("/start"):
+            log.debug(f"Stopping existing Dialog for {msg.chat_id}")
+            await self.menus.stop(msg.chat_id)
+            menu = None
+
+        # Create new dialog
+        if menu is None:
+            log.debug(f"Creating new Dialog for {msg.chat_id}")
+            if msg.is_private:
+                # A new command abandons the Dialog interrupted by a restart, if any
+                self.checkpoints.discard(msg.chat_id)
+            menu = await Dialog.create(
+                sender=self.sender,
+                entity=msg.chat,
+                repository=self.repository,
+                policies=self.policies,
+                username=self.username,
+                checkpoints=self.checkpoints,
+            )
+            await self.menus.put(msg.chat_id, menu)
+
+        log.debug(f"Advancing Dialog for {msg.chat_id}")
+        # noinspection PyBroadException
+        try:
+            await menu.next(msg)
+        except StopAsyncIteration:
+            self.menus.discard(msg.chat_id, menu)
+        except Exception:
+            log.error("".join(traceback.format_exception(*sys.exc_info())))
+            await self.sender.send_message(
+                entity=msg.chat,
+                message="☢️ Si è verificato un errore critico e la conversazione è stata annullata.\n"
+                        "\n"
+                        "L'errore è stato salvato nei log del server.")
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+
+import telethon
+import telethon.errors
+import telethon.utils
+from royalnet.typing import *
+from telethon.hints import *
+
+from .repository import Repository
+from .sender import Priority, Sender
+from ..policies import RESTRICT, PolicyRegistry
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "JoinPipeline",
+)
+
+
+class JoinPipeline:
+    """
+    Verify the accounts joining the monitored groups in batches.
+
+    All the accounts of a join event are checked with a single lookup; unverified accounts are kicked by a worker at a
+    limited rate, waiting out flood waits, and a single notice is sent for each burst of kicks in a chat.
+
+    Which accounts are verified, whether they are kicked or only restricted, and whether notices are sent at all
+    depends on the :class:`Policy` of each chat; the restrictions of the accounts are lifted as soon as they register.
+    """
+
+    def __init__(self,
+                 sender: Sender,
+                 repository: Repository,
+                 policies: PolicyRegistry,
+                 kick_interval: float = 0.5,
+                 burst_window: float = 3.0):
+        """
+        Initialize a JoinPipeline object.
+
+        :param sender: The Sender of the bot performing the kicks.
+        :param repository: The Repository to look up the joining accounts in.
+        :param policies: The registry of the policies of the chats.
+        :param kick_interval: The minimum number of seconds between two kicks.
+        :param burst_window: The number of seconds to wait for more kicks before sending a notice.
+        """
+        self.sender: Sender = sender
+        self.repository: Repository = repository
+        self.policies: PolicyRegistry = policies
+        self.kick_interval: float = kick_interval
+        self.burst_window: float = burst_window
+
+        self.queue: asyncio.Queue = asyncio.Queue()
+        "The kicks waiting to be performed, as tuples of chat and user."
+
+        self.pending: Dict[int, int] = {}
+        "The number of queued kicks for each chat id."
+
+        self.kicked: Dict[int, int] = {}
+        "The number of kicks performed since the last notice for each chat id."
+
+        self.notices: Dict[int, asyncio.Task] = {}
+        "The tasks which will send the next notice for each chat id."
+
+        self.lifts: Set[asyncio.Task] = set()
+        "The tasks lifting the restrictions of the newly registered accounts."
+
+    def __repr__(self):
+        return (f"{self.__class__.__qualname__}(queued={self.queue.qsize()}, pending_notices={len(self.notices)}, "
+                f"pending_lifts={len(self.lifts)})")
+
+    async def handle(self, chat: Entity, users: List[Entity]) -> None:
+        """
+        Verify all the accounts which joined a chat in a single event.
+
+        :param chat: The chat the accounts joined.
+        :param users: The accounts which joined.
+        """
+        policy = self.policies.get(telethon.utils.get_peer_id(chat))
+        whois = await self.repository.whois_tg_ids([user.id for user in users], domains=policy.allowed_domains)
+
+        for user in users:
+            message = whois.get(user.id)
+            if message is None:
+                self.enqueue_kick(chat, user)
+            elif policy.announce:
+                await self.sender.send_message(
+                    entity=chat,
+                    priority=Priority.NOTICE,
+                    parse_mode="HTML",
+                    message=message
+                )
+
+    def enqueue_kick(self, chat: Entity, user: Entity) -> None:
+        """
+        Queue the kick of an account from a chat, or its restriction if the policy of the chat says so.
+
+        :param chat: The chat to kick the account from.
+        :param user: The account to kick.
+        """
+        chat_id = telethon.utils.get_peer_id(chat)
+        self.pending[chat_id] = self.pending.get(chat_id, 0) + 1
+        self.queue.put_nowait((chat, user))
+
+    def enqueue_lift(self, tg_id: int) -> None:
+        """
+        Lift the restrictions of a newly registered account in the restricting chats which allow it.
+
+        :param tg_id: The Telegram id of the account.
+        """
+        task = asyncio.create_task(self._lift(tg_id))
+        self.lifts.add(task)
+        task.add_done_callback(self.lifts.discard)
+
+    async def run_worker(self) -> NoReturn:
+        """
+        Perform the queued kicks forever, one at a time.
+        """
+        while True:
+            chat, user = await self.queue.get()
+            chat_id = telethon.utils.get_peer_id(chat)
+            try:
+                if await self._kick(chat, user):
+                    self.kicked[chat_id] = self.kicked.get(chat_id, 0) + 1
+            except Exception:
+                log.error(f"Unexpected error while kicking {user.id} from {chat_id}", exc_info=True)
+            finally:
+                self.pending[chat_id] -= 1
+                if self.pending[chat_id] == 0:
+                    del self.pending[chat_id]
+                self.queue.task_done()
+
+            if self.kicked.get(chat_id) and chat_id not in self.notices:
+                self.notices[chat_id] = asyncio.create_task(self._notify(chat_id, chat))
+
+            await asyncio.sleep(self.kick_interval)
+
+    async def _kick(self, chat: Entity, user: Entity) -> bool:
+        restrict = self.policies.get(telethon.utils.get_peer_id(chat)).action == RESTRICT
+        while True:
+            try:
+                if restrict:
+                    await self.sender.bot.edit_permissions(entity=chat, user=user, send_messages=False)
+                else:
+                    await self.sender.bot.kick_participant(entity=chat, user=user)
+            except telethon.errors.FloodWaitError as e:
+                log.warning(f"Flood wait of {e.seconds} seconds while kicking {user.id}, waiting...")
+                await asyncio.sleep(e.seconds)
+            except telethon.errors.RPCError as e:
+                log.warning(f"Could not kick {user.id} from {chat.id}: {e}")
+                return False
+            else:
+                return True
+
+    async def _lift(self, tg_id: int) -> None:
+        for policy in self.policies.policies.values():
+            if policy.action != RESTRICT:
+                continue
+            try:
+                if tg_id not in await self.repository.registered_tg_ids([tg_id], domains=policy.allowed_domains):
+                    continue
+                while True:
+                    try:
+                        await self.sender.bot.edit_permissions(entity=policy.chat_id, user=tg_id, send_messages=True)
+                    except telethon.errors.FloodWaitError as e:
+                        log.warning(f"Flood wait of {e.seconds} seconds while lifting the restriction of {tg_id}, "
+                                    f"waiting...")
+                        await asyncio.sleep(e.seconds)
+                    else:
+                        log.info(f"Lifted the restriction of {tg_id} in {policy.chat_id}")
+                        break
+            except telethon.errors.RPCError as e:
+                # Most likely the account isn't a member of the chat
+                log.debug(f"Could not lift the restriction of {tg_id} in {policy.chat_id}: {e}")
+            except Exception:
+                log.error(f"Unexpected error while lifting the restriction of {tg_id} in {policy.chat_id}",
+                          exc_info=True)
+            await asyncio.sleep(self.kick_interval)
+
+    async def _notify(self, chat_id: int, chat: Entity) -> None:
+        try:
+            # Wait until the burst is over
+            await asyncio.sleep(self.burst_window)
+            while self.pending.get(chat_id):
+                await asyncio.sleep(self.burst_window)
+
+            count = self.kicked.pop(chat_id, 0)
+            policy = self.policies.get(chat_id)
+            if not policy.announce:
+                return
+            if policy.action == RESTRICT:
+                if count == 1:
+                    message = "🔇 L'account è stato silenziato perchè non autenticato."
+                else:
+                    message = f"🔇 {count} account sono stati silenziati perchè non autenticati."
+            elif count == 1:
+                message = "🚫 L'account è stato rimosso dal gruppo perchè non autenticato."
+            else:
+                message = f"🚫 {count} account sono stati rimossi dal gruppo perchè non autenticati."
+
+            await self.sender.send_message(
+                entity=chat,
+                priority=Priority.NOTICE,
+                parse_mode="HTML",
+                message=message
+            )
+        finally:
+            del self.notices[chat_id]
+            # Kicks which completed while the notice was being sent need another one
+            if self.kicked.get(chat_id):
+                self.notices[chat_id] = asyncio.create_task(self._notify(chat_id, chat))
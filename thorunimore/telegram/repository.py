@@ -0,0 +1,509 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import logging
+import time
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm
+from royalnet.typing import *
+
+from ..database import Student, Telegram, UsedNonce
+from ..database.students import normalize_name
+from ..database.engine import session_scope
+from ..database.loading import student_whois, telegram_student, telegram_whois
+from ..ttlcache import MISSING, TTLCache
+from .verified import VerifiedIndex
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "Repository",
+)
+
+T = TypeVar("T")
+
+
+class Repository:
+    """
+    An asynchronous data access layer for the bot.
+
+    Every operation runs with its own short-lived SQLAlchemy Session in a bounded thread pool, so that a slow database
+    never blocks the asyncio event loop the TelegramClient is running on.
+
+    The public whois messages of Telegram accounts are cached, including the absence of an account, and the cache is
+    invalidated whenever this Repository changes the accounts of a student.
+
+    The nonces of the used deep links are cached too, so that replayed links are rejected without querying the
+    database.
+
+    While its :class:`VerifiedIndex` is fresh, accounts which aren't registered are recognized without querying the
+    database at all.
+    """
+
+    def __init__(self,
+                 sessionmaker: Callable[[], sqlalchemy.orm.Session],
+                 max_workers: int = 4,
+                 whois_cache: Optional[TTLCache[int, Optional[Tuple[str, str]]]] = None,
+                 nonce_cache: Optional[TTLCache[bytes, bool]] = None,
+                 verified: Optional[VerifiedIndex] = None):
+        """
+        Initialize a Repository object.
+
+        :param sessionmaker: The factory used to create a new SQLAlchemy Session for each operation.
+        :param max_workers: The maximum number of database operations that may run at the same time.
+        :param whois_cache: The cache to store the public whois messages in; if not specified, a new one is created.
+        :param nonce_cache: The cache to store the nonces of the used deep links in; if not specified, a new one is
+                            created.
+        :param verified: The index of the registered accounts; if not specified, a new one is created, which is stale
+                         until :meth:`load_verified` is called.
+        """
+        self.Session: Callable[[], sqlalchemy.orm.Session] = sessionmaker
+        "The factory used to create a new SQLAlchemy Session for each operation."
+
+        self.executor: concurrent.futures.ThreadPoolExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="repository",
+        )
+        "The thread pool the blocking database operations are run in."
+
+        self.whois_cache: TTLCache[int, Optional[Tuple[str, str]]] = (
+            whois_cache if whois_cache is not None else TTLCache(max_size=10000, ttl=300)
+        )
+        """
+        The email domain of the student and the public whois message of the Telegram accounts, or None for the accounts
+        which aren't registered.
+        """
+
+        self.nonce_cache: TTLCache[bytes, bool] = (
+            nonce_cache if nonce_cache is not None else TTLCache(max_size=10000, ttl=3600)
+        )
+        "The nonces of the deep links known to have been used."
+
+        self.verified: VerifiedIndex = verified if verified is not None else VerifiedIndex()
+        "The index of the ids of the registered Telegram accounts."
+
+        self.on_change: Optional[Callable[[List[int], Optional[int]], None]] = None
+        """
+        A function called after this Repository changes the accounts of a student, with the ids of the accounts whose
+        whois messages changed and the id of the newly registered account, if any, so that other processes can apply
+        the same change with :meth:`apply_change`.
+        """
+
+        self.on_register: Optional[Callable[[int], None]] = None
+        """
+        A function called by :meth:`apply_change` with the id of each newly registered account, whichever process
+        registered it.
+        """
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}({self.executor._max_workers=})"
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Run a blocking function in the thread pool, passing it a new Session as the first argument.
+
+        The Session is rolled back if the function raises, and closed as soon as the function returns, so objects
+        returned by it will be detached.
+
+        :param func: The function to run.
+        :return: The value returned by the function.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(self._run, func, *args, **kwargs))
+
+    async def load_verified(self) -> None:
+        """
+        Load the ids of all the registered accounts into :attr:`verified`, making it fresh.
+        """
+        start = time.perf_counter()
+        self.verified.begin_load()
+        try:
+            ids = await self.run(VerifiedIndex.load)
+        except BaseException:
+            self.verified.abort_load()
+            raise
+        self.verified.finish_load(ids)
+        log.debug(f"Loaded {len(ids)} verified ids in {time.perf_counter() - start:.3f} seconds")
+
+    async def run_verified_loader(self) -> NoReturn:
+        """
+        Reload :attr:`verified` forever, three times within its maximum age, so that it stays fresh.
+        """
+        while True:
+            await asyncio.sleep(self.verified.max_age / 3)
+            try:
+                await self.load_verified()
+            except Exception:
+                log.error("Unexpected error while loading the verified ids", exc_info=True)
+
+    def _is_unregistered(self, tg_id: int) -> bool:
+        # A stale index may be missing accounts registered by other processes
+        return self.verified.fresh and tg_id not in self.verified
+
+    def _run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        with session_scope(self.Session) as session:
+            return func(session, *args, **kwargs)
+
+    def shutdown(self) -> None:
+        """
+        Wait for the running operations to complete, then stop the thread pool.
+        """
+        self.executor.shutdown(wait=True)
+
+    @staticmethod
+    def _whois(st: Student, full: bool) -> str:
+        if full:
+            return st.whois_message()
+        else:
+            return st.whois()
+
+    async def find_telegram(self, tg_id: int) -> Optional[Telegram]:
+        """
+        Find the Telegram account with the given id.
+
+        :param tg_id: The Telegram id of the account.
+        :return: The detached Telegram object (with only its Student loaded), or None if it isn't registered.
+        """
+        def _find_telegram(session: sqlalchemy.orm.Session) -> Optional[Telegram]:
+            return session.query(Telegram).options(telegram_student()).filter_by(id=tg_id).one_or_none()
+
+        return await self.run(_find_telegram)
+
+    async def get_student(self, email_prefix: str) -> Student:
+        """
+        Get the Student with the given email prefix.
+
+        :param email_prefix: The part of the email of the student before the @.
+        :return: The detached Student object (without relationships loaded).
+        :raises sqlalchemy.orm.exc.NoResultFound: If no such student exists.
+        """
+        def _get_student(session: sqlalchemy.orm.Session) -> Student:
+            return session.query(Student).filter_by(email_prefix=email_prefix).one()
+
+        return await self.run(_get_student)
+
+    async def whois_tg_id(self, tg_id: int, full: bool = False) -> Optional[str]:
+        """
+        Compose the whois message of the student owning the Telegram account with the given id.
+
+        Public whois messages are read through the cache.
+
+        :param tg_id: The Telegram id of the account.
+        :param full: Whether privacy settings should be ignored.
+        :return: The composed message, or None if the account isn't registered.
+        """
+        def _whois_tg_id(session: sqlalchemy.orm.Session) -> Optional[str]:
+            tg: Optional[Telegram] = session.query(Telegram).options(telegram_whois()).get(tg_id)
+            if tg is None:
+                return None
+            return self._whois(tg.st, full)
+
+        if full:
+            return await self.run(_whois_tg_id)
+        if self._is_unregistered(tg_id):
+            return None
+
+        entry = self.whois_cache.get(tg_id)
+        if entry is MISSING:
+            (entry,) = (await self._lookup_whois([tg_id])).values()
+        return entry[1] if entry is not None else None
+
+    async def _lookup_whois(self, tg_ids: List[int]) -> Dict[int, Optional[Tuple[str, str]]]:
+        def _whois_tg_ids(session: sqlalchemy.orm.Session) -> Dict[int, Optional[Tuple[str, str]]]:
+            tgs: List[Telegram] = (
+                session
+                .query(Telegram)
+                .options(telegram_whois())
+                .filter(Telegram.id.in_(tg_ids))
+                .all()
+            )
+            found = {tg.id: (tg.st.domain, tg.st.whois()) for tg in tgs}
+            return {tg_id: found.get(tg_id) for tg_id in tg_ids}
+
+        # Accounts changed while the query runs must not be cached with the values read before the change
+        since = self.whois_cache.version
+        entries = await self.run(_whois_tg_ids)
+        for tg_id, entry in entries.items():
+            self.whois_cache.set(tg_id, entry, since=since)
+        return entries
+
+    async def whois_tg_ids(self,
+                           tg_ids: Collection[int],
+                           domains: Optional[Collection[str]] = None) -> Dict[int, Optional[str]]:
+        """
+        Compose the public whois messages of the students owning the Telegram accounts with the given ids.
+
+        Ids which aren't in a fresh verified index are not looked up, the others are read through the cache, and all
+        the ids which aren't cached are looked up with a single query.
+
+        :param tg_ids: The Telegram ids of the accounts.
+        :param domains: If specified, accounts of students with an email domain not in it are treated as unregistered.
+        :return: A mapping of each id to its public whois message, or to None if the account isn't registered.
+        """
+        entries: Dict[int, Optional[Tuple[str, str]]] = {}
+        misses: List[int] = []
+        for tg_id in tg_ids:
+            if self._is_unregistered(tg_id):
+                entries[tg_id] = None
+                continue
+            entry = self.whois_cache.get(tg_id)
+            if entry is MISSING:
+                misses.append(tg_id)
+            else:
+                entries[tg_id] = entry
+
+        if misses:
+            entries.update(await self._lookup_whois(misses))
+
+        return {
+            tg_id: entry[1] if entry is not None and (domains is None or entry[0] in domains) else None
+            for tg_id, entry in entries.items()
+        }
+
+    async def registered_tg_ids(self,
+                                tg_ids: Collection[int],
+                                domains: Optional[Collection[str]] = None) -> Set[int]:
+        """
+        Find which of the given Telegram accounts are registered, with at most a single query.
+
+        If the verified index is fresh, only the ids in it are looked up, and only if their domain has to be checked.
+
+        :param tg_ids: The Telegram ids of the accounts.
+        :param domains: If specified, accounts of students with an email domain not in it are treated as unregistered.
+        :return: The set of the ids of the registered accounts.
+        """
+        def _registered_tg_ids(session: sqlalchemy.orm.Session, candidates: List[int]) -> Set[int]:
+            query = session.query(Telegram.id).filter(Telegram.id.in_(candidates))
+            if domains is not None:
+                query = query.join(Telegram.st).filter(Student.domain.in_(domains))
+            return {tg_id for tg_id, in query}
+
+        if self.verified.fresh:
+            candidates = [tg_id for tg_id in tg_ids if tg_id in self.verified]
+            if domains is None:
+                return set(candidates)
+        else:
+            candidates = list(tg_ids)
+        if not candidates:
+            return set()
+        return await self.run(_registered_tg_ids, candidates)
+
+    def apply_change(self, tg_ids: Iterable[int], registered: Optional[int] = None) -> None:
+        """
+        Forget the cached whois messages of changed accounts, and add the newly registered account to the index.
+
+        :param tg_ids: The ids of the accounts whose whois messages changed.
+        :param registered: The id of the newly registered account, or None if no account was registered.
+        """
+        for tg_id in tg_ids:
+            self.whois_cache.invalidate(tg_id)
+        if registered is not None:
+            self.verified.add(registered)
+            if self.on_register is not None:
+                self.on_register(registered)
+
+    def _changed(self, tg_ids: List[int], registered: Optional[int] = None) -> None:
+        self.apply_change(tg_ids, registered)
+        if self.on_change is not None:
+            self.on_change(tg_ids, registered)
+
+    async def whois_username(self, username: str, full: bool = False) -> Optional[str]:
+        """
+        Compose the whois message of the student owning the Telegram account with the given username.
+
+        :param username: The Telegram username of the account, without the @.
+        :param full: Whether privacy settings should be ignored.
+        :return: The composed message, or None if no account with that username is registered.
+        """
+        def _whois_username(session: sqlalchemy.orm.Session) -> Optional[str]:
+            tg: Optional[Telegram] = (
+                session
+                .query(Telegram)
+                .options(telegram_whois())
+                .filter_by(username=username)
+                .one_or_none()
+            )
+            if tg is None:
+                return None
+            return self._whois(tg.st, full)
+
+        return await self.run(_whois_username)
+
+    async def whois_email(self, email_prefix: str, full: bool = False) -> Optional[str]:
+        """
+        Compose the whois message of the student with the given email prefix.
+
+        :param email_prefix: The part of the email of the student before the @.
+        :param full: Whether privacy settings should be ignored.
+        :return: The composed message, or None if no such student exists.
+        """
+        def _whois_email(session: sqlalchemy.orm.Session) -> Optional[str]:
+            st: Optional[Student] = (
+                session
+                .query(Student)
+                .options(student_whois())
+                .filter_by(email_prefix=email_prefix)
+                .one_or_none()
+            )
+            if st is None:
+                return None
+            return self._whois(st, full)
+
+        return await self.run(_whois_email)
+
+    @staticmethod
+    def _escape_like(word: str) -> str:
+        # Words may contain underscores, which LIKE would otherwise match with any character
+        return word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+    async def whois_real_name(self, name: str, full: bool = False, limit: int = 10) -> List[str]:
+        """
+        Compose the whois messages of the students whose name matches the given one, ignoring case, accents and the
+        order of the words.
+
+        Every word of the given name must be the start of a word of the student's name; on PostgreSQL, names similar
+        enough to the given one also match, and results are ranked by similarity.
+
+        :param name: The name to search for.
+        :param full: Whether privacy settings should be ignored.
+        :param limit: The maximum number of students to return.
+        :return: A list of composed messages, one for each matching student, with exact matches first.
+        """
+        key = normalize_name(name)
+        if not key:
+            return []
+
+        def _whois_real_name(session: sqlalchemy.orm.Session) -> List[str]:
+            prefix = sqlalchemy.and_(*[
+                sqlalchemy.or_(
+                    Student.search_name.like(f"{word}%", escape="\\"),
+                    Student.search_name.like(f"% {word}%", escape="\\"),
+                )
+                for word in map(self._escape_like, key.split(" "))
+            ])
+            query = session.query(Student).options(student_whois())
+            if session.get_bind().dialect.name == "postgresql":
+                query = (
+                    query
+                    .filter(sqlalchemy.or_(prefix, Student.search_name.op("%")(key)))
+                    .order_by(
+                        (Student.search_name == key).desc(),
+                        sqlalchemy.func.similarity(Student.search_name, key).desc(),
+                        Student.search_name,
+                    )
+                )
+            else:
+                query = (
+                    query
+                    .filter(prefix)
+                    .order_by(
+                        (Student.search_name == key).desc(),
+                        Student.search_name,
+                    )
+                )
+            return [self._whois(st, full) for st in query.limit(limit).all()]
+
+        return await self.run(_whois_real_name)
+
+    def is_nonce_used(self, nonce: bytes) -> bool:
+        """
+        Check whether a deep link is known to have been used, without querying the database.
+
+        :param nonce: The nonce of the deep link.
+        :return: True if the link has certainly been used, False if it may not have been.
+        """
+        return self.nonce_cache.get(nonce, False)
+
+    async def consume_nonce(self, nonce: bytes, expires: Optional[int]) -> bool:
+        """
+        Mark a deep link as used, unless it already was.
+
+        :param nonce: The nonce of the deep link.
+        :param expires: The UNIX time the deep link expires at, or None if it never does.
+        :return: True if the link was marked as used now, False if it had already been used.
+        """
+        if self.is_nonce_used(nonce):
+            return False
+        # Mark it before querying, so that a replay arriving meanwhile is rejected too
+        self.nonce_cache.set(nonce, True)
+
+        def _consume_nonce(session: sqlalchemy.orm.Session) -> bool:
+            now = datetime.datetime.utcnow()
+            session.add(UsedNonce(
+                nonce=nonce.hex(),
+                expires_at=datetime.datetime.utcfromtimestamp(expires) if expires is not None else None,
+            ))
+            try:
+                session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                return False
+            session.query(UsedNonce).filter(UsedNonce.expires_at < now).delete(synchronize_session=False)
+            session.commit()
+            return True
+
+        try:
+            return await self.run(_consume_nonce)
+        except BaseException:
+            # The link wasn't marked as used after all, so it should still be usable
+            self.nonce_cache.invalidate(nonce)
+            raise
+
+    async def register(self,
+                       email_prefix: str,
+                       tg_id: int,
+                       first_name: str,
+                       last_name: Optional[str],
+                       username: Optional[str],
+                       privacy: bool) -> str:
+        """
+        Link a Telegram account to a student, and set the privacy mode of the student.
+
+        :param email_prefix: The part of the email of the student before the @.
+        :param tg_id: The Telegram id of the account.
+        :param first_name: The first name of the Telegram account.
+        :param last_name: The last name of the Telegram account.
+        :param username: The username of the Telegram account.
+        :param privacy: Whether the student wants to keep their data hidden.
+        :return: The email domain of the student.
+        """
+        def _register(session: sqlalchemy.orm.Session) -> Tuple[str, List[int]]:
+            st: Student = session.query(Student).filter_by(email_prefix=email_prefix).one()
+            st.privacy = privacy
+            tg = Telegram(
+                id=tg_id,
+                first_name=first_name,
+                last_name=last_name,
+                username=username,
+                st=st,
+            )
+            session.add(tg)
+            session.commit()
+            return st.domain, [tg.id for tg in st.tg]
+
+        domain, tg_ids = await self.run(_register)
+        # The whois messages of all the accounts of the student now include the new one
+        self._changed(tg_ids, registered=tg_id)
+        return domain
+
+    async def set_privacy(self, tg_id: int, privacy: bool) -> bool:
+        """
+        Change the privacy mode of the student owning the Telegram account with the given id.
+
+        :param tg_id: The Telegram id of the account.
+        :param privacy: Whether the student wants to keep their data hidden.
+        :return: The new privacy mode of the student.
+        """
+        def _set_privacy(session: sqlalchemy.orm.Session) -> Tuple[bool, List[int]]:
+            tg: Telegram = session.query(Telegram).filter_by(id=tg_id).one()
+            tg.st.privacy = privacy
+            session.commit()
+            return tg.st.privacy, [other.id for other in tg.st.tg]
+
+        new_privacy, tg_ids = await self.run(_set_privacy)
+        self._changed(tg_ids)
+        return new_privacy
@@ -0,0 +1,53 @@
+import enum
+
+import telethon.tl.custom
+
+__all__ = (
+    "Route",
+    "route",
+)
+
+
+COMMANDS = ("/whois", "/help", "/start", "/settings")
+"""The commands which open a new Dialog."""
+
+PRIVATE_COMMANDS = ("/start", "/settings")
+"""The commands which only work in private chats."""
+
+
+class Route(enum.Enum):
+    """Where a received message should be dispatched to."""
+
+    IGNORE = enum.auto()
+    """The message isn't meant for the bot, and should be dropped."""
+
+    PRIVATE_ONLY = enum.auto()
+    """The message is a private command sent in a group, and should be answered with a warning."""
+
+    DIALOG = enum.auto()
+    """The message should be passed to the Dialog of its chat, creating one if necessary."""
+
+
+def route(msg: telethon.tl.custom.Message, has_dialog: bool) -> Route:
+    """
+    Decide where a message should be dispatched to, without creating a Dialog.
+
+    :param msg: The received message.
+    :param has_dialog: Whether the chat of the message already has an open Dialog.
+    :return: The Route the message should take.
+    """
+    # Messages in an open Dialog might be answers to its questions
+    if has_dialog:
+        return Route.DIALOG
+
+    text = msg.message
+    if not text or text[0] != "/":
+        return Route.IGNORE
+
+    if not text.startswith(COMMANDS):
+        return Route.IGNORE
+
+    if text.startswith(PRIVATE_COMMANDS) and not msg.is_private:
+        return Route.PRIVATE_ONLY
+
+    return Route.DIALOG
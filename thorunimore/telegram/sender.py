@@ -0,0 +1,278 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import enum
+import itertools
+import logging
+import time
+
+import telethon
+import telethon.errors
+import telethon.utils
+from royalnet.typing import *
+from telethon.hints import *
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "Priority",
+    "TokenBucket",
+    "Sender",
+)
+
+
+class Priority(enum.IntEnum):
+    """How urgently a message should be sent; lower values are sent first."""
+
+    NOTICE = 0
+    """Join and kick notices in the monitored groups."""
+
+    REPLY = 1
+    """Replies to the users talking to the bot."""
+
+    HELP = 2
+    """Help text, which can wait."""
+
+
+class TokenBucket:
+    """
+    A token bucket rate limiter, allowing short bursts while enforcing an average rate.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize a TokenBucket object, full of tokens.
+
+        :param rate: The number of tokens added to the bucket every second.
+        :param capacity: The maximum number of tokens in the bucket.
+        :param clock: The function used to get the current time.
+        """
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.clock: Callable[[], float] = clock
+        self.tokens: float = capacity
+        self.updated: float = clock()
+        self.blocked_until: float = 0.0
+        "The time before which no tokens may be taken, regardless of how many are in the bucket."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}({self.rate=}, {self.capacity=}, {self.tokens=})"
+
+    def _refill(self) -> float:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def delay(self) -> float:
+        """
+        :return: The number of seconds to wait before a token can be taken.
+        """
+        now = self._refill()
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+    def take(self) -> None:
+        """
+        Take a token from the bucket; it may go into debt if there are none.
+        """
+        self._refill()
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        """
+        Prevent any token from being taken for the given number of seconds.
+
+        :param seconds: The number of seconds to block the bucket for.
+        """
+        self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+
+
+class _Request:
+    def __init__(self, entity: Entity, kwargs: Dict[str, Any], future: asyncio.Future):
+        self.entity: Entity = entity
+        self.kwargs: Dict[str, Any] = kwargs
+        self.future: asyncio.Future = future
+        self.enqueued: float = time.monotonic()
+
+
+class Sender:
+    """
+    A scheduler for all the messages sent by the bot.
+
+    Messages are queued by priority and sent in order, respecting both a global and a per-chat token bucket; at most
+    one message per chat is in flight at once, so that messages to the same chat keep their order.
+
+    Flood waits are handled by pausing all the messages, as they apply to the whole account, and slow mode waits by
+    pausing the affected chat; either way, the message is retried once the wait is over.
+    """
+
+    def __init__(self,
+                 bot: telethon.TelegramClient,
+                 rate: float = 30,
+                 burst: float = 30,
+                 chat_rate: float = 1,
+                 chat_burst: float = 3):
+        """
+        Initialize a Sender object.
+
+        :param bot: The bot sending the messages.
+        :param rate: The average number of messages per second the bot may send.
+        :param burst: The number of messages the bot may send at once.
+        :param chat_rate: The average number of messages per second the bot may send to a single chat.
+        :param chat_burst: The number of messages the bot may send at once to a single chat.
+        """
+        self.bot: telethon.TelegramClient = bot
+        self.bucket: TokenBucket = TokenBucket(rate=rate, capacity=burst)
+        self.chat_rate: float = chat_rate
+        self.chat_burst: float = chat_burst
+
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        "The token buckets of the chats; they are dropped when idle and full, as that is how new ones start."
+
+        self.queue: List[Tuple[int, int, int, _Request]] = []
+        "The queued messages, as tuples of priority, sequence number, chat id and request, sorted."
+
+        self.in_flight: Set[int] = set()
+        "The chat ids which have a message being sent right now."
+
+        self._sequence: Iterator[int] = itertools.count()
+        self._wakeup: asyncio.Event = asyncio.Event()
+
+        self.sent: int = 0
+        "The number of messages sent successfully."
+
+        self.retries: int = 0
+        "The number of times a message had to be sent again because of a flood or slow mode wait."
+
+        self.failures: int = 0
+        "The number of messages which could not be sent."
+
+        self.total_latency: float = 0.0
+        "The sum of the seconds each sent message spent between being queued and being sent."
+
+        self.max_latency: float = 0.0
+        "The highest number of seconds a sent message spent between being queued and being sent."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(queued={len(self.queue)}, {self.sent=}, {self.retries=}, " \
+               f"{self.failures=}, mean_latency={self.mean_latency:.3f}, max_latency={self.max_latency:.3f})"
+
+    @property
+    def mean_latency(self) -> float:
+        """
+        :return: The average number of seconds a sent message spent between being queued and being sent.
+        """
+        if self.sent == 0:
+            return 0.0
+        return self.total_latency / self.sent
+
+    async def send_message(self,
+                           entity: Entity,
+                           priority: Priority = Priority.REPLY,
+                           **kwargs) -> telethon.types.Message:
+        """
+        Queue a message, and wait for it to be sent.
+
+        :param entity: The chat to send the message to.
+        :param priority: How urgently the message should be sent.
+        :param kwargs: Keyword arguments to pass to :meth:`telethon.TelegramClient.send_message`.
+        :return: The sent message.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(priority, next(self._sequence), _Request(entity=entity, kwargs=kwargs, future=future))
+        return await future
+
+    def _enqueue(self, priority: int, sequence: int, request: _Request) -> None:
+        chat_id = telethon.utils.get_peer_id(request.entity)
+        bisect.insort(self.queue, (priority, sequence, chat_id, request))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(rate=self.chat_rate, capacity=self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune(self) -> None:
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in self.in_flight and bucket.delay() == 0 and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+
+    async def run(self) -> NoReturn:
+        """
+        Send the queued messages forever.
+        """
+        while True:
+            self._wakeup.clear()
+
+            if not self.queue:
+                self._prune()
+                await self._wakeup.wait()
+                continue
+
+            delay = self.bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            # Find the most urgent message whose chat can receive it right now
+            delay = None
+            for index, (priority, sequence, chat_id, request) in enumerate(self.queue):
+                if chat_id in self.in_flight:
+                    continue
+                chat_delay = self._chat_bucket(chat_id).delay()
+                if chat_delay > 0:
+                    delay = chat_delay if delay is None else min(delay, chat_delay)
+                    continue
+                del self.queue[index]
+                if request.future.done():
+                    # The caller is not waiting for this message anymore
+                    break
+                self.bucket.take()
+                self._chat_bucket(chat_id).take()
+                self.in_flight.add(chat_id)
+                asyncio.create_task(self._deliver(priority, sequence, chat_id, request))
+                break
+            else:
+                # Nothing can be sent right now: wait for a new message, a finished one, or a refilled bucket
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _deliver(self, priority: int, sequence: int, chat_id: int, request: _Request) -> None:
+        try:
+            message = await self.bot.send_message(entity=request.entity, **request.kwargs)
+        except telethon.errors.FloodWaitError as e:
+            log.warning(f"Flood wait of {e.seconds} seconds while sending to {chat_id}, pausing all messages...")
+            self.retries += 1
+            self.bucket.block(e.seconds)
+            self._enqueue(priority, sequence, request)
+        except telethon.errors.SlowModeWaitError as e:
+            log.warning(f"Slow mode wait of {e.seconds} seconds while sending to {chat_id}, retrying later...")
+            self.retries += 1
+            self._chat_bucket(chat_id).block(e.seconds)
+            self._enqueue(priority, sequence, request)
+        except Exception as e:
+            self.failures += 1
+            self._resolve(request.future, exception=e)
+        else:
+            latency = time.monotonic() - request.enqueued
+            self.sent += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self._resolve(request.future, result=message)
+        finally:
+            self.in_flight.discard(chat_id)
+            self._wakeup.set()
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result: Any = None, exception: Optional[BaseException] = None) -> None:
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
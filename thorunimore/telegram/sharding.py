@@ -0,0 +1,587 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import functools
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.context
+import multiprocessing.process
+import os
+import signal
+import threading
+
+import telethon.client.buttons
+import telethon.tl.custom
+from royalnet.typing import *
+from telethon.hints import *
+
+from .components import (
+    create_alchemist,
+    create_checkpoints,
+    create_menus,
+    create_policies,
+    create_repository,
+    run_policy_reloader,
+    setup_logging,
+)
+from .handler import MessageHandler
+from .repository import Repository
+from .router import Route, route
+from .sender import Priority, Sender
+from .store import DialogStore
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "shard_of",
+    "IncomingMessage",
+    "RemoteSender",
+    "ShardWorker",
+    "ShardPool",
+    "work",
+)
+
+
+def shard_of(chat_id: int, shards: int) -> int:
+    """
+    Choose the worker handling the messages of a chat; it never changes as long as the number of workers doesn't.
+
+    :param chat_id: The id of the chat, as returned by :func:`telethon.utils.get_peer_id`.
+    :param shards: The number of workers.
+    :return: The index of the worker.
+    """
+    return chat_id % shards
+
+
+class IncomingMessage(NamedTuple):
+    """
+    A received message, reduced to what the Dialogs use of it, so that it can be pickled and sent to a worker.
+
+    It quacks like a :class:`telethon.tl.custom.Message` as far as the Dialogs are concerned.
+    """
+
+    chat_id: int
+    """The id of the chat the message was sent in."""
+
+    chat: Entity
+    """The chat the message was sent in."""
+
+    sender: Optional[Entity]
+    """The account which sent the message."""
+
+    message: str
+    """The text of the message."""
+
+    is_private: bool
+    """Whether the message was sent in a private chat with the bot."""
+
+    @classmethod
+    async def from_message(cls, msg: telethon.tl.custom.Message) -> IncomingMessage:
+        """
+        Reduce a message received by the TelegramClient.
+
+        :param msg: The received message.
+        :return: The reduced message.
+        """
+        return cls(
+            chat_id=msg.chat_id,
+            chat=await msg.get_chat(),
+            sender=await msg.get_sender(),
+            message=msg.message,
+            is_private=msg.is_private,
+        )
+
+    async def get_sender(self) -> Optional[Entity]:
+        """
+        :return: The account which sent the message.
+        """
+        return self.sender
+
+
+def _set_closed(closed: asyncio.Future) -> None:
+    # The task waiting for the connection to be closed may have been cancelled meanwhile
+    if not closed.done():
+        closed.set_result(None)
+
+
+def _receive(connection: multiprocessing.connection.Connection,
+             loop: asyncio.AbstractEventLoop,
+             received: Callable[[tuple], None],
+             closed: asyncio.Future) -> None:
+    # Runs in its own thread, as receiving from a connection blocks
+    try:
+        while True:
+            try:
+                item = connection.recv()
+            except (EOFError, OSError):
+                loop.call_soon_threadsafe(_set_closed, closed)
+                return
+            loop.call_soon_threadsafe(received, item)
+    except RuntimeError:
+        # The event loop has been closed, nothing is left to handle the items
+        return
+
+
+class _RemoteBot:
+    # The only method of the TelegramClient the Dialogs call directly, which doesn't need a connection
+    build_reply_markup = staticmethod(telethon.client.buttons.ButtonMethods.build_reply_markup)
+
+
+class RemoteSender:
+    """
+    A stand-in for the :class:`Sender` in a worker process, asking the receiver process to send the messages instead.
+
+    All the messages of the bot are sent by the single Sender of the receiver, so that the rate limits apply to all
+    the workers together.
+    """
+
+    def __init__(self, connection: multiprocessing.connection.Connection):
+        """
+        Initialize a RemoteSender object.
+
+        :param connection: The connection to the receiver process.
+        """
+        self.connection: multiprocessing.connection.Connection = connection
+
+        self.bot: _RemoteBot = _RemoteBot()
+        "A stand-in for the TelegramClient, only able to build reply markups."
+
+        self.calls: Dict[int, asyncio.Future] = {}
+        "The futures of the messages waiting to be sent by the receiver, by call id."
+
+        self._sequence: Iterator[int] = itertools.count()
+
+        self.sent: int = 0
+        "The number of messages sent successfully."
+
+        self.failures: int = 0
+        "The number of messages which could not be sent."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(waiting={len(self.calls)}, {self.sent=}, {self.failures=})"
+
+    async def send_message(self, entity: Entity, priority: Priority = Priority.REPLY, **kwargs) -> None:
+        """
+        Ask the receiver to queue a message, and wait for it to be sent.
+
+        :param entity: The chat to send the message to.
+        :param priority: How urgently the message should be sent.
+        :param kwargs: Keyword arguments to pass to :meth:`telethon.TelegramClient.send_message`.
+        :return: None, as the sent message stays in the receiver process.
+        :raises RuntimeError: If the receiver could not send the message.
+        """
+        call_id = next(self._sequence)
+        future = asyncio.get_running_loop().create_future()
+        self.calls[call_id] = future
+        try:
+            self.connection.send(("send", call_id, entity, priority, kwargs))
+            await future
+        finally:
+            del self.calls[call_id]
+
+    def resolve(self, call_id: int, error: Optional[str]) -> None:
+        """
+        Wake up the caller waiting for a message to be sent.
+
+        :param call_id: The call id of the message.
+        :param error: The description of the error which prevented the message from being sent, or None if it was sent.
+        """
+        future = self.calls.get(call_id)
+        if future is None or future.done():
+            return
+        if error is None:
+            self.sent += 1
+            future.set_result(None)
+        else:
+            self.failures += 1
+            future.set_exception(RuntimeError(error))
+
+
+class ShardWorker:
+    """
+    The side of a worker process talking to the receiver process.
+
+    The messages of each chat are handled one at a time, in the order they were received, while messages of different
+    chats are handled concurrently; the chats whose Dialogs are opened and closed are reported to the receiver.
+    """
+
+    def __init__(self,
+                 connection: multiprocessing.connection.Connection,
+                 sender: RemoteSender,
+                 repository: Repository,
+                 menus: DialogStore,
+                 handler: MessageHandler,
+                 concurrency: int = 16):
+        """
+        Initialize a ShardWorker object.
+
+        :param connection: The connection to the receiver process.
+        :param sender: The RemoteSender used by the handler.
+        :param repository: The Repository used by the handler, whose changes are shared with the other processes.
+        :param menus: The store of the open Dialogs used by the handler.
+        :param handler: The MessageHandler to pass the messages to.
+        :param concurrency: The maximum number of messages that may be handled at the same time.
+        """
+        self.connection: multiprocessing.connection.Connection = connection
+        self.sender: RemoteSender = sender
+        self.repository: Repository = repository
+        self.menus: DialogStore = menus
+        self.handler: MessageHandler = handler
+
+        self.chats: Dict[int, Deque[IncomingMessage]] = {}
+        "The messages waiting to be handled, for each chat which has a message being handled right now."
+
+        self.handled: int = 0
+        "The number of messages handled."
+
+        self._semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+        self._closed: Optional[asyncio.Future] = None
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(busy_chats={len(self.chats)}, {self.handled=})"
+
+    def _received(self, item: tuple) -> None:
+        kind, *args = item
+        if kind == "message":
+            msg, = args
+            queue = self.chats.get(msg.chat_id)
+            if queue is None:
+                self.chats[msg.chat_id] = collections.deque([msg])
+                asyncio.create_task(self._drain(msg.chat_id))
+            else:
+                queue.append(msg)
+        elif kind == "sent":
+            self.sender.resolve(*args)
+        elif kind == "changed":
+            self.repository.apply_change(*args)
+        else:
+            log.warning(f"Received unknown item from the receiver: {item!r}")
+
+    async def _drain(self, chat_id: int) -> None:
+        queue = self.chats[chat_id]
+        while queue:
+            msg = queue.popleft()
+            async with self._semaphore:
+                # noinspection PyBroadException
+                try:
+                    await self.handler.handle(msg)
+                except Exception:
+                    log.error(f"Unexpected error while handling a message of {chat_id}", exc_info=True)
+            self.handled += 1
+        del self.chats[chat_id]
+
+    def _changed(self, tg_ids: List[int], registered: Optional[int]) -> None:
+        try:
+            self.connection.send(("changed", tg_ids, registered))
+        except OSError:
+            # The other processes will pick the change up when their caches expire and their indexes are reloaded
+            log.warning(f"Could not share the change of {tg_ids} with the receiver, as it isn't running anymore")
+
+    def _dialog_changed(self, chat_id: int, is_open: bool) -> None:
+        try:
+            self.connection.send(("dialog", chat_id, is_open))
+        except OSError:
+            log.debug(f"Could not report the Dialog of {chat_id} to the receiver, as it isn't running anymore")
+
+    async def run(self) -> None:
+        """
+        Handle the messages sent by the receiver, until it closes the connection.
+        """
+        loop = asyncio.get_running_loop()
+        self._closed = loop.create_future()
+        self.repository.on_change = self._changed
+        self.menus.on_change = self._dialog_changed
+        threading.Thread(
+            target=_receive,
+            args=(self.connection, loop, self._received, self._closed),
+            name="receiver",
+            daemon=True,
+        ).start()
+        self.connection.send(("ready",))
+        await self._closed
+        log.info("The receiver closed the connection, stopping...")
+
+
+async def _work(connection: multiprocessing.connection.Connection, username: str) -> None:
+    alchemist, pool_stats = create_alchemist()
+    repository = create_repository(alchemist)
+    policies = create_policies()
+    await repository.run(policies.refresh)
+    asyncio.create_task(run_policy_reloader(repository, policies))
+
+    menus = create_menus()
+    asyncio.create_task(menus.run_sweeper())
+    checkpoints = create_checkpoints()
+
+    sender = RemoteSender(connection=connection)
+    worker = ShardWorker(
+        connection=connection,
+        sender=sender,
+        repository=repository,
+        menus=menus,
+        handler=MessageHandler(
+            sender=sender,
+            repository=repository,
+            policies=policies,
+            menus=menus,
+            checkpoints=checkpoints,
+            username=username,
+        ),
+        concurrency=int(os.environ.get("HANDLER_CONCURRENCY", "16")),
+    )
+
+    async def report_stats():
+        while True:
+            await asyncio.sleep(60)
+            log.debug(f"Statistics: {worker}, {menus}, {checkpoints}, {sender}, {pool_stats}, "
+                      f"{repository.whois_cache}, {policies}")
+
+    asyncio.create_task(report_stats())
+
+    try:
+        await worker.run()
+    finally:
+        repository.shutdown()
+
+
+def work(connection: multiprocessing.connection.Connection, username: str) -> None:
+    """
+    The entry point of a worker process, configured by the same environment variables as the receiver.
+
+    :param connection: The connection to the receiver process.
+    :param username: The username of the bot.
+    """
+    # The receiver stops the workers by closing their connections, so they shouldn't be interrupted before it is
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging()
+    asyncio.get_event_loop().run_until_complete(_work(connection, username))
+
+
+class _Shard:
+    def __init__(self, index: int, process: multiprocessing.process.BaseProcess,
+                 connection: multiprocessing.connection.Connection):
+        self.index: int = index
+        self.process: multiprocessing.process.BaseProcess = process
+        self.connection: multiprocessing.connection.Connection = connection
+        self.ready: bool = False
+
+
+class ShardPool:
+    """
+    The receiver side of the sharded mode, running the Dialogs in worker processes so that they can use more than
+    one core.
+
+    Received messages are fanned out to the workers, sharded by chat with :func:`shard_of` so that the messages of a
+    chat are always handled by the same worker, in order; the messages the workers send are funneled back through the
+    single :class:`Sender` of the bot, and the changes they make to the accounts are shared with the other processes.
+
+    Workers which stop are restarted; the messages dispatched to a worker while it isn't running are dropped.
+    """
+
+    def __init__(self,
+                 sender: Sender,
+                 repository: Repository,
+                 workers: int,
+                 username: str,
+                 restart_delay: float = 5,
+                 context: multiprocessing.context.BaseContext = multiprocessing.get_context("spawn")):
+        """
+        Initialize a ShardPool object; the workers are started by :meth:`run`.
+
+        :param sender: The Sender sending the messages of the workers.
+        :param repository: The Repository of the receiver, which is kept in sync with the ones of the workers.
+        :param workers: The number of worker processes.
+        :param username: The username of the bot.
+        :param restart_delay: The number of seconds to wait before restarting a worker which stopped.
+        :param context: The multiprocessing context to start the workers with; they must not inherit the event loop
+                        and the connections of the receiver, so it shouldn't fork.
+        """
+        self.sender: Sender = sender
+        self.repository: Repository = repository
+        self.username: str = username
+        self.restart_delay: float = restart_delay
+        self.context: multiprocessing.context.BaseContext = context
+
+        self.shards: List[Optional[_Shard]] = [None] * workers
+        "The running workers, or None for the workers which are being restarted."
+
+        self.dispatched: int = 0
+        "The number of messages dispatched to the workers."
+
+        self.dropped: int = 0
+        "The number of messages dropped because their worker wasn't running."
+
+        self.relayed: int = 0
+        "The number of messages sent on behalf of the workers, successfully or not."
+
+        self.restarts: int = 0
+        "The number of times a worker had to be restarted."
+
+        self.reducing: Dict[int, Deque[asyncio.Future]] = {}
+        "The messages of each chat being reduced to :class:`IncomingMessage`, in the order they were received."
+
+        self.open_chats: Set[int] = set()
+        "The ids of the chats with an open Dialog, as reported by the workers."
+
+        self.ignored: int = 0
+        "The number of messages dropped by :meth:`wants` without being dispatched."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(workers={len(self.shards)}, {self.dispatched=}, {self.ignored=}, " \
+               f"{self.dropped=}, {self.relayed=}, {self.restarts=}, open_chats={len(self.open_chats)})"
+
+    @property
+    def ready(self) -> bool:
+        """
+        :return: Whether all the workers are running and ready to handle messages.
+        """
+        return all(shard is not None and shard.ready for shard in self.shards)
+
+    def wants(self, msg: telethon.tl.custom.Message) -> bool:
+        """
+        Decide whether a received message should be submitted, so that the messages which aren't meant for the bot are
+        dropped without fetching their chat and sender, nor waking up a worker.
+
+        :param msg: The received message.
+        :return: Whether the message should be submitted.
+        """
+        # Any text in a private chat may be the answer a checkpoint is waiting for, and the workers know no checkpoints
+        has_dialog = msg.is_private or msg.chat_id in self.open_chats
+        if route(msg, has_dialog=has_dialog) is Route.IGNORE:
+            self.ignored += 1
+            return False
+        return True
+
+    def submit(self, msg: telethon.tl.custom.Message) -> None:
+        """
+        Reduce a message received by the TelegramClient, and dispatch it to the worker of its chat.
+
+        Reducing a message may have to fetch its chat and sender, so messages are reduced concurrently, but the messages
+        of a chat are always dispatched in the order they were submitted; to keep the order they were received in, this
+        must be called as soon as a message is received, before awaiting anything.
+
+        :param msg: The received message.
+        """
+        reduced = asyncio.ensure_future(IncomingMessage.from_message(msg))
+        queue = self.reducing.get(msg.chat_id)
+        if queue is not None:
+            queue.append(reduced)
+            return
+        self.reducing[msg.chat_id] = collections.deque([reduced])
+        asyncio.create_task(self._forward(msg.chat_id))
+
+    async def _forward(self, chat_id: int) -> None:
+        queue = self.reducing[chat_id]
+        try:
+            while queue:
+                reduced = queue.popleft()
+                try:
+                    msg = await reduced
+                except Exception:
+                    log.error(f"Could not reduce a message of {chat_id}, dropping it", exc_info=True)
+                    self.dropped += 1
+                else:
+                    self.dispatch(msg)
+        finally:
+            del self.reducing[chat_id]
+
+    def dispatch(self, msg: IncomingMessage) -> None:
+        """
+        Send a received message to the worker of its chat.
+
+        :param msg: The received message.
+        """
+        shard = self.shards[shard_of(msg.chat_id, len(self.shards))]
+        try:
+            if shard is None:
+                raise BrokenPipeError()
+            shard.connection.send(("message", msg))
+        except OSError:
+            log.warning(f"Dropping message of {msg.chat_id}, as its worker isn't running")
+            self.dropped += 1
+        else:
+            self.dispatched += 1
+
+    def _send(self, shard: _Shard, item: tuple) -> None:
+        try:
+            shard.connection.send(item)
+        except OSError:
+            log.debug(f"Could not send {item[0]!r} to worker {shard.index}, as it isn't running anymore")
+
+    def _received(self, shard: _Shard, item: tuple) -> None:
+        kind, *args = item
+        if kind == "send":
+            asyncio.create_task(self._relay(shard, *args))
+        elif kind == "changed":
+            self.repository.apply_change(*args)
+            for other in self.shards:
+                if other is not None and other is not shard:
+                    self._send(other, item)
+        elif kind == "dialog":
+            chat_id, is_open = args
+            if is_open:
+                self.open_chats.add(chat_id)
+            else:
+                self.open_chats.discard(chat_id)
+        elif kind == "ready":
+            log.info(f"Worker {shard.index} is ready")
+            shard.ready = True
+        else:
+            log.warning(f"Received unknown item from worker {shard.index}: {item!r}")
+
+    async def _relay(self, shard: _Shard, call_id: int, entity: Entity, priority: Priority, kwargs: Dict[str, Any]):
+        try:
+            await self.sender.send_message(entity=entity, priority=priority, **kwargs)
+        except Exception as e:
+            # The exceptions of telethon can't always be pickled, so only their description is sent back
+            error = f"{e.__class__.__qualname__}: {e}"
+        else:
+            error = None
+        self.relayed += 1
+        self._send(shard, ("sent", call_id, error))
+
+    async def _supervise(self, index: int) -> NoReturn:
+        loop = asyncio.get_running_loop()
+        while True:
+            connection, child_connection = self.context.Pipe()
+            process = self.context.Process(
+                target=work,
+                args=(child_connection, self.username),
+                name=f"worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            child_connection.close()
+
+            shard = _Shard(index=index, process=process, connection=connection)
+            closed = loop.create_future()
+            threading.Thread(
+                target=_receive,
+                args=(connection, loop, functools.partial(self._received, shard), closed),
+                name=f"worker-{index}",
+                daemon=True,
+            ).start()
+            self.shards[index] = shard
+            log.debug(f"Started worker {index}: {process}")
+
+            await closed
+            self.shards[index] = None
+            # The Dialogs of the worker are gone with it
+            self.open_chats = {chat_id for chat_id in self.open_chats if shard_of(chat_id, len(self.shards)) != index}
+            connection.close()
+            await loop.run_in_executor(None, process.join, self.restart_delay)
+            if process.is_alive():
+                process.kill()
+            log.error(f"Worker {index} stopped with exit code {process.exitcode}, "
+                      f"restarting in {self.restart_delay} seconds...")
+            self.restarts += 1
+            await asyncio.sleep(self.restart_delay)
+
+    async def run(self) -> NoReturn:
+        """
+        Start the workers, and keep them running forever.
+        """
+        await asyncio.gather(*(self._supervise(index) for index in range(len(self.shards))))
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import time
+
+from royalnet.typing import *
+
+from .dialog import Dialog
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "DialogStore",
+)
+
+
+class DialogStore:
+    """
+    A bounded registry of the open Dialogs of the bot, keyed by chat id.
+
+    Dialogs idle for longer than the TTL are stopped by the sweeper, and the least recently used Dialog is stopped
+    whenever adding a new one would exceed the maximum size; evicted Dialogs keep their checkpoints, so that they can
+    be resumed by the next message of their chat.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 900):
+        """
+        Initialize a DialogStore object.
+
+        :param max_size: The maximum number of Dialogs that may be open at the same time.
+        :param ttl: The number of seconds after which an idle Dialog is stopped.
+        """
+        self.max_size: int = max_size
+        "The maximum number of Dialogs that may be open at the same time."
+
+        self.ttl: float = ttl
+        "The number of seconds after which an idle Dialog is stopped."
+
+        self.dialogs: collections.OrderedDict[int, Dialog] = collections.OrderedDict()
+        "The open Dialogs, from the least recently used to the most recently used."
+
+        self.evicted: int = 0
+        "The number of Dialogs stopped because the store was full."
+
+        self.expired: int = 0
+        "The number of Dialogs stopped because they were idle for too long."
+
+        self.on_change: Optional[Callable[[int, bool], None]] = None
+        "A function called with the id of a chat and whether it has an open Dialog, whenever that changes."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(size={len(self)}, {self.max_size=}, {self.evicted=}, {self.expired=})"
+
+    def __len__(self) -> int:
+        return len(self.dialogs)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self.dialogs
+
+    def get(self, chat_id: int) -> Optional[Dialog]:
+        """
+        Get the open Dialog of a chat, marking it as the most recently used.
+
+        :param chat_id: The id of the chat.
+        :return: The Dialog, or None if the chat has no open Dialog.
+        """
+        dialog = self.dialogs.get(chat_id)
+        if dialog is not None:
+            self.dialogs.move_to_end(chat_id)
+        return dialog
+
+    async def put(self, chat_id: int, dialog: Dialog) -> None:
+        """
+        Store the open Dialog of a chat, stopping the least recently used Dialogs if the store is full.
+
+        :param chat_id: The id of the chat.
+        :param dialog: The Dialog to store.
+        """
+        old_dialog = self.dialogs.pop(chat_id, None)
+        self.dialogs[chat_id] = dialog
+        if old_dialog is None:
+            self._changed(chat_id, True)
+        else:
+            await self._stop(old_dialog)
+        while len(self.dialogs) > self.max_size:
+            old_chat_id, old_dialog = self.dialogs.popitem(last=False)
+            log.debug(f"Evicting Dialog for {old_chat_id}")
+            self.evicted += 1
+            self._changed(old_chat_id, False)
+            await self._stop(old_dialog, keep_checkpoint=True)
+
+    def discard(self, chat_id: int, dialog: Dialog) -> None:
+        """
+        Remove a Dialog which has already closed by itself from the store.
+
+        :param chat_id: The id of the chat.
+        :param dialog: The Dialog to remove; if the chat has a different Dialog open, nothing is removed.
+        """
+        if self.dialogs.get(chat_id) is dialog:
+            del self.dialogs[chat_id]
+            self._changed(chat_id, False)
+
+    async def stop(self, chat_id: int) -> None:
+        """
+        Stop the open Dialog of a chat, if there is one, and remove it from the store.
+
+        :param chat_id: The id of the chat.
+        """
+        dialog = self.dialogs.pop(chat_id, None)
+        if dialog is not None:
+            self._changed(chat_id, False)
+            await self._stop(dialog)
+
+    def _changed(self, chat_id: int, is_open: bool) -> None:
+        if self.on_change is not None:
+            self.on_change(chat_id, is_open)
+
+    @staticmethod
+    async def _stop(dialog: Dialog, keep_checkpoint: bool = False) -> None:
+        # noinspection PyBroadException
+        try:
+            await dialog.stop(keep_checkpoint=keep_checkpoint)
+        except Exception:
+            log.warning(f"Could not stop {dialog} cleanly", exc_info=True)
+
+    async def sweep(self) -> None:
+        """
+        Stop all the Dialogs which have been idle for longer than the TTL.
+        """
+        deadline = time.monotonic() - self.ttl
+        while self.dialogs:
+            chat_id, dialog = next(iter(self.dialogs.items()))
+            # Dialogs are kept in order of use, so all the following ones are more recent
+            if dialog.last_activity >= deadline:
+                break
+            log.debug(f"Expiring Dialog for {chat_id}")
+            del self.dialogs[chat_id]
+            self.expired += 1
+            self._changed(chat_id, False)
+            await self._stop(dialog)
+
+    async def run_sweeper(self, interval: Optional[float] = None) -> NoReturn:
+        """
+        Sweep the store forever.
+
+        :param interval: The number of seconds to wait between two sweeps; defaults to a quarter of the TTL.
+        """
+        interval = interval or self.ttl / 4
+        while True:
+            await asyncio.sleep(interval)
+            await self.sweep()
+            log.debug(f"Swept dialogs: {self}")
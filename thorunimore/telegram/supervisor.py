@@ -0,0 +1,189 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+
+import telethon
+import telethon.tl.types
+import telethon.utils
+from royalnet.typing import *
+
+from ..ttlcache import MISSING, TTLCache
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "Supervisor",
+)
+
+
+class Supervisor:
+    """
+    Keep the bot connected, reconnecting with an exponential backoff and catching up on the updates missed while it
+    was disconnected.
+
+    Catch-up replays the missed updates through the usual event handlers, and may replay some which were already
+    received live: the handlers registered with :meth:`on` skip the updates they have already processed, and run at
+    most ``concurrency`` at a time, so that a long backlog is processed in parallel without flooding the database.
+    """
+
+    def __init__(self,
+                 bot: telethon.TelegramClient,
+                 min_delay: float = 1.0,
+                 max_delay: float = 300.0,
+                 catch_up_timeout: float = 120.0,
+                 concurrency: int = 16,
+                 seen: Optional[TTLCache] = None,
+                 rng: Optional[random.Random] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize a Supervisor object.
+
+        :param bot: The connected client of the bot.
+        :param min_delay: The number of seconds to wait before the first reconnection attempt.
+        :param max_delay: The maximum number of seconds to wait between two reconnection attempts; a connection which
+                          lasted longer than this resets the backoff.
+        :param catch_up_timeout: The maximum number of seconds to spend fetching the missed updates.
+        :param concurrency: The maximum number of handlers running at the same time.
+        :param seen: The cache of the updates already processed by each handler.
+        :param rng: The random number generator used for the jitter.
+        :param clock: The function used to get the current time.
+        """
+        self.bot: telethon.TelegramClient = bot
+        self.min_delay: float = min_delay
+        self.max_delay: float = max_delay
+        self.catch_up_timeout: float = catch_up_timeout
+        self.concurrency: int = concurrency
+        self.seen: TTLCache = seen if seen is not None else TTLCache(max_size=10000, ttl=3600)
+        self.rng: random.Random = rng or random.Random()
+        self.clock: Callable[[], float] = clock
+
+        self.semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+        "The semaphore limiting the number of handlers running at the same time."
+
+        self.reconnections: int = 0
+        "The number of times the bot reconnected."
+
+        self.duplicates: int = 0
+        "The number of updates skipped because a handler had already processed them."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}({self.reconnections=}, {self.duplicates=}, seen={len(self.seen)})"
+
+    @staticmethod
+    def update_key(update: telethon.tl.TLObject) -> Optional[Hashable]:
+        """
+        Find a key identifying an update, which stays the same when the update is replayed by catch-up.
+
+        New messages are identified by their chat and id, as catch-up wraps them in updates without a ``pts``;
+        participant updates by their ``qts``.
+
+        :param update: The raw update.
+        :return: The key, or None if the update can't be identified.
+        """
+        if isinstance(update, (telethon.tl.types.UpdateNewMessage, telethon.tl.types.UpdateNewChannelMessage)):
+            message = update.message
+            if isinstance(message, telethon.tl.types.MessageEmpty):
+                return None
+            return "message", telethon.utils.get_peer_id(message.peer_id), message.id
+        if isinstance(update, telethon.tl.types.UpdateShortMessage):
+            return "message", update.user_id, update.id
+        if isinstance(update, telethon.tl.types.UpdateShortChatMessage):
+            return "message", telethon.utils.get_peer_id(telethon.tl.types.PeerChat(update.chat_id)), update.id
+        qts = getattr(update, "qts", None)
+        if qts:
+            return "qts", qts
+        return None
+
+    def on(self, event: telethon.events.common.EventBuilder, limited: bool = True) -> Callable[[Callable], Callable]:
+        """
+        Register a handler for an event with the bot, making it skip the updates it has already processed and limiting
+        how many handlers run at the same time.
+
+        :param event: The event the handler should be called for.
+        :param limited: Whether the handler should wait for the semaphore; handlers which only hand the updates off
+                        shouldn't, as waiting may start them in a different order than the updates were received in.
+        :return: A decorator registering the handler.
+        """
+        def decorator(handler: Callable[[Any], Awaitable[None]]) -> Callable:
+            @functools.wraps(handler)
+            async def supervised(ev) -> None:
+                key = self.update_key(ev.original_update)
+                if key is not None:
+                    key = (handler.__qualname__, key)
+                    if self.seen.get(key) is not MISSING:
+                        log.debug(f"Skipping update already processed by {handler.__qualname__}: {key}")
+                        self.duplicates += 1
+                        return
+                    self.seen.set(key, True)
+                if not limited:
+                    await handler(ev)
+                    return
+                async with self.semaphore:
+                    await handler(ev)
+
+            self.bot.add_event_handler(supervised, event)
+            return supervised
+
+        return decorator
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Compute how long to wait before a reconnection attempt, with an exponential backoff and full jitter.
+
+        :param attempt: The number of attempts which already failed in a row.
+        :return: The number of seconds to wait.
+        """
+        return self.rng.uniform(0, min(self.max_delay, self.min_delay * 2 ** min(attempt, 32)))
+
+    async def catch_up(self) -> None:
+        """
+        Fetch the updates missed while the bot was disconnected, giving up after :attr:`catch_up_timeout` seconds.
+
+        The fetched updates are dispatched to the handlers in the background.
+        """
+        log.info("Catching up...")
+        start = self.clock()
+        try:
+            await asyncio.wait_for(self.bot.catch_up(), timeout=self.catch_up_timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"Catch-up didn't finish in {self.catch_up_timeout} seconds, some updates may have been missed")
+        except Exception:
+            log.error("Unexpected error while catching up", exc_info=True)
+        else:
+            log.info(f"Caught up in {self.clock() - start:.2f} seconds")
+
+    async def run(self) -> NoReturn:
+        """
+        Run the bot forever, reconnecting and catching up every time it is disconnected.
+        """
+        attempt = 0
+        while True:
+            if not self.bot.is_connected():
+                try:
+                    await self.bot.connect()
+                except Exception as e:
+                    delay = self.backoff(attempt)
+                    attempt += 1
+                    log.error(f"Reconnection failed ({e!r})... Retrying in {delay:.1f} seconds.")
+                    await asyncio.sleep(delay)
+                    continue
+                self.reconnections += 1
+
+            await self.catch_up()
+
+            log.info(f"Running!")
+            connected_at = self.clock()
+            try:
+                # noinspection PyProtectedMember
+                await self.bot._run_until_disconnected()
+            except Exception as e:
+                log.error(f"Disconnected with an error: {e!r}")
+
+            if self.clock() - connected_at >= self.max_delay:
+                attempt = 0
+            delay = self.backoff(attempt)
+            attempt += 1
+            log.error(f"Disconnected... Retrying in {delay:.1f} seconds.")
+            await asyncio.sleep(delay)
@@ -0,0 +1,129 @@
+import array
+import bisect
+import logging
+import time
+
+import sqlalchemy
+import sqlalchemy.orm
+from royalnet.typing import *
+
+from ..database import Telegram
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "VerifiedIndex",
+)
+
+
+class VerifiedIndex:
+    """
+    A compact in-memory set of the ids of all the registered Telegram accounts, to decide whether an account is
+    verified without querying the database.
+
+    Ids are kept in a sorted ``array('q')``, taking 8 bytes each, and looked up with a binary search.
+
+    The index is loaded with a single streaming query, and kept up to date by the :class:`Repository` as accounts are
+    registered; changes made by other processes are picked up by reloading it periodically. An index which hasn't
+    been reloaded for longer than :attr:`max_age` is stale, and should not be trusted.
+    """
+
+    def __init__(self, max_age: float = 900, clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize an empty, stale VerifiedIndex object.
+
+        :param max_age: The number of seconds after its last load after which the index becomes stale.
+        :param clock: The function used to get the current time.
+        """
+        self.max_age: float = max_age
+        self.clock: Callable[[], float] = clock
+
+        self.ids: array.array = array.array("q")
+        "The sorted ids of the registered accounts."
+
+        self.loaded_at: Optional[float] = None
+        "The time the index was last loaded at, or None if it was never loaded."
+
+        self.journal: Optional[List[int]] = None
+        "The ids added while a load is in progress, to be added to the loaded ids too, or None if none is."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(size={len(self)}, {self.fresh=}, nbytes={self.nbytes})"
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, tg_id: int) -> bool:
+        index = bisect.bisect_left(self.ids, tg_id)
+        return index < len(self.ids) and self.ids[index] == tg_id
+
+    @property
+    def fresh(self) -> bool:
+        """
+        :return: Whether the index has been loaded recently enough to be trusted.
+        """
+        return self.loaded_at is not None and self.clock() - self.loaded_at < self.max_age
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: The number of bytes taken by the ids.
+        """
+        return self.ids.itemsize * len(self.ids)
+
+    def add(self, tg_id: int) -> None:
+        """
+        Add the id of a newly registered account to the index.
+
+        :param tg_id: The Telegram id of the account.
+        """
+        if self.journal is not None:
+            self.journal.append(tg_id)
+        self._add(self.ids, tg_id)
+
+    @staticmethod
+    def _add(ids: array.array, tg_id: int) -> None:
+        index = bisect.bisect_left(ids, tg_id)
+        if index == len(ids) or ids[index] != tg_id:
+            ids.insert(index, tg_id)
+
+    @staticmethod
+    def load(session: sqlalchemy.orm.Session, batch_size: int = 10000) -> array.array:
+        """
+        Fetch the sorted ids of all the registered accounts, streaming them from the database in batches.
+
+        :param session: The Session to query with.
+        :param batch_size: The number of rows to fetch at a time.
+        :return: The sorted ids.
+        """
+        ids = array.array("q")
+        result = session.execute(
+            sqlalchemy.select(Telegram.id).order_by(Telegram.id).execution_options(stream_results=True)
+        )
+        for batch in result.scalars().partitions(batch_size):
+            ids.extend(batch)
+        return ids
+
+    def begin_load(self) -> None:
+        """
+        Start recording the ids added to the index, so that they aren't lost when the ids being loaded replace it.
+        """
+        self.journal = []
+
+    def finish_load(self, ids: array.array) -> None:
+        """
+        Replace the ids of the index with freshly loaded ones, adding the ids added since :meth:`begin_load`.
+
+        :param ids: The ids returned by :meth:`load`.
+        """
+        for tg_id in self.journal or ():
+            self._add(ids, tg_id)
+        self.journal = None
+        self.ids = ids
+        self.loaded_at = self.clock()
+
+    def abort_load(self) -> None:
+        """
+        Stop recording the ids added to the index, as the load failed.
+        """
+        self.journal = None
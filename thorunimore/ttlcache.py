@@ -0,0 +1,122 @@
+import collections
+import time
+
+from royalnet.typing import *
+
+__all__ = (
+    "MISSING",
+    "TTLCache",
+)
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+MISSING = object()
+"""Sentinel returned by :meth:`TTLCache.get` when a key isn't cached, as None is a valid cached value."""
+
+
+class TTLCache(Generic[K, V]):
+    """
+    A size-bounded in-memory cache, whose entries expire after a fixed amount of time.
+
+    When full, the least recently used entry is evicted to make room for the new one.
+    It is not thread-safe.
+    """
+
+    def __init__(self, max_size: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize a TTLCache object.
+
+        :param max_size: The maximum number of entries in the cache.
+        :param ttl: The number of seconds after which an entry expires.
+        :param clock: The function used to get the current time.
+        """
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self.clock: Callable[[], float] = clock
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        "The cached entries, as tuples of expiration time and value, from the least to the most recently used."
+
+        self.hits: int = 0
+        "The number of lookups which found a cached value."
+
+        self.misses: int = 0
+        "The number of lookups which found no cached value, or an expired one."
+
+        self.evictions: int = 0
+        "The number of entries removed to make room for new ones."
+
+        self.version: int = 0
+        "The number of invalidations so far; values read before an invalidation are stale."
+
+        self.invalidations: collections.OrderedDict = collections.OrderedDict()
+        "The version each recently invalidated key was last invalidated at, from the least to the most recent."
+
+        self.horizon: int = 0
+        "The most recent version no longer in :attr:`invalidations`; values read before it may be stale."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(size={len(self)}, {self.hits=}, {self.misses=}, {self.evictions=})"
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: K, default: Any = MISSING) -> Union[V, Any]:
+        """
+        Get the cached value of a key.
+
+        :param key: The key to look up.
+        :param default: The object to return if the key isn't cached.
+        :return: The cached value, or the default.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires, value = entry
+        if expires <= self.clock():
+            del self.entries[key]
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V, since: Optional[int] = None) -> None:
+        """
+        Cache the value of a key, evicting the least recently used entries if the cache is full.
+
+        :param key: The key to cache.
+        :param value: The value to cache for the key.
+        :param since: The :attr:`version` of the cache when the value started being read; if the key may have been
+                      invalidated after it, the value is stale and isn't cached.
+        """
+        if since is not None and (since < self.horizon or self.invalidations.get(key, since) > since):
+            return
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: K) -> None:
+        """
+        Remove a key from the cache, if it is cached.
+
+        :param key: The key to remove.
+        """
+        self.entries.pop(key, None)
+        self.version += 1
+        self.invalidations[key] = self.version
+        self.invalidations.move_to_end(key)
+        while len(self.invalidations) > self.max_size:
+            _, self.horizon = self.invalidations.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Remove all the entries from the cache.
+        """
+        self.entries.clear()
+        self.version += 1
+        self.invalidations.clear()
+        self.horizon = self.version
@@ -1,26 +1,70 @@
+import json
+import logging
 import os
-import re
+import tempfile
+import time
 
 import authlib.integrations.base_client
 import authlib.integrations.flask_client
 import flask
 import flask_sqlalchemy
+import requests
+import werkzeug.exceptions
 import werkzeug.middleware.proxy_fix
 from royalnet.typing import *
 
 from ..database import Student, Token, Telegram
 from ..database.base import Base
+from ..database.engine import engine_options, PoolStats
+from ..database.loading import telegram_student
+from ..database.migrations import prepare
 from ..deeplinking import DeepLinking
+from ..policies import PolicyRegistry, default_policy
+from .discovery import DiscoveryCache
+from .ratelimit import SlidingWindowLimiter, backend_from_url
+from .server import Server, server_options, precompile_templates
+from .tokens import TokenRegistry
 
+log = logging.getLogger(__name__)
 
 app = flask.Flask(__name__)
 app.config.update(**os.environ)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
 
 # noinspection PyArgumentEqualDefault
 reverse_proxy_app = werkzeug.middleware.proxy_fix.ProxyFix(app=app, x_for=1, x_proto=1, x_host=1, x_port=0, x_prefix=0)
 
 db = flask_sqlalchemy.SQLAlchemy(app=app, metadata=Base.metadata)
-db.create_all()
+pool_stats = PoolStats()
+pool_stats.attach(db.engine)
+prepare(
+    db.engine,
+    auto_migrate=os.environ.get("DATABASE_AUTO_MIGRATE", "false").lower() in ("1", "true", "yes"),
+)
+
+api_tokens = TokenRegistry(
+    load=lambda: db.session.query(Token.id, Token.token, Token.rate_limit).filter_by(revoked=False).all(),
+    refresh_interval=float(app.config.get("API_TOKENS_REFRESH", 60)),
+)
+with app.app_context():
+    api_tokens.refresh()
+api_tokens.start(context=app.app_context)
+
+policies = PolicyRegistry(
+    default=default_policy(app.config),
+    refresh_interval=float(app.config.get("POLICY_REFRESH", 60)),
+)
+with app.app_context():
+    policies.refresh(db.session)
+policies.start(db.session, context=app.app_context)
+
+rate_limiter = SlidingWindowLimiter(
+    backend=backend_from_url(app.config.get(
+        "API_RATE_BACKEND",
+        f"sqlite:{os.path.join(tempfile.gettempdir(), 'thorunimore-ratelimit.sqlite')}",
+    )),
+    window=float(app.config.get("API_RATE_WINDOW", 60)),
+)
 
 oauth = authlib.integrations.flask_client.OAuth(app=app)
 oauth.register(
@@ -32,7 +76,21 @@ oauth.register(
     },
 )
 
-dl = DeepLinking(app.secret_key)
+discovery = DiscoveryCache(
+    metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+    path=app.config.get("OIDC_CACHE_PATH", os.path.join(tempfile.gettempdir(), "thorunimore-google-oidc.json")),
+)
+if "OIDC_FIXTURE" in app.config:
+    discovery.seed(app.config["OIDC_FIXTURE"])
+discovery.attach(oauth.google)
+try:
+    discovery.load()
+except requests.RequestException as e:
+    # Authlib will fetch the documents by itself when they are first needed
+    log.warning(f"Could not warm the OpenID discovery cache: {e!r}")
+discovery.start()
+
+dl = DeepLinking(app.secret_key, max_age=int(app.config.get("DEEPLINK_TTL", 3600)))
 
 
 @app.route("/")
@@ -72,24 +130,32 @@ def page_authorize():
             tip='Probabilmente hai effettuato l\'accesso con l\'email sbagliata. Fai il '
                 '<a href="https://accounts.google.com/logout">logout</a> da tutti i tuoi account Google e riprova!'
         ), 403
-    email_prefix_match = re.match(r"(.+)@studenti\.unimore\.it", userinfo.email)
-    if not email_prefix_match:
+    email_prefix, _, domain = userinfo.email.rpartition("@")
+    domain = domain.lower()
+    if not email_prefix or domain not in policies.domains():
         return flask.render_template(
             "error.html",
-            error="Questo account Google non appartiene a Studenti Unimore Informatica.",
+            error="Questo account Google non appartiene a nessuno dei domini ammessi.",
             tip='Probabilmente hai effettuato l\'accesso con l\'email sbagliata. Fai il '
                 '<a href="https://accounts.google.com/logout">logout</a> da tutti i tuoi account Google e riprova!',
         ), 403
-    email_prefix = email_prefix_match.group(1)
 
     student: Optional[Student] = db.session.query(Student).filter_by(email_prefix=email_prefix).one_or_none()
     if student is None:
         student = Student(
             email_prefix=email_prefix,
+            domain=domain,
             first_name=userinfo.given_name,
             last_name=userinfo.family_name
         )
         db.session.add(student)
+    elif student.domain != domain:
+        # Students are identified by the part of their email before the @, which must not be shared across domains
+        return flask.render_template(
+            "error.html",
+            error="Un altro studente con lo stesso nome utente, ma un dominio email diverso, è già registrato.",
+            tip='Contatta <a href="https://t.me/Steffo">@Steffo</a> per risolvere il problema!',
+        ), 409
     else:
         student.first_name = userinfo.given_name
         student.last_name = userinfo.family_name
@@ -107,28 +173,117 @@ def page_privacy():
     return flask.render_template("privacy.html")
 
 
-@app.route("/api/<token>/whois/<int:tg_id>")
-def api_whois(token: str, tg_id: int):
-    token = db.session.query(Token).filter_by(token=token).one_or_none()
-    if token is None:
-        return flask.jsonify({
+def _rate_limit(key: str, limit: int, cost: int = 1) -> Optional[flask.Response]:
+    """
+    Count an API request towards a rate limit, remembering the most restrictive one for the response headers.
+
+    :param key: The key the limit applies to.
+    :param limit: How many requests are allowed every window.
+    :param cost: How many requests the current one counts as.
+    :return: None if the limit wasn't exceeded, or the error response to return otherwise.
+    """
+    result = rate_limiter.hit(key, limit, cost)
+    current = flask.g.get("rate_limit")
+    if current is None or not result.allowed or (current.allowed and result.remaining < current.remaining):
+        flask.g.rate_limit = result
+    if not result.allowed:
+        response = flask.make_response(flask.jsonify({
+            "description": "Rate limit exceeded",
+        }), 429)
+        response.headers["Retry-After"] = str(result.retry_after)
+        return response
+    return None
+
+
+@app.after_request
+def _rate_limit_headers(response: flask.Response) -> flask.Response:
+    if (result := flask.g.get("rate_limit")) is not None:
+        response.headers["RateLimit-Limit"] = str(result.limit)
+        response.headers["RateLimit-Remaining"] = str(result.remaining)
+        response.headers["RateLimit-Reset"] = str(result.reset)
+    return response
+
+
+stats_reported: float = time.monotonic()
+"""When the statistics of this process were last logged."""
+
+
+@app.after_request
+def _report_stats(response: flask.Response) -> flask.Response:
+    # Every worker process logs its own statistics, at most once a minute, without needing a thread of its own
+    global stats_reported
+    now = time.monotonic()
+    if now - stats_reported >= 60:
+        stats_reported = now
+        log.debug(f"Statistics: {pool_stats}, {api_tokens}, {policies}")
+    return response
+
+
+def _check_client() -> Optional[flask.Response]:
+    """
+    Check that the IP address of the client hasn't exceeded its rate limit, whichever token it uses.
+
+    :return: None if the client can continue, or the error response to return otherwise.
+    """
+    return _rate_limit(f"ip:{flask.request.remote_addr}", int(app.config.get("API_IP_RATE_LIMIT", 1200)))
+
+
+def _check_token(token: str) -> Optional[flask.Response]:
+    """
+    Check that an API token is valid, without querying the database, and remember it for :func:`_check_quota`.
+
+    :param token: The token to check.
+    :return: None if the token is valid, or the error response to return otherwise.
+    """
+    registered = api_tokens.validate(token)
+    if registered is None:
+        return flask.make_response(flask.jsonify({
             "description": "Invalid token",
-        }), 403
+        }), 403)
+    flask.g.token = registered
+    return None
+
+
+def _token_limit() -> int:
+    """
+    :return: How many requests the token validated by :func:`_check_token` may make every window.
+    """
+    limit = flask.g.token.rate_limit
+    if limit is None:
+        limit = int(app.config.get("API_RATE_LIMIT", 600))
+    return limit
+
+
+def _check_quota(cost: int = 1) -> Optional[flask.Response]:
+    """
+    Check that the token validated by :func:`_check_token` hasn't exceeded its own rate limit.
+
+    :param cost: How many requests the current one counts as.
+    :return: None if the token can continue, or the error response to return otherwise.
+    """
+    return _rate_limit(f"token:{flask.g.token.id}", _token_limit(), cost)
+
 
-    tg = db.session.query(Telegram).filter_by(id=tg_id).one_or_none()
+def _whois_payload(tg: Optional[Telegram]) -> Tuple[Dict[str, JSON], int]:
+    """
+    Build the API response about a Telegram account, respecting the privacy settings of its student.
+
+    :param tg: The Telegram account, or None if it wasn't found.
+    :return: The JSON payload and the HTTP status code.
+    """
     if tg is None:
-        return flask.jsonify({
+        return {
             "description": "User was not found in Thor's database",
             "found": False,
-        }), 404
+        }, 404
 
     if tg.st.privacy:
-        return flask.jsonify({
+        return {
             "description": "User has a private profile in Thor's database",
             "found": True,
-        }), 200
+        }, 200
 
-    return flask.jsonify({
+    return {
         "description": "User has a public profile in Thor's database",
         "found": True,
         "tg": {
@@ -137,15 +292,126 @@ def api_whois(token: str, tg_id: int):
             "username": tg.username,
         },
         "st": {
-            "email": f"{tg.st.email_prefix}@studenti.unimore.it",
+            "email": tg.st.email(),
             "first_name": tg.st.first_name,
             "last_name": tg.st.last_name,
         }
-    }), 200
+    }, 200
+
+
+def _whois_etag(tg: Optional[Telegram]) -> Optional[str]:
+    """
+    Build the ETag of the API response about a Telegram account, which changes whenever the account or its student do.
+
+    :param tg: The Telegram account, or None if it wasn't found.
+    :return: The ETag, or None if the account wasn't found.
+    """
+    if tg is None:
+        return None
+    return f"{tg.id}-{tg.version}-{tg.st.version}"
+
+
+@app.route("/api/<token>/whois/<int:tg_id>")
+def api_whois(token: str, tg_id: int):
+    if error := _check_client() or _check_token(token) or _check_quota():
+        return error
+
+    tg = db.session.query(Telegram).options(telegram_student()).filter_by(id=tg_id).one_or_none()
+    etag = _whois_etag(tg)
+    if etag is not None and flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        payload, status = _whois_payload(tg)
+        response = flask.make_response(flask.jsonify(payload), status)
+
+    if etag is not None:
+        response.set_etag(etag)
+    # Caches may store the response, but must revalidate it every time, so that privacy changes apply immediately
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _batch_ids() -> List[int]:
+    """
+    Read the Telegram ids requested in the body of a batch API request.
+
+    The body can be either a JSON object with an ``ids`` list, or NDJSON with one id per line.
+
+    Batches can't be bigger than the rate limit of the token, as every id counts as a request and they could never be
+    allowed.
+
+    :return: The requested ids, without duplicates, in the order they were requested.
+    :raises werkzeug.exceptions.HTTPException: If the body is invalid, or contains too many ids.
+    """
+    limit = min(int(app.config.get("API_BATCH_LIMIT", 1000)), _token_limit())
+
+    if flask.request.mimetype == "application/x-ndjson":
+        values = []
+        for line in flask.request.stream:
+            if not line.strip():
+                continue
+            if len(values) >= limit:
+                flask.abort(413, f"At most {limit} ids can be requested at once")
+            try:
+                values.append(json.loads(line))
+            except ValueError:
+                flask.abort(400, "Invalid NDJSON line")
+    else:
+        body = flask.request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get("ids"), list):
+            flask.abort(400, "The body should be a JSON object with an ids list")
+        values = body["ids"]
+        if len(values) > limit:
+            flask.abort(413, f"At most {limit} ids can be requested at once")
+
+    if not all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+        flask.abort(400, "Telegram ids should be integers")
+    return list(dict.fromkeys(values))
+
+
+@app.route("/api/<token>/whois", methods=["POST"])
+def api_whois_batch(token: str):
+    if error := _check_client() or _check_token(token):
+        return error
+
+    try:
+        tg_ids = _batch_ids()
+    except werkzeug.exceptions.HTTPException as e:
+        return flask.jsonify({
+            "description": e.description,
+        }), e.code
+    # Every requested id counts as a request, so that batches don't bypass the quota
+    if error := _check_quota(max(1, len(tg_ids))):
+        return error
+
+    tgs = db.session.query(Telegram).options(telegram_student()).filter(Telegram.id.in_(tg_ids)).all()
+    found = {tg.id: tg for tg in tgs}
+
+    def generate():
+        for tg_id in tg_ids:
+            payload, _ = _whois_payload(found.get(tg_id))
+            yield json.dumps({"id": tg_id, **payload}) + "\n"
+
+    return flask.Response(generate(), mimetype="application/x-ndjson")
+
+
+def _post_fork(_server, _worker) -> None:
+    # Connections and threads inherited from the master process can't be used by the worker
+    db.engine.dispose(close=False)
+    discovery.start()
+    api_tokens.start(context=app.app_context)
+    policies.start(db.session, context=app.app_context)
 
 
 def main():
-    app.run()
+    if app.config.get("WEB_SERVER", "gunicorn") == "flask":
+        app.run()
+        return
+
+    precompile_templates(app)
+    db.engine.dispose()
+    Server(reverse_proxy_app, options={**server_options(), "post_fork": _post_fork}).run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+import email.utils
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import requests
+from royalnet.typing import *
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "DiscoveryCache",
+)
+
+
+class DiscoveryCache:
+    """
+    A cache of the OpenID Connect discovery document of a provider and of its signing keys (JWKS), stored in a file so
+    that it is shared by all the processes using it, and injected in Authlib clients so that they never have to fetch
+    them while handling a request.
+
+    The cache file contains a JSON object with the ``metadata``, the ``jwks``, and the UNIX time they ``expires`` at,
+    as told by the HTTP cache headers of the provider.
+    """
+
+    def __init__(self,
+                 metadata_url: str,
+                 path: str,
+                 default_ttl: float = 3600,
+                 min_ttl: float = 60,
+                 timeout: float = 10,
+                 clock: Callable[[], float] = time.time):
+        """
+        Initialize a DiscoveryCache object; it will be empty until it is loaded or seeded.
+
+        :param metadata_url: The URL of the discovery document.
+        :param path: The path of the cache file.
+        :param default_ttl: For how many seconds the documents are fresh if the provider doesn't say.
+        :param min_ttl: The minimum number of seconds between two fetches, and how long before expiring the documents
+                        are refreshed.
+        :param timeout: The timeout in seconds of the requests to the provider.
+        :param clock: The function used to get the current time; it must be the same in all processes.
+        """
+        self.metadata_url: str = metadata_url
+        self.path: str = path
+        self.default_ttl: float = default_ttl
+        self.min_ttl: float = min_ttl
+        self.timeout: float = timeout
+        self.clock: Callable[[], float] = clock
+
+        self.document: Optional[Dict[str, Any]] = None
+        "The documents currently in use, in the same format as the cache file."
+
+        self.seeded: bool = False
+        "Whether the documents come from a fixture, in which case they are never refreshed."
+
+        self.clients: List[Any] = []
+        "The Authlib clients the documents are injected into."
+
+        self._next_refresh: float = 0
+        self._stopped: threading.Event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __repr__(self):
+        expires = self.document["expires"] if self.document else None
+        return f"{self.__class__.__qualname__}({self.metadata_url=}, {self.path=}, {expires=}, {self.seeded=})"
+
+    def attach(self, client) -> None:
+        """
+        Inject the documents in an Authlib client, now and every time they are refreshed.
+
+        :param client: The client, such as ``oauth.google``.
+        """
+        self.clients.append(client)
+        if self.document is not None:
+            self._inject(client, self.document)
+
+    def seed(self, fixture: str) -> None:
+        """
+        Use the documents contained in a fixture file instead of the ones of the provider, so that the OAuth flow can
+        be tested without network access.
+
+        :param fixture: The path of a JSON file with the ``metadata`` and the ``jwks``.
+        """
+        with open(fixture) as file:
+            data = json.load(file)
+        self.seeded = True
+        self._use({"metadata": data["metadata"], "jwks": data["jwks"], "expires": float("inf")})
+
+    def load(self) -> None:
+        """
+        Use the documents in the cache file if they are fresh, or fetch them from the provider and update the file.
+
+        If the provider can't be reached, the stale documents are kept in use.
+
+        :raises requests.RequestException: If the provider can't be reached, and no documents are available.
+        """
+        if self.seeded:
+            return
+        document = self._read()
+        if document is None or document["expires"] - self.min_ttl <= self.clock():
+            try:
+                document = self._fetch()
+            except (requests.RequestException, ValueError) as e:
+                document = document or self.document
+                if document is None:
+                    raise
+                log.warning(f"Could not refresh the OpenID discovery document, keeping the stale one: {e!r}")
+                self._use(document)
+                self._next_refresh = self.clock() + self.min_ttl
+                return
+            self._write(document)
+        self._use(document)
+        self._next_refresh = document["expires"] - self.min_ttl
+
+    def start(self) -> None:
+        """
+        Start refreshing the documents in a background thread, shortly before they expire.
+
+        The thread doesn't survive a fork, so processes forked after starting it have to start it again.
+        """
+        if self.seeded or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="discovery-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background thread started by :meth:`start`.
+        """
+        self._stopped.set()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(max(1.0, self._next_refresh - self.clock())):
+            try:
+                self.load()
+            except Exception as e:
+                log.error(f"Could not fetch the OpenID discovery document: {e!r}")
+                self._next_refresh = self.clock() + self.min_ttl
+
+    def _fetch(self) -> Dict[str, Any]:
+        log.debug(f"Fetching the OpenID discovery document: {self.metadata_url}")
+        response = requests.get(self.metadata_url, timeout=self.timeout)
+        response.raise_for_status()
+        metadata = response.json()
+        expires = self.clock() + self._lifetime(response)
+
+        response = requests.get(metadata["jwks_uri"], timeout=self.timeout)
+        response.raise_for_status()
+        jwks = response.json()
+        expires = min(expires, self.clock() + self._lifetime(response))
+
+        return {"metadata": metadata, "jwks": jwks, "expires": expires}
+
+    def _lifetime(self, response: requests.Response) -> float:
+        cache_control = response.headers.get("Cache-Control", "").lower()
+        if "no-store" in cache_control or "no-cache" in cache_control:
+            return self.min_ttl
+        if match := re.search(r"max-age=(\d+)", cache_control):
+            lifetime = int(match.group(1)) - int(response.headers.get("Age", 0))
+        elif "Expires" in response.headers:
+            try:
+                expires = email.utils.parsedate_to_datetime(response.headers["Expires"])
+                date = email.utils.parsedate_to_datetime(response.headers["Date"]) if "Date" in response.headers \
+                    else None
+            except (TypeError, ValueError):
+                return self.min_ttl
+            lifetime = expires.timestamp() - (date.timestamp() if date else self.clock())
+        else:
+            lifetime = self.default_ttl
+        return max(self.min_ttl, lifetime)
+
+    def _read(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable OpenID discovery cache {self.path}: {e!r}")
+            return None
+
+    def _write(self, document: Dict[str, Any]) -> None:
+        # Write to a temporary file and rename it, so that other processes never read a partially written file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, temporary = tempfile.mkstemp(dir=directory, prefix=".discovery-")
+            with os.fdopen(fd, "w") as file:
+                json.dump(document, file)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            log.warning(f"Could not write the OpenID discovery cache {self.path}: {e!r}")
+
+    def _use(self, document: Dict[str, Any]) -> None:
+        self.document = document
+        for client in self.clients:
+            self._inject(client, document)
+
+    @staticmethod
+    def _inject(client, document: Dict[str, Any]) -> None:
+        # Authlib skips fetching the metadata if _loaded_at is set, and the keys if jwks is set
+        client.server_metadata.update(document["metadata"])
+        client.server_metadata["jwks"] = document["jwks"]
+        client.server_metadata["_loaded_at"] = time.time()
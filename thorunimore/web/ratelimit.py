@@ -0,0 +1,202 @@
+import abc
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from royalnet.typing import *
+
+__all__ = (
+    "RateLimitBackend",
+    "MemoryBackend",
+    "SQLiteBackend",
+    "RateLimit",
+    "SlidingWindowLimiter",
+    "backend_from_url",
+)
+
+
+class RateLimitBackend(metaclass=abc.ABCMeta):
+    """
+    A storage for the hit counters of a :class:`SlidingWindowLimiter`, divided in fixed windows.
+    """
+
+    @abc.abstractmethod
+    def hit(self, key: str, window: int, cost: int, allow: Callable[[int, int], bool]) -> Tuple[int, int, bool]:
+        """
+        Atomically add hits to the counter of a key in a window, if they are allowed.
+
+        :param key: The key being limited.
+        :param window: The number of the current window.
+        :param cost: The number of hits to add.
+        :param allow: A function deciding whether the hits are allowed, given the hits of the key in the previous
+                      window, and in the current window including the new ones.
+        :return: The hits of the key in the previous window, in the current window including the new ones only if
+                 they were allowed, and whether they were.
+        """
+        raise NotImplementedError()
+
+
+class MemoryBackend(RateLimitBackend):
+    """
+    A backend keeping the counters in the memory of the process; they are not shared with other processes.
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, Dict[int, int]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def hit(self, key: str, window: int, cost: int, allow: Callable[[int, int], bool]) -> Tuple[int, int, bool]:
+        with self._lock:
+            windows = self.counters.setdefault(key, {})
+            for old in [old for old in windows if old < window - 1]:
+                del windows[old]
+            previous, current = windows.get(window - 1, 0), windows.get(window, 0)
+            if not allow(previous, current + cost):
+                return previous, current, False
+            windows[window] = current + cost
+            return previous, current + cost, True
+
+
+class SQLiteBackend(RateLimitBackend):
+    """
+    A backend keeping the counters in a SQLite database file, so that they are shared by all the processes using it,
+    such as the workers of a gunicorn server.
+    """
+
+    CLEANUP_EVERY = 1000
+    """After how many hits the counters of the expired windows are deleted."""
+
+    def __init__(self, path: str):
+        """
+        Initialize a SQLiteBackend object.
+
+        :param path: The path of the database file; it is created if it doesn't exist.
+        """
+        self.path: str = path
+        self._local: threading.local = threading.local()
+        self._hits: int = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections can't be shared by threads, nor survive a fork
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("CREATE TABLE IF NOT EXISTS hits ("
+                               "key TEXT NOT NULL, window INTEGER NOT NULL, count INTEGER NOT NULL, "
+                               "PRIMARY KEY (key, window))")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def hit(self, key: str, window: int, cost: int, allow: Callable[[int, int], bool]) -> Tuple[int, int, bool]:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            counts = dict(connection.execute("SELECT window, count FROM hits WHERE key = ? AND window >= ?",
+                                             (key, window - 1)).fetchall())
+            previous, current = counts.get(window - 1, 0), counts.get(window, 0)
+            allowed = allow(previous, current + cost)
+            if allowed:
+                connection.execute("INSERT INTO hits (key, window, count) VALUES (?, ?, ?) "
+                                   "ON CONFLICT (key, window) DO UPDATE SET count = count + excluded.count",
+                                   (key, window, cost))
+                current += cost
+            self._hits += 1
+            if self._hits % self.CLEANUP_EVERY == 0:
+                connection.execute("DELETE FROM hits WHERE window < ?", (window - 1,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return previous, current, allowed
+
+
+class RateLimit(NamedTuple):
+    """The outcome of a hit on a :class:`SlidingWindowLimiter`."""
+
+    allowed: bool
+    """Whether the hit is within the limit."""
+
+    limit: int
+    """The maximum number of hits allowed in a window."""
+
+    remaining: int
+    """The number of hits still allowed in the current window."""
+
+    reset: int
+    """The number of seconds after which the current window ends."""
+
+    retry_after: int
+    """The number of seconds to wait before the limit allows another hit, or 0 if it already does."""
+
+
+class SlidingWindowLimiter:
+    """
+    A rate limiter approximating a sliding window by weighting the hits of the previous fixed window by how much it
+    still overlaps with the sliding one.
+    """
+
+    def __init__(self, backend: RateLimitBackend, window: float = 60, clock: Callable[[], float] = time.time):
+        """
+        Initialize a SlidingWindowLimiter object.
+
+        :param backend: The storage of the hit counters.
+        :param window: The length of the window in seconds.
+        :param clock: The function used to get the current time; it must be the same in all processes.
+        """
+        self.backend: RateLimitBackend = backend
+        self.window: float = window
+        self.clock: Callable[[], float] = clock
+
+    def hit(self, key: str, limit: int, cost: int = 1) -> RateLimit:
+        """
+        Count hits towards the limit of a key, if they are within it; rejected hits aren't counted, so that retrying
+        too early doesn't extend the wait.
+
+        :param key: The key being limited, such as a token or an IP address.
+        :param limit: The maximum number of hits allowed in a window.
+        :param cost: The number of hits to count.
+        :return: Whether the hits are allowed, and the state of the limit.
+        """
+        now = self.clock()
+        window, offset = divmod(now, self.window)
+        weight = 1 - offset / self.window
+        previous, current, allowed = self.backend.hit(
+            key, int(window), cost,
+            allow=lambda previous_hits, current_hits: previous_hits * weight + current_hits <= limit,
+        )
+        estimate = previous * weight + current
+        return RateLimit(
+            allowed=allowed,
+            limit=limit,
+            remaining=max(0, math.floor(limit - estimate)),
+            reset=math.ceil(self.window - offset),
+            retry_after=0 if allowed else math.ceil(self._retry_after(limit, previous, current, offset, cost)),
+        )
+
+    def _retry_after(self, limit: int, previous: int, current: int, offset: float, cost: int) -> float:
+        # The weight of the previous window decreases linearly until the end of the current one...
+        if current + cost <= limit and previous > 0:
+            return max(0.0, self.window * (1 - (limit - cost - current) / previous) - offset)
+        # ...after which the current window becomes the previous one, and decreases in the same way
+        if current == 0:
+            # More hits than the limit are never allowed
+            return self.window - offset
+        return self.window - offset + self.window * max(0.0, 1 - (limit - cost) / current)
+
+
+def backend_from_url(url: str) -> RateLimitBackend:
+    """
+    Create a backend from its description.
+
+    :param url: Either ``memory``, or ``sqlite:`` followed by the path of the database file.
+    :return: The created backend.
+    """
+    if url == "memory":
+        return MemoryBackend()
+    if url.startswith("sqlite:"):
+        return SQLiteBackend(url[len("sqlite:"):])
+    raise ValueError(f"Unknown rate limit backend: {url}")
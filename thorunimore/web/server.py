@@ -0,0 +1,81 @@
+import logging
+import multiprocessing
+import os
+
+import flask
+import gunicorn.app.base
+from royalnet.typing import *
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "server_options",
+    "precompile_templates",
+    "Server",
+)
+
+
+def server_options(environ: Mapping[str, str] = os.environ) -> Dict[str, Any]:
+    """
+    Build the gunicorn settings of the production server from the environment.
+
+    :param environ: The mapping to read the settings from.
+    :return: The gunicorn settings.
+    """
+    threads = int(environ.get("WEB_THREADS", 4))
+    return {
+        "bind": environ.get("WEB_BIND", "127.0.0.1:30008"),
+        "workers": int(environ.get("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1)),
+        "threads": threads,
+        "worker_class": "gthread" if threads > 1 else "sync",
+        "timeout": int(environ.get("WEB_TIMEOUT", 30)),
+        "graceful_timeout": int(environ.get("WEB_GRACEFUL_TIMEOUT", 30)),
+        "max_requests": int(environ.get("WEB_MAX_REQUESTS", 0)),
+        "max_requests_jitter": int(environ.get("WEB_MAX_REQUESTS_JITTER", 0)),
+        # Everything is set up once in the master process, and inherited by the workers when they are forked
+        "preload_app": True,
+    }
+
+
+def precompile_templates(app: flask.Flask) -> int:
+    """
+    Compile all the templates of an app into the cache of its Jinja environment, so that processes forked afterwards
+    don't have to compile them again while handling requests.
+
+    :param app: The app whose templates should be compiled.
+    :return: The number of compiled templates.
+    """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    log.debug(f"Precompiled {len(names)} templates")
+    return len(names)
+
+
+class Server(gunicorn.app.base.BaseApplication):
+    """
+    A gunicorn server running a WSGI app which has already been imported, configured without command line arguments.
+
+    The server reloads gracefully on ``SIGHUP``, starting new workers and letting the old ones finish their requests;
+    since the app is preloaded, new code is picked up only by upgrading the master process with ``SIGUSR2``.
+    """
+
+    def __init__(self, application: Callable, options: Dict[str, Any]):
+        """
+        Initialize a Server object.
+
+        :param application: The WSGI app to serve.
+        :param options: The gunicorn settings, such as the ones built by :func:`server_options` and server hooks such
+                        as ``post_fork``.
+        """
+        self.application: Callable = application
+        self.options: Dict[str, Any] = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self) -> Callable:
+        return self.application
@@ -0,0 +1,83 @@
+import hashlib
+import hmac
+import logging
+import time
+
+from royalnet.typing import *
+
+from ..registry import PeriodicRegistry
+
+log = logging.getLogger(__name__)
+
+__all__ = (
+    "RegisteredToken",
+    "TokenRegistry",
+)
+
+
+class RegisteredToken(NamedTuple):
+    """A valid API token, as known by a :class:`TokenRegistry`."""
+
+    id: int
+    """The id of the token."""
+
+    rate_limit: Optional[int]
+    """The quota of the token, or None if it uses the default one."""
+
+
+class TokenRegistry(PeriodicRegistry):
+    """
+    An in-memory registry of the valid API tokens, so that checking a token never requires a database query.
+
+    Tokens are indexed by their SHA-256 digest and then compared in constant time, so that the time taken to reject a
+    token reveals nothing about the valid ones.
+    The registry has to be reloaded periodically, for example with :meth:`start`, so that new and revoked tokens are
+    picked up without restarting the process.
+    """
+
+    def __init__(self,
+                 load: Callable[[], Iterable[Tuple[int, str, Optional[int]]]],
+                 refresh_interval: float = 60,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize a TokenRegistry object; it will be empty until it is refreshed for the first time.
+
+        :param load: A function returning the id, the value and the quota of all the valid tokens.
+        :param refresh_interval: The number of seconds after which the registry should be reloaded.
+        :param clock: The function used to get the current time.
+        """
+        super().__init__(refresh_interval=refresh_interval, clock=clock)
+        self.load: Callable[[], Iterable[Tuple[int, str, Optional[int]]]] = load
+
+        self.tokens: Dict[bytes, Tuple[RegisteredToken, bytes]] = {}
+        "The valid tokens, as a mapping of their digest to their details and their encoded value."
+
+    def __repr__(self):
+        return f"{self.__class__.__qualname__}(size={len(self.tokens)}, {self.refreshed=}, {self.failures=})"
+
+    @staticmethod
+    def _digest(value: bytes) -> bytes:
+        return hashlib.sha256(value).digest()
+
+    def _reload(self) -> None:
+        tokens = {}
+        for token_id, token, rate_limit in self.load():
+            value = token.encode("utf8")
+            tokens[self._digest(value)] = (RegisteredToken(id=token_id, rate_limit=rate_limit), value)
+        self.tokens = tokens
+
+    def validate(self, token: str) -> Optional[RegisteredToken]:
+        """
+        Check whether a token is valid.
+
+        :param token: The token to check.
+        :return: The details of the token if it is valid, None otherwise.
+        """
+        value = token.encode("utf8")
+        entry = self.tokens.get(self._digest(value))
+        if entry is None:
+            return None
+        registered, expected = entry
+        if not hmac.compare_digest(expected, value):
+            return None
+        return registered